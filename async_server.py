@@ -0,0 +1,439 @@
+"""Serves map_server.py's API (or with --tiles, tile_server.py's tiles) from
+one thread per process with Tornado, reading MongoDB through Motor.
+
+Requests are coroutines rather than threads, so a process can keep
+thousands of them waiting on MongoDB at once. Queries that don't depend on
+each other are sent together: a map request's ways are read while its
+nodes are being written out, and the nodes of those ways and their
+relations come from concurrent $in queries. Responses are written a
+section at a time as the documents arrive.
+
+Needs Motor 0.7 and Tornado 4, the last releases that work with pymongo 2
+(pip install "motor==0.7" "tornado<5")."""
+
+import re
+import sys
+import json
+import logging
+from itertools import islice
+
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+from compactschema import expandRecord, scaleQuery
+from globalmaptiles import GlobalMercator
+from insert_tiled_osm_data import wayTileQuery
+from osmxml import DEFAULT_CHUNK_BYTES
+from nodestore import IdSet
+from mongopool import addPoolOptions
+from map_server import IN_CHUNK, OUTPUTS, QueryStats, bboxBounds, buildMongoQuery, outputFormat
+import tile_server
+from tile_server import TileCache, SharedInvalidations, metatileBlock, blockNodeQuery, \
+    otherNodeIds, splitMetatile, tileFormat
+from tilestore import gunzipBytes
+
+log = logging.getLogger('mongosm')
+
+class AsyncOsmApi(object):
+    """map_server.OsmApi's queries as coroutines on a Motor client, writing
+    their results with write(section, documents), a coroutine. Each
+    request gets its own so that its queries can be counted; the client
+    and its connections are shared."""
+    def __init__(self, client, compact=False):
+        self.db = client.osm
+        self.compact = compact
+        self.queries = 0
+
+    def find(self, collection, query, fields=None):
+        self.queries = self.queries + 1
+        return collection.find(query, fields)
+
+    def findOne(self, collection, query, fields=None):
+        self.queries = self.queries + 1
+        return collection.find_one(query, fields)
+
+    def findIn(self, collection, ids):
+        """Send a query for every IN_CHUNK ids at once, returning a future
+        list of documents for each"""
+        ids = iter(ids)
+        futures = []
+        while True:
+            chunk = list(islice(ids, IN_CHUNK))
+            if not chunk:
+                break
+            futures.append(self.find(collection, {'_id': {'$in': chunk}}).to_list(None))
+        return futures
+
+    def scale(self, query):
+        """Scale bbox and polygon queries for fixed-point coordinates"""
+        if self.compact:
+            return scaleQuery(query)
+        return query
+
+    @gen.coroutine
+    def writeCursor(self, cursor, name, write, seen=None):
+        """Write a cursor's documents as they arrive. If seen is given, the
+        ids of the documents are added to it."""
+        fetch = cursor.fetch_next
+        while (yield fetch):
+            # Everything Motor already has buffered goes out together
+            rows = []
+            while fetch.done() and fetch.result():
+                row = cursor.next_object()
+                if seen is not None:
+                    seen.add(row['_id'])
+                rows.append(expandRecord(row))
+                fetch = cursor.fetch_next
+            yield write(name, rows)
+
+    @gen.coroutine
+    def writeFutures(self, futures, name, write):
+        """Write the documents of findIn() futures in order"""
+        for future in futures:
+            rows = yield future
+            yield write(name, [expandRecord(row) for row in rows])
+
+    @gen.coroutine
+    def readWays(self, ways, nodeIds):
+        """The ways from a future list of them, the ids of their nodes that
+        aren't in nodeIds and the ids of their relations"""
+        ways = [expandRecord(row) for row in (yield ways)]
+        wayNodeIds = IdSet()
+        relationIds = set()
+        for way in ways:
+            for nodeId in way['nd']:
+                if nodeId not in nodeIds:
+                    wayNodeIds.add(nodeId)
+            relationIds.update(way.get('relations', []))
+        raise gen.Return((ways, wayNodeIds, relationIds))
+
+    @gen.coroutine
+    def getBbox(self, bbox, write):
+        """Everything in a bbox, in the order map_server.OsmApi.getBbox()
+        writes it. Unlike there, the ways are held in memory: they are read
+        along with the nodes, before the nodes have all been written."""
+        bbox = self.scale(bbox)
+        nodeIds = IdSet()
+        ways = self.find(self.db.ways, bbox).to_list(None)
+        yield self.writeCursor(self.find(self.db.nodes, bbox), 'nodes', write, nodeIds)
+
+        (ways, wayNodeIds, relationIds) = yield self.readWays(ways, nodeIds)
+        # Both only need the ways, so they're read at the same time
+        wayNodes = self.findIn(self.db.nodes, wayNodeIds)
+        relations = self.findIn(self.db.relations, relationIds)
+        yield write('ways', ways)
+        yield self.writeFutures(wayNodes, 'wayNodes', write)
+        yield self.writeFutures(relations, 'relations', write)
+
+    @gen.coroutine
+    def getNodes(self, query, write):
+        yield self.writeCursor(self.find(self.db.nodes, self.scale(query)), 'nodes', write)
+
+    @gen.coroutine
+    def getWays(self, query, write):
+        ways = self.find(self.db.ways, self.scale(query)).to_list(None)
+        (ways, wayNodeIds, relationIds) = yield self.readWays(ways, IdSet())
+        yield self.writeFutures(self.findIn(self.db.nodes, wayNodeIds), 'nodes', write)
+        yield write('ways', ways)
+
+    @gen.coroutine
+    def getRelations(self, query, write):
+        yield self.writeCursor(self.find(self.db.relations, self.scale(query)), 'relations', write)
+
+    @gen.coroutine
+    def getPrimitives(self, query, write):
+        """Nodes matching the query, the other nodes of the ways matching
+        it and then the ways, with the nodes and ways queries sent at once"""
+        query = self.scale(query)
+        seen = IdSet()
+        ways = self.find(self.db.ways, query).to_list(None)
+        yield self.writeCursor(self.find(self.db.nodes, query), 'nodes', write, seen)
+
+        (ways, wayNodeIds, relationIds) = yield self.readWays(ways, seen)
+        yield self.writeFutures(self.findIn(self.db.nodes, wayNodeIds), 'nodes', write)
+        yield write('ways', ways)
+
+    @gen.coroutine
+    def getById(self, collection, name, id, write):
+        row = yield self.findOne(collection, {'_id': id})
+        if row:
+            yield write(name, [expandRecord(row)])
+
+    def getNodeById(self, id, write):
+        return self.getById(self.db.nodes, 'nodes', id, write)
+
+    def getWayById(self, id, write):
+        return self.getById(self.db.ways, 'ways', id, write)
+
+    def getRelationById(self, id, write):
+        return self.getById(self.db.relations, 'relations', id, write)
+
+class AsyncTileApi(object):
+    """tile_server.OsmApi's metatiles on a Motor client, with the nodes and
+    ways of the block queried at the same time"""
+    def __init__(self, client):
+        self.db = client.osm
+        self.proj = GlobalMercator()
+
+    @gen.coroutine
+    def getMetatile(self, zoom, x, y, size):
+        (levels, bx, by, blockZoom) = metatileBlock(self.proj, zoom, x, y, size)
+        log.info("Querying for %s.", self.proj.QuadTree(bx, by, blockZoom))
+
+        (nodeRows, wayRows) = yield [
+            self.db.nodes.find(blockNodeQuery(self.proj, bx, by, blockZoom)).to_list(None),
+            self.db.ways.find(wayTileQuery(self.proj, bx, by, blockZoom)).to_list(None)]
+        nodes = dict((row['_id'], expandRecord(row)) for row in nodeRows)
+        ways = dict((row['_id'], expandRecord(row)) for row in wayRows)
+
+        # Nodes on ways that extend beyond the block
+        otherRows = yield self.db.nodes.find(
+            {'_id': {'$in': list(otherNodeIds(ways, nodes))} }).to_list(None)
+        otherNodes = dict((row['_id'], expandRecord(row)) for row in otherRows)
+
+        raise gen.Return(splitMetatile(self.proj, zoom, x, y, levels, nodes, ways, otherNodes))
+
+class ApiHandler(web.RequestHandler):
+    """Base for the API handlers. stream() writes a response a section
+    at a time and flushes it to the client every DEFAULT_CHUNK_BYTES."""
+    endpoint = None
+
+    def prepare(self):
+        self.api = AsyncOsmApi(self.application.client, self.application.compact)
+
+    @gen.coroutine
+    def stream(self, format, data, method, *args):
+        """Write data's header, call method(*args, write) and write the
+        footer, recording the queries it took"""
+        stats = self.application.stats
+        stats['in_flight'] = stats['in_flight'] + 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            (outputClass, contentType) = OUTPUTS[format]
+            self.outputter = outputClass()
+            self.pending = 0
+            self.set_header('Content-Type', contentType)
+            self.write(self.outputter.header(data))
+            yield method(*(args + (self.writeSection,)))
+            self.write(self.outputter.footer())
+        finally:
+            stats['in_flight'] = stats['in_flight'] - 1
+            self.application.queryStats.record(self.endpoint, self.api.queries)
+            log.info("%s took %d queries", self.endpoint, self.api.queries)
+
+    @gen.coroutine
+    def writeSection(self, name, mappables):
+        chunk = self.outputter.section(name, mappables)
+        self.write(chunk)
+        self.pending = self.pending + len(chunk)
+        if self.pending >= DEFAULT_CHUNK_BYTES:
+            self.pending = 0
+            yield self.flush()
+
+class MapHandler(ApiHandler):
+    endpoint = 'mapRequest'
+
+    @gen.coroutine
+    def get(self):
+        format = outputFormat(self.request, self.request.path)[0]
+        query = buildMongoQuery('[bbox=%s]' % (self.get_argument('bbox'),))
+        yield self.stream(format, {'bounds': bboxBounds(query)}, self.api.getBbox, query)
+
+class ElementHandler(ApiHandler):
+    ENDPOINTS = {'node': 'getNode', 'way': 'getWay', 'relation': 'getRelation'}
+
+    @gen.coroutine
+    def get(self, type, id):
+        self.endpoint = self.ENDPOINTS[type]
+        (format, id) = outputFormat(self.request, id)
+        method = getattr(self.api, 'get%sById' % (type.capitalize(),))
+        yield self.stream(format, {}, method, long(id))
+
+class QueryHandler(ApiHandler):
+    ENDPOINTS = {'node': ('getNodeQuery', 'getNodes'),
+                 'way': ('getWayQuery', 'getWays'),
+                 'relation': ('getRelationQuery', 'getRelations'),
+                 '*': ('getPrimitiveQuery', 'getPrimitives')}
+
+    @gen.coroutine
+    def get(self, type, xapi_query):
+        (self.endpoint, method) = self.ENDPOINTS[type]
+        (format, xapi_query) = outputFormat(self.request, xapi_query)
+        query = buildMongoQuery(xapi_query)
+        yield self.stream(format, {}, getattr(self.api, method), query)
+
+class StatsHandler(web.RequestHandler):
+    def get(self):
+        stats = dict(self.application.stats)
+        stats['queries'] = self.application.queryStats.stats()
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(stats))
+
+class CapabilitiesHandler(web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write("""
+            <osm version="0.6" generator="mongosm 0.1">
+                <api>
+                    <version minimum="0.6" maximum="0.6"/>
+                    <area maximum="0.5"/>
+                </api>
+            </osm>""")
+
+class TileHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self, zoom, x, y):
+        format = tileFormat(self.request, y)
+        (outputClass, contentType) = tile_server.OUTPUTS[format]
+        (zoom, x, y) = (int(zoom), int(x), int(y.split('.')[0]))
+        cache = self.application.cache
+        api = self.application.tileApi
+        self.set_header('Content-Type', contentType)
+
+        if cache is None:
+            docs = yield api.getMetatile(zoom, x, y, 1)
+            for chunk in outputClass().iter(docs[(x, y)]):
+                self.write(chunk)
+            return
+
+        cached = cache.get(zoom, x, y, format)
+        if cached is None:
+            # Neighbouring tiles are likely to be asked for next, so render
+            # the whole metatile and cache all of it
+            docs = yield api.getMetatile(zoom, x, y, self.application.metatile)
+            for ((tileX, tileY), data) in docs.iteritems():
+                tileBody = ''.join(outputClass().iter(data))
+                cache.put(zoom, tileX, tileY, tileBody, format)
+                if (tileX, tileY) == (x, y):
+                    body = tileBody
+            self.write(body)
+            return
+
+        (body, gzipped) = cached
+        if gzipped and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+        elif gzipped:
+            body = gunzipBytes(body)
+        self.write(body)
+
+class InvalidateHandler(web.RequestHandler):
+    def post(self, quadkey):
+        """Drop cached tiles overlapping a changed tile, given as a quadkey"""
+        if not re.match('^[0-3]*$', quadkey):
+            raise web.HTTPError(400, "Not a quadkey: %s" % (quadkey,))
+        dropped = 0
+        if self.application.cache is not None:
+            dropped = self.application.cache.invalidate(quadkey)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'invalidated': dropped}))
+
+class CacheStatsHandler(web.RequestHandler):
+    def get(self):
+        cache = self.application.cache
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(cache.stats() if cache is not None else {}))
+
+class AsyncMongosm(web.Application):
+    """The routes of map_server.Mongosm, but for the unfinished
+    /api/0.6/changesets"""
+    def __init__(self, client, compact=False, **settings):
+        self.client = client
+        self.compact = compact
+        self.queryStats = QueryStats()
+        self.stats = {'in_flight': 0, 'max_in_flight': 0}
+        web.Application.__init__(self, [
+            (r'/api/0\.6/map(?:\.json)?', MapHandler),
+
+            (r'/api/0\.6/(node|way|relation)/([^/]+)', ElementHandler),
+            (r'/api/0\.6/(node|way|relation|\*)([^/]+)', QueryHandler),
+
+            (r'/api/capabilities', CapabilitiesHandler),
+            (r'/api/stats', StatsHandler),
+        ], **settings)
+
+class AsyncTileMongosm(web.Application):
+    """The routes of tile_server.Mongosm, but for /tiles/pool. There is no
+    --store, since its reads would hold up every other request."""
+    def __init__(self, client, cache=None, metatile=1, **settings):
+        self.tileApi = AsyncTileApi(client)
+        self.cache = cache
+        self.metatile = metatile
+        web.Application.__init__(self, [
+            (r'/tiles/0\.6/(\d+)/(\d+)/([^/]+)', TileHandler),
+            (r'/tiles/invalidate/([^/]*)', InvalidateHandler),
+            (r'/tiles/cache', CacheStatsHandler),
+            (r'/api/capabilities', CapabilitiesHandler),
+        ], **settings)
+
+@gen.coroutine
+def isCompactAsync(client):
+    """compactschema.isCompact() through Motor"""
+    schema = yield client.osm.schema.find_one({'_id': 'schema'})
+    raise gen.Return(bool(schema and schema.get('compact')))
+
+def openClient(options):
+    """The Motor client selected by the mongopool.addPoolOptions() options"""
+    import motor
+    return motor.MotorClient(options.mongo,
+                             maxPoolSize=options.poolSize,
+                             connectTimeoutMS=options.connectTimeoutMs,
+                             socketTimeoutMS=options.socketTimeoutMs,
+                             waitQueueTimeoutMS=options.waitTimeoutMs,
+                             readPreference=options.readPreference)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("--tiles", dest="tiles", action="store_true", default=False,
+                      help="serve tile_server.py's tiles from a tiled database "
+                           "instead of map_server.py's API")
+    parser.add_option("--cache-mb", dest="cacheMb", type="int", default=64,
+                      help="with --tiles, MB of rendered tiles to keep in memory, "
+                           "0 to turn the cache off [%default]")
+    parser.add_option("--cache-gzip", dest="cacheGzip", action="store_true",
+                      default=False, help="with --tiles, keep cached tiles gzipped")
+    parser.add_option("--metatile", dest="metatile", type="int", default=1,
+                      help="with --tiles, load and cache the whole N x N block of "
+                           "tiles around a missed tile (N a power of two) [%default]")
+    addPoolOptions(parser)
+    parser.add_option("--host", dest="host", default="0.0.0.0",
+                      help="address to listen on [%default]")
+    parser.add_option("--port", dest="port", type="int", default=5000,
+                      help="port to listen on [%default]")
+    parser.add_option("--processes", dest="processes", type="int", default=1,
+                      help="processes to serve from, each with its own MongoDB "
+                           "connections; 0 starts one per CPU [%default]")
+    parser.add_option("--no-access-log", dest="accessLog", action="store_false",
+                      default=True, help="don't log every request")
+    (options, args) = parser.parse_args()
+    if options.metatile < 1 or options.metatile & (options.metatile - 1):
+        parser.error("--metatile must be a power of two")
+
+    logging.basicConfig(level=logging.INFO if options.accessLog else logging.WARNING)
+
+    sockets = bind_sockets(options.port, options.host)
+    # Tile invalidations have to reach every process's cache
+    shared = SharedInvalidations() if options.tiles and options.cacheMb > 0 else None
+    print "Serving on http://%s:%d/." % (options.host, options.port)
+    sys.stdout.flush()
+    if options.processes != 1:
+        # Motor clients don't survive a fork, so each process opens its own
+        fork_processes(options.processes)
+
+    client = openClient(options)
+    if options.tiles:
+        cache = None
+        if options.cacheMb > 0:
+            cache = TileCache(options.cacheMb * 1024 * 1024, options.cacheGzip, shared)
+        app = AsyncTileMongosm(client, cache, options.metatile)
+    else:
+        compact = IOLoop.current().run_sync(lambda: isCompactAsync(client))
+        app = AsyncMongosm(client, compact)
+
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    IOLoop.current().start()
@@ -0,0 +1,105 @@
+"""Collects member -> relation links while relations are parsed and writes
+them to the nodes and ways collections in bulk once the import is done."""
+
+import sys
+import time
+import heapq
+import struct
+import tempfile
+
+# Links that spill to disk are written as (type, member id, relation id).
+LINK = struct.Struct('<bqq')
+TYPES = ['node', 'way']
+
+class RelationBackrefs(object):
+    """Buffers member -> relation links in memory, spilling sorted runs to
+    temporary files once more than maxLinks are held, and applies them as
+    unordered bulk $addToSet updates grouped by member document."""
+    def __init__(self, client, maxLinks=5000000, batchSize=1000, tempDir=None):
+        self.client = client
+        self.maxLinks = maxLinks
+        self.batchSize = batchSize
+        self.tempDir = tempDir
+        self.links = []
+        self.runs = []
+        self.stat_links = 0
+        self.stat_updates = 0
+
+    def add(self, memberType, ref, relationId):
+        """Remember that relationId has the given node or way as a member"""
+        if memberType not in TYPES:
+            return
+        self.links.append((TYPES.index(memberType), ref, relationId))
+        self.stat_links = self.stat_links + 1
+        if len(self.links) >= self.maxLinks:
+            self.spill()
+
+    def spill(self):
+        """Write the in-memory links out as a sorted run"""
+        self.links.sort()
+        run = tempfile.TemporaryFile(dir=self.tempDir)
+        for link in self.links:
+            run.write(LINK.pack(*link))
+        run.seek(0)
+        self.runs.append(run)
+        self.links = []
+
+    def readRun(self, run):
+        while True:
+            data = run.read(LINK.size)
+            if len(data) < LINK.size:
+                break
+            yield LINK.unpack(data)
+
+    def sortedLinks(self):
+        self.links.sort()
+        if not self.runs:
+            return iter(self.links)
+        return heapq.merge(self.links, *[self.readRun(run) for run in self.runs])
+
+    def groupedLinks(self):
+        """Yield (type, member id, [relation ids]) for every member"""
+        current = None
+        relations = []
+        for (typeIndex, ref, relationId) in self.sortedLinks():
+            if (typeIndex, ref) != current:
+                if current is not None:
+                    yield (TYPES[current[0]], current[1], relations)
+                current = (typeIndex, ref)
+                relations = []
+            if not relations or relations[-1] != relationId:
+                relations.append(relationId)
+        if current is not None:
+            yield (TYPES[current[0]], current[1], relations)
+
+    def execute(self, collection, updates):
+        bulk = collection.initialize_unordered_bulk_op()
+        for (ref, relations) in updates:
+            bulk.find({'_id': ref}).update({'$addToSet': {'relations': {'$each': relations}}})
+        bulk.execute()
+        self.stat_updates = self.stat_updates + len(updates)
+
+    def apply(self):
+        """Apply every collected link to the member documents"""
+        start = time.time()
+        collections = {'node': self.client.osm.nodes,
+                       'way': self.client.osm.ways}
+        pending = {'node': [], 'way': []}
+        for (memberType, ref, relations) in self.groupedLinks():
+            pending[memberType].append((ref, relations))
+            if len(pending[memberType]) >= self.batchSize:
+                self.execute(collections[memberType], pending[memberType])
+                pending[memberType] = []
+        for memberType in TYPES:
+            if pending[memberType]:
+                self.execute(collections[memberType], pending[memberType])
+
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.links = []
+
+        elapsed = time.time() - start
+        rate = self.stat_updates / elapsed if elapsed > 0 else 0
+        sys.stdout.write("\nApplied %d relation links to %d members in %.1fs (%d updates/s)\n" % (
+                         self.stat_links, self.stat_updates, elapsed, rate))
@@ -0,0 +1,480 @@
+"""Import benchmarks: generates a synthetic OSM XML file and runs the
+importers against it, recording throughput, peak memory and database
+round trips as JSON so runs can be compared.
+
+By default the importers write to MemoryClient, an in-process stand-in
+for MongoDB, which measures the importers themselves. With --mongo they
+write to a real mongod instead."""
+
+import os
+import sys
+import json
+import math
+import time
+import Queue
+import random
+import resource
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+from xml.sax.saxutils import quoteattr
+
+# Bulk writes are sent in groups of at most this many operations
+MAX_WRITE_BATCH = 1000
+
+TAG_KEYS = ['highway', 'building', 'name', 'amenity', 'landuse', 'surface',
+            'source', 'addr:street', 'addr:housenumber', 'natural', 'oneway']
+TAG_VALUES = ['yes', 'no', 'residential', 'service', 'footway', 'house',
+              'asphalt', 'survey', 'bing', 'school', 'parking', 'water']
+ROLES = ['', 'outer', 'inner', 'stop', 'platform', 'forward']
+
+def randomTags(rand, average):
+    tags = []
+    for i in range(rand.randint(0, average * 2)):
+        k = rand.choice(TAG_KEYS)
+        if k == 'name':
+            v = 'Street %d' % (rand.randint(1, 100000),)
+        else:
+            v = rand.choice(TAG_VALUES)
+        tags.append((k, v))
+    return tags
+
+def writeElement(out, name, attrs, tags, children):
+    out.write('  <%s %s' % (name, ' '.join('%s=%s' % (k, quoteattr(str(v)))
+                                           for (k, v) in attrs)))
+    if not tags and not children:
+        out.write('/>\n')
+        return
+    out.write('>\n')
+    for child in children:
+        out.write('    %s\n' % (child,))
+    for (k, v) in tags:
+        out.write('    <tag k=%s v=%s/>\n' % (quoteattr(k), quoteattr(v)))
+    out.write('  </%s>\n' % (name,))
+
+def generateOsm(out, nodes=100000, waysPerNode=0.1, relationsPerWay=0.05,
+                tags=2, wayLength=10, members=8, bbox=(-1.0, 51.0, 0.0, 52.0),
+                seed=1):
+    """Write a synthetic OSM XML file, returning how many nodes, ways and
+    relations it holds.
+
+    Nodes are spread evenly over bbox (minlon, minlat, maxlon, maxlat).
+    Ways use runs of nearby node ids, like real data sorted by id does,
+    and relations mix nodes, ways and earlier relations. tags, wayLength
+    and members are averages."""
+    rand = random.Random(seed)
+    (minlon, minlat, maxlon, maxlat) = bbox
+    ways = int(nodes * waysPerNode)
+    relations = int(ways * relationsPerWay)
+
+    def info(id):
+        return [('id', id),
+                ('version', rand.randint(1, 5)),
+                ('timestamp', time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                            time.gmtime(rand.randint(1100000000, 1400000000)))),
+                ('uid', rand.randint(1, 5000)),
+                ('user', 'user%d' % (rand.randint(1, 5000),)),
+                ('changeset', rand.randint(1, 20000000))]
+
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<osm version="0.6" generator="mongosm benchmark">\n')
+    for id in xrange(1, nodes + 1):
+        attrs = info(id)
+        attrs.append(('lat', '%.7f' % (rand.uniform(minlat, maxlat),)))
+        attrs.append(('lon', '%.7f' % (rand.uniform(minlon, maxlon),)))
+        writeElement(out, 'node', attrs, randomTags(rand, tags), [])
+
+    for id in xrange(1, ways + 1):
+        length = max(2, rand.randint(2, wayLength * 2 - 2))
+        start = rand.randint(1, max(1, nodes - length))
+        refs = ['<nd ref="%d"/>' % (min(nodes, start + i),) for i in range(length)]
+        if rand.random() < 0.2:
+            # Closed ways (areas) end on their first node
+            refs.append(refs[0])
+        writeElement(out, 'way', info(id), randomTags(rand, tags), refs)
+
+    for id in xrange(1, relations + 1):
+        children = []
+        for i in range(rand.randint(1, members * 2 - 1)):
+            kind = rand.random()
+            if kind < 0.6 and ways:
+                (memberType, ref) = ('way', rand.randint(1, ways))
+            elif kind < 0.95 or id == 1:
+                (memberType, ref) = ('node', rand.randint(1, nodes))
+            else:
+                (memberType, ref) = ('relation', rand.randint(1, id - 1))
+            children.append('<member type="%s" ref="%d" role=%s/>' % (
+                memberType, ref, quoteattr(rand.choice(ROLES))))
+        relationTags = randomTags(rand, tags) + [('type', rand.choice(['route', 'multipolygon']))]
+        writeElement(out, 'relation', info(id), relationTags, children)
+    out.write('</osm>\n')
+
+    return {'nodes': nodes, 'ways': ways, 'relations': relations}
+
+class MemoryBulk(object):
+    """Stand-in for a pymongo unordered bulk operation"""
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+        self.query = None
+
+    def insert(self, doc):
+        self.ops.append(('insert', None, doc))
+
+    def find(self, query):
+        self.query = query
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self, doc):
+        self.ops.append(('replace', self.query, doc))
+
+    def update(self, update):
+        self.ops.append(('update', self.query, update))
+
+    def execute(self, writeConcern=None):
+        self.collection.client.roundTrips += int(math.ceil(len(self.ops) / float(MAX_WRITE_BATCH)))
+        for (op, query, doc) in self.ops:
+            if op == 'update':
+                self.collection.applyUpdate(query, doc, False)
+            else:
+                self.collection.docs[doc['_id']] = doc
+        return {'nInserted': len(self.ops)}
+
+class MemoryCursor(object):
+    """What find() returns: an iterator with a no-op batch_size()"""
+    def __init__(self, docs):
+        self.docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.docs.next()
+
+    def batch_size(self, size):
+        return self
+
+class MemoryCollection(object):
+    """Stand-in for a pymongo collection, supporting just what the
+    importers and map_server.py use. Queries only look at _id, or at loc
+    for the map's bbox queries."""
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.docs = {}
+
+    def roundTrip(self):
+        self.client.roundTrips += 1
+        if self.client.latency:
+            time.sleep(self.client.latency)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self)
+
+    def insert(self, docs, **kwargs):
+        self.roundTrip()
+        if isinstance(docs, dict):
+            docs = [docs]
+        for doc in docs:
+            self.docs[doc['_id']] = doc
+
+    def save(self, doc, **kwargs):
+        self.roundTrip()
+        self.docs[doc['_id']] = doc
+
+    def matching(self, query):
+        if not query:
+            return self.docs.values()
+        if 'loc' in query:
+            return self.inBox(query['loc']['$within']['$polygon'])
+        ids = query.get('_id')
+        if isinstance(ids, dict):
+            return [self.docs[id] for id in ids.get('$in', []) if id in self.docs]
+        if ids in self.docs:
+            return [self.docs[ids]]
+        return []
+
+    def inBox(self, polygon):
+        """Documents with a location (or a way point) in the bounding box of
+        polygon"""
+        lats = [point[0] for point in polygon]
+        lons = [point[1] for point in polygon]
+        (minlat, maxlat, minlon, maxlon) = (min(lats), max(lats), min(lons), max(lons))
+        docs = []
+        for doc in self.docs.itervalues():
+            loc = doc.get('loc')
+            if not loc:
+                continue
+            points = loc if isinstance(loc[0], list) else [loc]
+            for (lat, lon) in points:
+                if minlat <= lat <= maxlat and minlon <= lon <= maxlon:
+                    docs.append(doc)
+                    break
+        return docs
+
+    def find(self, query=None, fields=None, **kwargs):
+        docs = self.matching(query)
+        for i in range(1 + len(docs) / MAX_WRITE_BATCH):
+            self.roundTrip()
+        return MemoryCursor(docs)
+
+    def find_one(self, query=None, fields=None, sort=None, **kwargs):
+        self.roundTrip()
+        docs = self.matching(query)
+        if sort:
+            (field, direction) = sort[0]
+            docs = sorted(docs, key=lambda doc: doc.get(field), reverse=direction < 0)
+        if docs:
+            return docs[0]
+        return None
+
+    def applyUpdate(self, query, update, upsert):
+        doc = self.docs.get(query['_id'])
+        if doc is None:
+            if not upsert:
+                return
+            doc = dict(query)
+            self.docs[doc['_id']] = doc
+        for (field, value) in update.get('$set', {}).iteritems():
+            doc[field] = value
+        for (field, value) in update.get('$addToSet', {}).iteritems():
+            values = doc.setdefault(field, [])
+            for v in value.get('$each', [value]) if isinstance(value, dict) else [value]:
+                if v not in values:
+                    values.append(v)
+
+    def update(self, query, update, upsert=False, **kwargs):
+        self.roundTrip()
+        self.applyUpdate(query, update, upsert)
+
+    def remove(self, query=None, **kwargs):
+        self.roundTrip()
+        for doc in self.matching(query):
+            del self.docs[doc['_id']]
+
+    def ensure_index(self, keys, **kwargs):
+        self.roundTrip()
+
+    def create_index(self, keys, **kwargs):
+        self.roundTrip()
+
+    def drop_indexes(self):
+        self.roundTrip()
+
+class MemoryDatabase(object):
+    def __init__(self, client):
+        self.client = client
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self.client, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def current_op(self):
+        self.client.roundTrips += 1
+        return {'inprog': []}
+
+class MemoryClient(object):
+    """In-process stand-in for a MongoClient that keeps documents in
+    dicts and counts the round trips pymongo would have made. Each round
+    trip takes latency seconds."""
+    def __init__(self, latency=0):
+        self.roundTrips = 0
+        self.latency = latency
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self)
+        return self.databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def disconnect(self):
+        pass
+
+def peakRss():
+    """Peak resident set size in KB of this process or any of its
+    finished children (worker and decoder processes)"""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def runImport(importer, filename, importerArgs, mongo, results, verbose):
+    """Child process for one benchmark run, so that its peak RSS is its own"""
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    if mongo:
+        from pymongo import MongoClient
+        client = MongoClient(mongo)
+    else:
+        client = MemoryClient()
+
+    start = time.time()
+    if importer == 'full':
+        import insert_osm_data
+        (options, args) = insert_osm_data.optionParser().parse_args(importerArgs)
+        handler = insert_osm_data.importFile(client, filename, options)
+    else:
+        import insert_tiled_osm_data
+        handler = insert_tiled_osm_data.importFile(client, filename,
+                                                   '--compact' in importerArgs)
+    elapsed = time.time() - start
+
+    results.put({'seconds': elapsed,
+                 'phase_seconds': handler.stat_seconds,
+                 'peak_rss_kb': peakRss(),
+                 'round_trips': getattr(client, 'roundTrips', None)})
+
+def serverRequests(client):
+    return client.admin.command('serverStatus')['network']['numRequests']
+
+def benchmark(importer, filename, counts, importerArgs, mongo, verbose):
+    """Run one import in a child process and work out its rates"""
+    if mongo:
+        from pymongo import MongoClient
+        client = MongoClient(mongo)
+        client.drop_database('osm')
+        before = serverRequests(client)
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=runImport,
+                                      args=(importer, filename, importerArgs,
+                                            mongo, results, verbose))
+    process.start()
+    while True:
+        try:
+            result = results.get(True, 1)
+            break
+        except Queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError("The %s import failed" % (importer,))
+    process.join()
+
+    if mongo:
+        # Less the serverStatus request itself
+        result['round_trips'] = serverRequests(client) - before - 1
+        client.disconnect()
+
+    phases = result['phase_seconds']
+    for name in ('node', 'way', 'relation'):
+        seconds = phases.get(name, 0)
+        count = counts[name + 's']
+        result[name + 's_per_s'] = count / seconds if seconds > 0 else None
+    result['importer'] = importer
+    result['args'] = importerArgs
+    return result
+
+def printResult(result):
+    def rate(value):
+        return '%d/s' % (value,) if value is not None else '-'
+    print "%-5s %-30s %7.1fs  nodes %9s  ways %8s  relations %7s  rss %6dMB  round trips %d" % (
+        result['importer'], ' '.join(result['args']), result['seconds'],
+        rate(result['nodes_per_s']), rate(result['ways_per_s']),
+        rate(result['relations_per_s']), result['peak_rss_kb'] / 1024,
+        result['round_trips'])
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [importer args...]\n\n"
+                                "Arguments after the options (put them after --) are "
+                                "passed to the importers, e.g.\n"
+                                "  %prog --nodes 1000000 -- --defer-indexes --compact")
+    parser.add_option("--importer", dest="importers", action="append",
+                      choices=["full", "tiled"],
+                      help="importer to run: full (insert_osm_data.py) or tiled "
+                           "(insert_tiled_osm_data.py); may be repeated [both]")
+    parser.add_option("--input", dest="input", default=None,
+                      help="benchmark an existing OSM file instead of "
+                           "generating one")
+    parser.add_option("--output", dest="output", default="benchmark.json",
+                      help="file to write the JSON results to [%default]")
+    parser.add_option("--mongo", dest="mongo", default=None,
+                      help="run against the mongod at this host or URI instead "
+                           "of the in-process stand-in. Its osm database is "
+                           "dropped before every run")
+    parser.add_option("--runs", dest="runs", type="int", default=1,
+                      help="times to run each importer [%default]")
+    parser.add_option("--nodes", dest="nodes", type="int", default=100000,
+                      help="nodes to generate [%default]")
+    parser.add_option("--ways-per-node", dest="waysPerNode", type="float",
+                      default=0.1, help="ways generated per node [%default]")
+    parser.add_option("--relations-per-way", dest="relationsPerWay",
+                      type="float", default=0.05,
+                      help="relations generated per way [%default]")
+    parser.add_option("--tags", dest="tags", type="int", default=2,
+                      help="average tags per element [%default]")
+    parser.add_option("--way-length", dest="wayLength", type="int", default=10,
+                      help="average nodes per way [%default]")
+    parser.add_option("--members", dest="members", type="int", default=8,
+                      help="average members per relation [%default]")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="random seed for the generated file [%default]")
+    parser.add_option("--verbose", dest="verbose", action="store_true",
+                      default=False, help="show the importers' own output")
+    (options, importerArgs) = parser.parse_args()
+
+    importers = options.importers or ['full', 'tiled']
+    if not options.mongo and 'full' in importers:
+        fullOptions = __import__('insert_osm_data').optionParser().parse_args(importerArgs)[0]
+        if fullOptions.workers > 0:
+            parser.error("--workers needs a real mongod, use --mongo")
+
+    generated = None
+    if options.input:
+        filename = options.input
+        counts = {'nodes': 0, 'ways': 0, 'relations': 0}
+        for line in open(filename):
+            for name in ('node', 'way', 'relation'):
+                if line.lstrip().startswith('<%s ' % (name,)):
+                    counts[name + 's'] += 1
+    else:
+        (fd, filename) = tempfile.mkstemp(suffix='.osm')
+        out = os.fdopen(fd, 'w')
+        start = time.time()
+        counts = generateOsm(out, options.nodes, options.waysPerNode,
+                             options.relationsPerWay, options.tags,
+                             options.wayLength, options.members,
+                             seed=options.seed)
+        out.close()
+        generated = {'seconds': time.time() - start,
+                     'bytes': os.path.getsize(filename),
+                     'tags': options.tags,
+                     'way_length': options.wayLength,
+                     'members': options.members,
+                     'seed': options.seed}
+        print "Generated %d nodes, %d ways and %d relations (%dMB) in %.1fs." % (
+            counts['nodes'], counts['ways'], counts['relations'],
+            generated['bytes'] / 1024 / 1024, generated['seconds'])
+
+    runs = []
+    try:
+        for importer in importers:
+            for i in range(options.runs):
+                result = benchmark(importer, filename, counts, importerArgs,
+                                   options.mongo, options.verbose)
+                printResult(result)
+                runs.append(result)
+    finally:
+        if generated is not None:
+            os.remove(filename)
+
+    report = {'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              'database': options.mongo or 'stand-in',
+              'input': options.input,
+              'counts': counts,
+              'generated': generated,
+              'runs': runs}
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results written to %s." % (options.output,)
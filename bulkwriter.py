@@ -0,0 +1,168 @@
+"""Batches documents by approximate BSON size and writes them with
+unordered bulk operations, keeping a few batches in flight at once."""
+
+import Queue
+import threading
+
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+def bsonSize(value):
+    """Roughly how many bytes value takes up once encoded as BSON"""
+    if isinstance(value, dict):
+        size = 5
+        for (k, v) in value.iteritems():
+            size = size + len(k) + 2 + bsonSize(v)
+        return size
+    elif isinstance(value, (list, tuple)):
+        size = 5
+        for (i, v) in enumerate(value):
+            size = size + len(str(i)) + 2 + bsonSize(v)
+        return size
+    elif isinstance(value, basestring):
+        return len(value) + 5
+    elif isinstance(value, bool):
+        return 1
+    elif value is None:
+        return 0
+    return 8
+
+def parseWriteConcern(w, journal=False):
+    """Build a write concern from command line values; w=0 is the
+    unacknowledged fast load mode"""
+    concern = {}
+    if w is not None:
+        concern['w'] = int(w) if str(w).isdigit() else w
+    if journal:
+        concern['j'] = True
+    return concern
+
+class BulkWriter(object):
+    """Buffers documents for one collection and writes them as unordered
+    bulk inserts once a batch reaches batchBytes. A batch holding any
+    document added with upsert set is written as upserts instead.
+
+    With inFlight > 0, batches are written by that many background threads
+    and add() only blocks once they are all busy. A marker can be attached
+    to each document; onWritten is called with the marker of the last
+    document of every batch once it and all batches before it are
+    written, which is what a checkpoint needs."""
+    def __init__(self, collection, batchBytes=DEFAULT_BATCH_BYTES,
+                 writeConcern=None, inFlight=2, onWritten=None):
+        self.collection = collection
+        self.batchBytes = batchBytes
+        self.writeConcern = writeConcern or {}
+        self.inFlight = inFlight
+        self.onWritten = onWritten
+
+        self.batch = []
+        self.batchSize = 0
+        self.batchUpsert = False
+        self.marker = None
+
+        self.stat_batches = 0
+        self.stat_docs = 0
+        self.stat_bytes = 0
+
+        self.error = None
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.finished = {}
+        self.nextFinished = 0
+        self.threads = []
+        if inFlight > 0:
+            self.queue = Queue.Queue(maxsize=inFlight)
+            for i in range(inFlight):
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def add(self, doc, marker=None, upsert=False):
+        """Buffer a document. upsert is for documents that may already be
+        stored, such as those written again when resuming an import."""
+        self.batch.append(doc)
+        self.batchSize = self.batchSize + bsonSize(doc)
+        self.batchUpsert = self.batchUpsert or upsert
+        self.marker = marker
+        if self.batchSize >= self.batchBytes:
+            self.flush()
+
+    def flush(self, upsert=False):
+        """Send the current batch off to be written, as upserts if upsert
+        is set or any of its documents asked for it"""
+        self.raiseError()
+        if not self.batch:
+            return
+        task = (self.sent, self.batch, self.batchSize, self.marker,
+                upsert or self.batchUpsert)
+        self.sent = self.sent + 1
+        self.batch = []
+        self.batchSize = 0
+        self.batchUpsert = False
+        self.marker = None
+
+        if self.inFlight > 0:
+            self.queue.put(task)
+        else:
+            self.write(*task)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is not None and self.error is None:
+                    self.write(*task)
+            except Exception, e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if task is None:
+                break
+
+    def write(self, seq, docs, size, marker, upsert):
+        bulk = self.collection.initialize_unordered_bulk_op()
+        if upsert:
+            for doc in docs:
+                bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+        else:
+            for doc in docs:
+                bulk.insert(doc)
+        bulk.execute(self.writeConcern)
+
+        with self.lock:
+            self.stat_batches = self.stat_batches + 1
+            self.stat_docs = self.stat_docs + len(docs)
+            self.stat_bytes = self.stat_bytes + size
+
+            # Batches can finish out of order; only report a marker once
+            # everything before it is written too
+            self.finished[seq] = marker
+            lastMarker = None
+            while self.nextFinished in self.finished:
+                marker = self.finished.pop(self.nextFinished)
+                if marker is not None:
+                    lastMarker = marker
+                self.nextFinished = self.nextFinished + 1
+            if lastMarker is not None and self.onWritten is not None:
+                self.onWritten(lastMarker)
+
+    def raiseError(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def wait(self):
+        """Flush and block until every batch has been written"""
+        self.flush()
+        if self.inFlight > 0:
+            self.queue.join()
+        self.raiseError()
+
+    def close(self):
+        self.wait()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,92 @@
+"""Import progress kept in the osm.checkpoints collection so that an
+interrupted import can pick up where it left off."""
+
+import time
+import threading
+
+# Elements appear in this order in OSM files
+TYPE_ORDER = {'node': 0, 'way': 1, 'relation': 2}
+
+# Phases an import goes through after the elements are loaded
+PHASES = ['elements', 'backrefs', 'indexes', 'done']
+
+class ImportCheckpoint(object):
+    """Records, at batch boundaries, the last element id flushed to the
+    database and an input offset from which every later element can be
+    read again.
+
+    Bulk writer threads save checkpoints while the main thread reads and
+    moves them on, so writes are serialised by a lock."""
+    def __init__(self, client, filename):
+        self.client = client
+        self.filename = filename
+        self.collection = client.osm.checkpoints
+        self.state = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read the last checkpoint, returning False if there isn't one"""
+        self.state = self.collection.find_one({'_id': 'import'})
+        if self.state is None:
+            return False
+        if self.state.get('file') != self.filename:
+            print "Warning: checkpoint was written for %s, not %s." % (
+                self.state.get('file'), self.filename)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.collection.remove({'_id': 'import'})
+            self.state = None
+
+    def write(self, fields):
+        fields['file'] = self.filename
+        fields['updated'] = time.time()
+        with self.lock:
+            self.collection.update({'_id': 'import'}, {'$set': fields}, upsert=True)
+            if self.state is None:
+                self.state = {}
+            self.state.update(fields)
+
+    def save(self, name, lastId, offset):
+        """Remember that every element up to (name, lastId) is stored and
+        that reading again from offset will get everything after it"""
+        self.write({'phase': 'elements',
+                    'type': name,
+                    'lastId': lastId,
+                    'offset': offset})
+
+    def setPhase(self, phase):
+        self.write({'phase': phase})
+
+    def phase(self):
+        if self.state is None:
+            return 'elements'
+        return self.state.get('phase', 'elements')
+
+    def phaseDone(self, phase):
+        """True if the loaded checkpoint is already past the given phase"""
+        return PHASES.index(self.phase()) > PHASES.index(phase)
+
+    def offset(self):
+        if self.state is None:
+            return 0
+        return self.state.get('offset', 0)
+
+    def elementType(self):
+        if self.state is None:
+            return None
+        return self.state.get('type')
+
+    def isDone(self, name, id):
+        """True if the element was flushed before the checkpoint"""
+        with self.lock:
+            state = self.state
+            if state is None or 'type' not in state:
+                return False
+            if state.get('phase', 'elements') != 'elements':
+                return True
+            done = TYPE_ORDER[state['type']]
+            if TYPE_ORDER[name] != done:
+                return TYPE_ORDER[name] < done
+            return id <= state['lastId']
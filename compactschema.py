@@ -0,0 +1,169 @@
+"""Optional compact document schema.
+
+- Coordinates are stored as int32 fixed-point values at 1e-7 degrees
+  instead of float64s.
+- Way node refs are stored as a binary blob of zigzag delta varints.
+- Tags are stored as a binary blob of length-prefixed UTF-8 strings
+  (key, value, key, value...). The plain list of keys stays in 'ky' so
+  that it can still be indexed and queried.
+
+compactRecord() and expandRecord() convert documents of either importer's
+schema; expandRecord() leaves documents that aren't compact alone, so the
+servers can call it on everything they read."""
+
+from bson.binary import Binary
+
+from nodestore import toFixed, fromFixed, COORD_SCALE
+
+# Bounds for a 2d index over fixed-point coordinates (the upper bound is
+# exclusive)
+COORD_MIN = -180 * COORD_SCALE
+COORD_MAX = 180 * COORD_SCALE + 1
+
+def encodeVarint(value, out):
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value = value >> 7
+    out.append(chr(value))
+
+def decodeVarints(data):
+    values = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = ord(data[pos])
+            pos = pos + 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift = shift + 7
+        values.append(result)
+    return values
+
+def packRefs(refs):
+    out = []
+    previous = 0
+    for ref in refs:
+        delta = ref - previous
+        encodeVarint((delta << 1) ^ (delta >> 63), out)
+        previous = ref
+    return Binary(''.join(out))
+
+def unpackRefs(data):
+    refs = []
+    total = 0L
+    for value in decodeVarints(data):
+        total = total + ((value >> 1) ^ -(value & 1))
+        refs.append(total)
+    return refs
+
+def packTags(tags):
+    out = []
+    for (k, v) in tags:
+        for s in (k, v):
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+            encodeVarint(len(s), out)
+            out.append(s)
+    return Binary(''.join(out))
+
+def unpackTags(data):
+    strings = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        length = 0
+        shift = 0
+        while True:
+            b = ord(data[pos])
+            pos = pos + 1
+            length |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift = shift + 7
+        strings.append(data[pos:pos + length].decode('utf-8'))
+        pos = pos + length
+    return zip(strings[0::2], strings[1::2])
+
+def packCoord(value):
+    if isinstance(value, float):
+        return toFixed(value)
+    return value
+
+def unpackCoord(value):
+    if isinstance(value, (int, long)):
+        return fromFixed(value)
+    return value
+
+def packLoc(loc):
+    """Compact a [lat, lon] pair, a {'lat', 'lon'} dict or a list of
+    pairs. Anything else (like a list of quadkeys) is left alone."""
+    if isinstance(loc, dict):
+        return dict((k, packCoord(v)) for (k, v) in loc.iteritems())
+    elif isinstance(loc, list) and loc:
+        if isinstance(loc[0], list):
+            return [[packCoord(c) for c in pair] for pair in loc]
+        elif isinstance(loc[0], (int, long, float)):
+            return [packCoord(c) for c in loc]
+    return loc
+
+def unpackLoc(loc):
+    if isinstance(loc, dict):
+        return dict((k, unpackCoord(v)) for (k, v) in loc.iteritems())
+    elif isinstance(loc, list) and loc:
+        if isinstance(loc[0], list):
+            return [[unpackCoord(c) for c in pair] for pair in loc]
+        elif isinstance(loc[0], (int, long)):
+            return [unpackCoord(c) for c in loc]
+    return loc
+
+# Node ref fields of the two importers' way documents
+REF_FIELDS = ('nd', 'n')
+
+def compactRecord(record):
+    """Convert a node, way or relation document to the compact schema"""
+    if 'loc' in record:
+        record['loc'] = packLoc(record['loc'])
+    for field in REF_FIELDS:
+        if field in record and isinstance(record[field], list):
+            record[field] = packRefs(record[field])
+    if 'tg' in record and isinstance(record['tg'], list):
+        record['tg'] = packTags(record['tg'])
+    return record
+
+def expandRecord(record):
+    """Convert a compact document back to the plain schema"""
+    if 'loc' in record:
+        record['loc'] = unpackLoc(record['loc'])
+    for field in REF_FIELDS:
+        if field in record and isinstance(record[field], basestring):
+            record[field] = unpackRefs(record[field])
+    if 'tg' in record and isinstance(record['tg'], basestring):
+        record['tg'] = unpackTags(record['tg'])
+    return record
+
+def isCompact(client):
+    """True if the database was imported with the compact schema"""
+    schema = client.osm.schema.find_one({'_id': 'schema'})
+    return bool(schema and schema.get('compact'))
+
+def setCompact(client, compact):
+    client.osm.schema.update({'_id': 'schema'},
+                             {'$set': {'compact': compact}}, upsert=True)
+
+def scaleQuery(query):
+    """Scale the coordinates of a $within query on loc to fixed-point"""
+    if 'loc' not in query or not isinstance(query['loc'], dict):
+        return query
+    query = dict(query)
+    within = {}
+    for (shape, points) in query['loc'].get('$within', {}).iteritems():
+        if shape == '$center':
+            within[shape] = [[toFixed(c) for c in points[0]], toFixed(points[1])]
+        else:
+            within[shape] = [[toFixed(c) for c in point] for point in points]
+    query['loc'] = {'$within': within}
+    return query
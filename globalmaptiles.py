@@ -65,6 +65,40 @@ Class is available under the open-source GDAL license (www.gdal.org).
 
 import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Zoom level of integer quadkeys: two bits per level fits 31 levels in a
+# positive int64
+MORTON_ZOOM = 31
+
+# Latitude at which the square Spherical Mercator map ends; nearer the
+# poles y runs off to infinity
+MAX_LATITUDE = math.degrees(math.atan(math.sinh(math.pi)))
+
+def spreadBits(v):
+    "Spreads the low 32 bits of v out to the even bits of a 64 bit integer"
+
+    v = v & 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+def spreadBitsArray(v):
+    "Vectorized spreadBits for a numpy array"
+
+    v = numpy.asarray(v).astype(numpy.uint64) & numpy.uint64(0xFFFFFFFF)
+    for (shift, mask) in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                          (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                          (1, 0x5555555555555555)):
+        v = (v | (v << numpy.uint64(shift))) & numpy.uint64(mask)
+    return v
+
 class GlobalMercator(object):
     """
     TMS Global Mercator Profile
@@ -275,6 +309,107 @@ class GlobalMercator(object):
             
         return quadKey
 
+    def MortonKey(self, tx, ty, zoom ):
+        "Converts TMS tile coordinates to an integer quadkey with the same digits as QuadTree"
+
+        ty = (2**zoom - 1) - ty
+        return spreadBits(tx) | (spreadBits(ty) << 1)
+
+    def MortonRange(self, tx, ty, zoom, keyZoom=MORTON_ZOOM ):
+        "Returns the range [min, max) of integer quadkeys at keyZoom inside the given TMS tile"
+
+        shift = 2 * (keyZoom - zoom)
+        key = self.MortonKey(tx, ty, zoom)
+        return key << shift, (key + 1) << shift
+
+    def MortonToQuadTree(self, key, zoom ):
+        "Converts an integer quadkey at the given zoom back to a Microsoft QuadTree string"
+
+        return ''.join(str((key >> (2 * i)) & 3) for i in range(zoom - 1, -1, -1))
+
+    def MortonCovering(self, keys, zoom, maxCells=None ):
+        "Returns a small list of (key, zoom) tiles covering a set of integer quadkeys at zoom"
+
+        # Four siblings make their parent, which covers exactly the same
+        # area. Past maxCells whole levels are replaced by their parents,
+        # which covers more than the original tiles.
+        levels = {zoom: set(keys)}
+        count = len(levels[zoom])
+        for z in range(zoom, 0, -1):
+            cells = levels.get(z, set())
+            children = {}
+            for key in cells:
+                children[key >> 2] = children.get(key >> 2, 0) + 1
+            coarsen = maxCells is not None and count > maxCells
+            parents = set(p for (p, n) in children.iteritems() if n == 4 or coarsen)
+            if parents:
+                levels[z] = set(key for key in cells if (key >> 2) not in parents)
+                levels[z - 1] = levels.get(z - 1, set()) | parents
+                count = sum(len(level) for level in levels.itervalues())
+
+        covering = []
+        for (z, cells) in sorted(levels.iteritems()):
+            for key in sorted(cells):
+                # Coarsening can make a tile that contains deeper ones
+                if not any((key >> (2 * (z - up))) in levels.get(up, ()) for up in range(z)):
+                    covering.append((key, z))
+        return covering
+
+    # Batch versions of the conversions above. They take and return numpy
+    # arrays, and fall back to lists and the scalar methods without numpy.
+
+    def LatLonToMetersArray(self, lat, lon ):
+        "Converts arrays of lat/lon in WGS84 Datum to arrays of XY in Spherical Mercator EPSG:900913, clamped to the map"
+
+        if numpy is None:
+            meters = [self.LatLonToMeters(min(max(y, -MAX_LATITUDE), MAX_LATITUDE), x)
+                      for (y, x) in zip(lat, lon)]
+            return [m[0] for m in meters], [m[1] for m in meters]
+        lat = numpy.clip(numpy.asarray(lat, dtype=numpy.float64), -MAX_LATITUDE, MAX_LATITUDE)
+        lon = numpy.asarray(lon, dtype=numpy.float64)
+        mx = lon * self.originShift / 180.0
+        my = numpy.log( numpy.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+
+        my = my * self.originShift / 180.0
+        return mx, my
+
+    def MetersToTileArray(self, mx, my, zoom ):
+        "Returns arrays of the tiles for arrays of mercator coordinates, clamped to the map"
+
+        last = 2**zoom - 1
+        if numpy is None:
+            tiles = [self.MetersToTile(x, y, zoom) for (x, y) in zip(mx, my)]
+            return ([min(max(tx, 0), last) for (tx, ty) in tiles],
+                    [min(max(ty, 0), last) for (tx, ty) in tiles])
+        res = self.Resolution( zoom )
+        px = (numpy.asarray(mx) + self.originShift) / res
+        py = (numpy.asarray(my) + self.originShift) / res
+        tx = numpy.ceil( px / float(self.tileSize) ) - 1
+        ty = numpy.ceil( py / float(self.tileSize) ) - 1
+        return (numpy.clip(tx, 0, last).astype(numpy.int64),
+                numpy.clip(ty, 0, last).astype(numpy.int64))
+
+    def MortonKeyArray(self, tx, ty, zoom ):
+        "Converts arrays of TMS tile coordinates to an array of integer quadkeys"
+
+        if numpy is None:
+            return [self.MortonKey(x, y, zoom) for (x, y) in zip(tx, ty)]
+        ty = (2**zoom - 1) - numpy.asarray(ty, dtype=numpy.int64)
+        keys = spreadBitsArray(tx) | (spreadBitsArray(ty) << numpy.uint64(1))
+        return keys.astype(numpy.int64)
+
+    def QuadTreeArray(self, tx, ty, zoom ):
+        "Converts arrays of TMS tile coordinates to a list of Microsoft QuadTree strings"
+
+        return [self.MortonToQuadTree(int(key), zoom) for key in self.MortonKeyArray(tx, ty, zoom)]
+
+    def LatLonToMortonArray(self, lat, lon, zoom=MORTON_ZOOM ):
+        "Converts arrays of lat/lon to an array of integer quadkeys of the tiles at zoom holding them"
+
+        (mx, my) = self.LatLonToMetersArray(lat, lon)
+        (tx, ty) = self.MetersToTileArray(mx, my, zoom)
+        return self.MortonKeyArray(tx, ty, zoom)
+
 #---------------------
 
 class GlobalGeodetic(object):
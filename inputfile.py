@@ -0,0 +1,242 @@
+"""Opens OSM input files, decompressing .gz and .bz2 files on the fly.
+
+Decompression runs in a background thread (and, for multi-stream bz2
+files like the planet dumps, in a pool of processes) and hands large
+buffers to the reader through a bounded queue, so that decompression,
+parsing and inserting all overlap."""
+
+import bz2
+import zlib
+import Queue
+import threading
+import multiprocessing
+from collections import deque
+
+BUFFER_SIZE = 4 * 1024 * 1024
+QUEUE_BUFFERS = 16
+
+# Every bz2 stream starts with "BZh", the block size, and the block magic
+BZ2_STREAM_START = ['BZh%d1AY&SY' % (level,) for level in range(1, 10)]
+
+def decompressBz2Stream(data):
+    """Decompress one bz2 stream, returning (data, True) or (data, False)
+    if data turned out not to be a whole stream"""
+    decompressor = bz2.BZ2Decompressor()
+    try:
+        output = decompressor.decompress(data)
+    except (IOError, EOFError):
+        return ('', False)
+    return (output, decompressor.unused_data == '' and isStreamEnd(decompressor))
+
+def isStreamEnd(decompressor):
+    # Python 2's BZ2Decompressor only reports the end of the stream by
+    # refusing more data.
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+class ReaderClosed(Exception):
+    pass
+
+class DecompressingReader(object):
+    """Read-only file object that returns the decompressed contents of a
+    file, with decompression done ahead of time in the background"""
+    def __init__(self, file_obj, kind, decoders=1):
+        self.file_obj = file_obj
+        self.kind = kind
+        self.decoders = decoders
+        self.buffers = Queue.Queue(maxsize=QUEUE_BUFFERS)
+        self.current = ''
+        self.currentPos = 0
+        self.position = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self):
+        try:
+            if self.kind == 'gz':
+                self.produceGzip()
+            elif self.decoders > 1:
+                self.produceParallelBz2()
+            else:
+                self.produceBz2()
+        except ReaderClosed:
+            return
+        except Exception, e:
+            self.error = e
+        self.put(None)
+
+    def put(self, data):
+        """Queue a buffer for the reader, waiting while the queue is full
+        unless the reader has been closed"""
+        while not self.closed:
+            try:
+                self.buffers.put(data, True, 1)
+                return
+            except Queue.Full:
+                pass
+        raise ReaderClosed()
+
+    def produceGzip(self):
+        # Concatenated gzip members are valid gzip files too
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            data = self.file_obj.read(BUFFER_SIZE)
+            if not data:
+                break
+            while data:
+                self.put(decompressor.decompress(data))
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.put(decompressor.flush())
+
+    def produceBz2(self):
+        decompressor = bz2.BZ2Decompressor()
+        while True:
+            data = self.file_obj.read(BUFFER_SIZE)
+            if not data:
+                break
+            while data:
+                try:
+                    self.put(decompressor.decompress(data))
+                    data = ''
+                except EOFError:
+                    # The last stream ended exactly at the end of a read
+                    decompressor = bz2.BZ2Decompressor()
+                else:
+                    if decompressor.unused_data:
+                        data = decompressor.unused_data
+                        decompressor = bz2.BZ2Decompressor()
+
+    def iterBz2Streams(self):
+        """Split the compressed file on bz2 stream headers"""
+        pending = ''
+        while True:
+            data = self.file_obj.read(BUFFER_SIZE)
+            pending = pending + data
+            start = 1
+            while True:
+                found = [pending.find(magic, start) for magic in BZ2_STREAM_START]
+                found = [i for i in found if i >= 0]
+                if not found:
+                    break
+                split = min(found)
+                yield pending[:split]
+                pending = pending[split:]
+                start = 1
+            if not data:
+                break
+        if pending:
+            yield pending
+
+    def produceParallelBz2(self):
+        pool = multiprocessing.Pool(self.decoders)
+        results = deque()
+        leftover = ''
+
+        def finish(stream, result):
+            (output, complete) = result.get()
+            if complete:
+                self.put(output)
+                return ''
+            # Not a real stream boundary: glue it onto the next piece
+            return stream
+
+        try:
+            for stream in self.iterBz2Streams():
+                if leftover:
+                    stream = leftover + stream
+                    leftover = ''
+                results.append((stream, pool.apply_async(decompressBz2Stream, (stream,))))
+                if len(results) >= self.decoders * 2:
+                    leftover = self.finishInOrder(results, finish)
+            while results:
+                leftover = self.finishInOrder(results, finish)
+            if leftover:
+                self.put(bz2.decompress(leftover))
+        finally:
+            pool.terminate()
+
+    def finishInOrder(self, results, finish):
+        """Emit the oldest stream. A false split is decompressed together
+        with the piece after it, in this thread."""
+        (stream, result) = results.popleft()
+        leftover = finish(stream, result)
+        while leftover and results:
+            (stream, result) = results.popleft()
+            (output, complete) = decompressBz2Stream(leftover + stream)
+            if complete:
+                self.put(output)
+                leftover = ''
+            else:
+                leftover = leftover + stream
+        return leftover
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self.currentPos >= len(self.current):
+                if self.done:
+                    break
+                data = self.buffers.get()
+                if data is None:
+                    self.done = True
+                    if self.error is not None:
+                        raise IOError("Decompression failed: %s" % (self.error,))
+                    break
+                self.current = data
+                self.currentPos = 0
+                continue
+            if size < 0:
+                end = len(self.current)
+            else:
+                end = min(self.currentPos + wanted, len(self.current))
+                wanted = wanted - (end - self.currentPos)
+            chunks.append(self.current[self.currentPos:end])
+            self.currentPos = end
+        data = ''.join(chunks)
+        self.position = self.position + len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.file_obj.close()
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        """Only moving forward is supported, by decompressing and
+        throwing the data away"""
+        if offset < self.position:
+            raise IOError("Can't seek backwards in a compressed file")
+        while self.position < offset:
+            if not self.read(min(offset - self.position, BUFFER_SIZE)):
+                break
+
+def baseName(filename):
+    """The file name without any compression suffix"""
+    for suffix in ('.gz', '.bz2'):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+def openInput(filename, decoders=None):
+    """Open an OSM file for reading, decompressing it if it ends in .gz
+    or .bz2"""
+    if decoders is None:
+        decoders = multiprocessing.cpu_count()
+    if filename.endswith('.gz'):
+        return DecompressingReader(open(filename, 'rb'), 'gz')
+    elif filename.endswith('.bz2'):
+        return DecompressingReader(open(filename, 'rb'), 'bz2', decoders)
+    return open(filename, 'rb')
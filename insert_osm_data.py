@@ -1,37 +1,125 @@
-"""This program parses an OSM XML file and inserts the data in a
+"""This program parses an OSM XML or PBF file and inserts the data in a
 MongoDB database"""
 
 import sys
 import os
+import re
 import time
+import Queue
 import pymongo
+import threading
+import multiprocessing
 from datetime import datetime
 #from xml.sax import make_parser
 #from xml.sax.handler import ContentHandler
 from pymongo import MongoClient
+from optparse import OptionParser
 from xml.etree.cElementTree import iterparse
 
+from nodestore import openNodeStore, SparseNodeStore
+from checkpoint import ImportCheckpoint
+from backrefs import RelationBackrefs
+from osmpbf import OsmPbfReader
+from inputfile import openInput, baseName
+from bulkwriter import BulkWriter, DEFAULT_BATCH_BYTES, parseWriteConcern
+from compactschema import compactRecord, unpackLoc, isCompact, setCompact, \
+     COORD_MIN, COORD_MAX
+
+# Secondary indexes, as (collection, keys)
+INDEXES = [('nodes', [('loc', pymongo.GEO2D)]),
+           ('nodes', [('id', pymongo.ASCENDING),
+                      ('version', pymongo.DESCENDING)]),
+           ('ways', [('loc', pymongo.GEO2D)]),
+           ('ways', [('id', pymongo.ASCENDING),
+                     ('version', pymongo.DESCENDING)]),
+           ('relations', [('id', pymongo.ASCENDING),
+                          ('version', pymongo.DESCENDING)])]
+
+COLLECTIONS = {'node': 'nodes', 'way': 'ways', 'relation': 'relations'}
+
 class OsmHandler(object):
     """Base class for parsing OSM XML data"""
-    def __init__(self, client):
+    def __init__(self, client, nodeStore=None, indexes=True,
+                 batchBytes=DEFAULT_BATCH_BYTES, writeConcern=None, inFlight=2,
+                 compact=False):
         self.client = client
+        self.nodeStore = nodeStore
+        self.compact = compact
+        self.backrefs = RelationBackrefs(client)
+        self.batchBytes = batchBytes
+        self.writeConcern = writeConcern
+        self.inFlight = inFlight
+        self.writers = {}
+        self.checkpoint = None
+        self.resuming = False
+        # Highest _id stored by the interrupted import, by element type
+        self.storedMax = {}
 
-        self.client.osm.nodes.ensure_index([('loc', pymongo.GEO2D)])
-        self.client.osm.nodes.ensure_index([('id', pymongo.ASCENDING),
-                                            ('version', pymongo.DESCENDING)])
-
-        self.client.osm.ways.ensure_index([('loc', pymongo.GEO2D)])
-        self.client.osm.ways.ensure_index([('id', pymongo.ASCENDING),
-                                           ('version', pymongo.DESCENDING)])
-
-        self.client.osm.relations.ensure_index([('id', pymongo.ASCENDING),
-                                                ('version', pymongo.DESCENDING)])
+        if indexes:
+            self.ensureIndexes()
         self.stat_nodes = 0
         self.stat_ways = 0
         self.stat_relations = 0
+        self.stat_seconds = {}
+        self.currentPhase = None
+        self.phaseStart = None
         self.lastStatString = ""
         self.statsCount = 0
 
+    def markPhase(self, phase):
+        """Start timing a phase (an element type, 'backrefs' or 'indexes'),
+        finishing the writes of the one before it first"""
+        if self.currentPhase in COLLECTIONS:
+            self.finishWriting(self.currentPhase)
+        now = time.time()
+        if self.currentPhase is not None:
+            self.stat_seconds[self.currentPhase] = (self.stat_seconds.get(self.currentPhase, 0) +
+                                                    now - self.phaseStart)
+        self.currentPhase = phase
+        self.phaseStart = now
+
+    def indexOptions(self, keys):
+        """Compact coordinates need wider bounds on the 2d indexes"""
+        if self.compact and (('loc', pymongo.GEO2D) in keys):
+            return {'min': COORD_MIN, 'max': COORD_MAX}
+        return {}
+
+    def ensureIndexes(self):
+        for (collection, keys) in INDEXES:
+            self.client.osm[collection].ensure_index(keys, **self.indexOptions(keys))
+
+    def dropIndexes(self):
+        """Drop every index but _id so a bulk load doesn't maintain them"""
+        for collection in ('nodes', 'ways', 'relations'):
+            self.client.osm[collection].drop_indexes()
+
+    def buildIndexes(self):
+        """Build the secondary indexes after a load, reporting progress. A
+        failed build is raised here, so the checkpoint stays before the
+        index phase."""
+        for (collection, keys) in INDEXES:
+            name = "%s %s" % (collection, ', '.join(k for (k, d) in keys))
+            start = time.time()
+            errors = []
+            def build(collection=collection, keys=keys):
+                try:
+                    self.client.osm[collection].create_index(keys, **self.indexOptions(keys))
+                except Exception:
+                    errors.append(sys.exc_info())
+            builder = threading.Thread(target=build)
+            builder.start()
+            while builder.is_alive():
+                builder.join(5)
+                for op in self.client.osm.current_op().get('inprog', []):
+                    if op.get('ns') == 'osm.%s' % (collection,) and 'msg' in op:
+                        sys.stdout.write("\rIndexing %s: %s" % (name, op['msg']))
+                        sys.stdout.flush()
+            if errors:
+                sys.stdout.write("\rFailed to index %s after %.1fs\n" % (name, time.time() - start))
+                (errorType, error, traceback) = errors[0]
+                raise errorType, error, traceback
+            sys.stdout.write("\rIndexed %s in %.1fs\n" % (name, time.time() - start))
+
     def writeStatsToScreen(self):
         for char in self.lastStatString:
             sys.stdout.write('\b')
@@ -67,139 +155,624 @@ class OsmHandler(object):
         t = datetime.strptime(isotime, "%Y-%m-%dT%H:%M:%SZ")
         return time.mktime(t.timetuple())
 
+    def wayLocations(self, nodeIds):
+        """Look up the locations of a way's nodes, in way order"""
+        locs = []
+        if self.nodeStore is not None:
+            for node in nodeIds:
+                loc = self.nodeStore.get(node)
+                if loc is not None:
+                    locs.append(loc)
+                else:
+                    print 'node not found: '+ str(node)
+            return locs
+
+        nds = dict((rec['_id'], rec) for rec in self.client.osm.nodes.find({ '_id': { '$in': nodeIds } }, { 'loc': 1, '_id': 1 }))
+        for node in nodeIds:
+            if node in nds:
+                locs.append(nds[node]['loc'])
+            else:
+                print 'node not found: '+ str(node)
+        return locs
+
+    def buildRecord(self, element):
+        """Turn an element from OsmXmlReader or OsmPbfReader into a document"""
+        (name, attrs, tags, children) = element
+        record = self.fillDefault(attrs)
+        for (k, v) in tags:
+            # MongoDB doesn't let us have dots in the key names.
+            #k = k.replace('.', ',,')
+            record['tg'].append((k, v))
+            record['ky'].append(k)
+        if len(record['tg']) == 0:
+            del record['tg']
+        if len(record['ky']) == 0:
+            del record['ky']
+
+        if name == 'node':
+            record['loc'] = children
+        elif name == 'way':
+            record['nd'] = children
+        elif name == 'relation':
+            record['mm'] = children
+        return record
+
     def parse(self, file_obj):
-        nodes = []
-        ways = []
-        
-        context = iter(iterparse(file_obj, events=('start', 'end')))
-        event, root = context.next()
-        
-        for (event, elem) in context:
-            name = elem.tag
-            attrs = elem.attrib
-            
-            if 'start' == event:
-                """Parse the XML element at the start"""
-                if name == 'node':
-                    record = self.fillDefault(attrs)
-                    loc = [float(attrs['lat']),
-                           float(attrs['lon'])]
-                    record['loc'] = loc
-                elif name == 'tag':
-                    k = attrs['k']
-                    v = attrs['v']
-                    # MongoDB doesn't let us have dots in the key names.
-                    #k = k.replace('.', ',,')
-                    record['tg'].append((k, v))
-                    record['ky'].append(k)
-                elif name == 'way':
-                    # Insert remaining nodes
-                    if len(nodes) > 0:
-                        self.client.osm.nodes.insert(nodes)
-                        nodes = []
+        self.load(OsmXmlReader(file_obj))
+
+    def writer(self, name):
+        """The bulk writer for an element type, created on first use"""
+        if name not in self.writers:
+            onWritten = None
+            if self.checkpoint is not None:
+                onWritten = lambda marker: self.checkpoint.save(*marker)
+            self.writers[name] = BulkWriter(self.client.osm[COLLECTIONS[name]],
+                                            self.batchBytes, self.writeConcern,
+                                            self.inFlight, onWritten)
+        return self.writers[name]
+
+    def finishWriting(self, name):
+        """Wait until every document of an element type is written"""
+        if name in self.writers:
+            self.writers.pop(name).close()
+
+    def store(self, name, record, marker=None, upsert=False):
+        """Queue a finished document to be written. It is upserted if
+        upsert is set or an interrupted import may have stored it."""
+        if self.compact:
+            compactRecord(record)
+        self.writer(name).add(record, marker, upsert or self.mayBeStored(name, record['_id']))
+
+    def insertRecords(self, name, records, upsert=False):
+        """Write a batch of documents and wait for them. Upserting makes
+        writing a batch that may already be partly stored idempotent."""
+        for record in records:
+            self.store(name, record, upsert=upsert)
+        self.writer(name).wait()
+
+    def resume(self, checkpoint):
+        """Get ready to continue an import from a checkpoint.
+
+        Batches after the checkpoint's can have been written before the
+        import stopped, and nothing bounds how many, so elements up to
+        the highest _id already stored for their type are upserted."""
+        for (name, collection) in COLLECTIONS.iteritems():
+            row = self.client.osm[collection].find_one({}, ['_id'], sort=[('_id', pymongo.DESCENDING)])
+            if row is not None:
+                self.storedMax[name] = row['_id']
+
+        # Only ways still to be loaded need node locations
+        pastWays = checkpoint.elementType() == 'relation' or checkpoint.phaseDone('elements')
+        if isinstance(self.nodeStore, SparseNodeStore) and checkpoint.elementType() is not None \
+                and not pastWays:
+            for row in self.client.osm.nodes.find({}, {'loc': 1}):
+                loc = unpackLoc(row['loc'])
+                self.nodeStore.set(row['_id'], loc[0], loc[1])
+
+        # The relations' back-references, unless they are already applied
+        if pastWays and not checkpoint.phaseDone('backrefs'):
+            for row in self.client.osm.relations.find({}, {'mm': 1}):
+                for member in row.get('mm', []):
+                    self.backrefs.add(member['type'], member['ref'], row['_id'])
+
+    def mayBeStored(self, name, id):
+        """True if a resumed import may already have stored an element"""
+        return name in self.storedMax and id <= self.storedMax[name]
+
+    def skipped(self, element):
+        """True while resuming and still before the checkpoint"""
+        if self.checkpoint is None or not self.resuming:
+            return False
+        if self.checkpoint.isDone(element[0], long(element[1]['id'])):
+            return True
+        self.resuming = False
+        return False
+
+    def load(self, elements):
+        marker = None
+
+        if self.checkpoint is None or not self.checkpoint.phaseDone('elements'):
+            for element in elements:
+                name = element[0]
+                if self.skipped(element):
+                    continue
+                if name != self.currentPhase:
+                    self.markPhase(name)
+
+                record = self.buildRecord(element)
+                if self.checkpoint is not None:
+                    marker = (name, record['_id'], elements.offset)
 
-                    record = self.fillDefault(attrs)
-                    record['nd'] = []
-                elif name == 'relation':
-                    # Insert remaining ways
-                    if len(ways) > 0:
-                        self.client.osm.ways.insert(ways)
-                        ways = []
-
-                    record = self.fillDefault(attrs)
-                    record['mm'] = []
-                elif name == 'nd':
-                    ref = long(attrs['ref'])
-                    record['nd'].append(ref)
-                elif name == 'member':
-                    record['mm'].append(dict(type=attrs['type'],
-                                                  ref=long(attrs['ref']),
-                                                  role=attrs['role']))
-                    
-                    if attrs['type'] == 'way':
-                        ways2relations = self.client.osm.ways.find_one({ '_id' : ref})
-                        if ways2relations:
-                            if 'relations' not in ways2relations:
-                                ways2relations['relations'] = []
-                            ways2relations['relations'].append(record['_id'])
-                            self.client.osm.ways.save(ways2relations)
-                    elif attrs['type'] == 'node':
-                        nodes2relations = self.client.osm.nodes.find_one({ '_id' : ref})
-                        if nodes2relations:
-                            if 'relations' not in nodes2relations:
-                                nodes2relations['relations'] = []
-                            nodes2relations['relations'].append(record['_id'])
-                            self.client.osm.nodes.save(nodes2relations)
-            elif 'end' == event:
-                """Finish parsing an element
-                (only really used with nodes, ways and relations)"""
                 if name == 'node':
-                    if len(record['tg']) == 0:
-                        del record['tg']
-                    if len(record['ky']) == 0:
-                        del record['ky']
-                    nodes.append(record)
-                    if len(nodes) > 2500:
-                        self.client.osm.nodes.insert(nodes)
-                        nodes = []
-                        self.writeStatsToScreen()
+                    if self.nodeStore is not None:
+                        self.nodeStore.set(record['_id'], record['loc'][0], record['loc'][1])
+                    self.store(name, record, marker)
 
-                    record = {}
+                    self.statsCount = self.statsCount + 1
+                    if self.statsCount > 2500:
+                        self.writeStatsToScreen()
+                        self.statsCount = 0
                     self.stat_nodes = self.stat_nodes + 1
                 elif name == 'way':
-                    if len(record['tg']) == 0:
-                        del record['tg']
-                    if len(record['ky']) == 0:
-                        del record['ky']
-                    nds = dict((rec['_id'], rec) for rec in self.client.osm.nodes.find({ '_id': { '$in': record['nd'] } }, { 'loc': 1, '_id': 1 }))
-                    record['loc'] = []
-                    for node in record['nd']:
-                        if node in nds:
-                            record['loc'].append(nds[node]['loc'])
-                        else:
-                            print 'node not found: '+ str(node)
-
-                    ways.append(record)
-                    if len(ways) > 2000:
-                        self.client.osm.ways.insert(ways)
-                        ways = []
-
-                    record = {}
+                    # Ways may look their nodes up in the database
+                    self.finishWriting('node')
+
+                    record['loc'] = self.wayLocations(record['nd'])
+                    self.store(name, record, marker)
+
                     self.statsCount = self.statsCount + 1
                     if self.statsCount > 1000:
                         self.writeStatsToScreen()
                         self.statsCount = 0
                     self.stat_ways = self.stat_ways + 1
                 elif name == 'relation':
-                    if len(record['tg']) == 0:
-                        del record['tg']
-                    if len(record['ky']) == 0:
-                        del record['ky']
-                    self.client.osm.relations.save(record)
-                    record = {}
+                    self.finishWriting('node')
+                    self.finishWriting('way')
+
+                    for member in record['mm']:
+                        self.backrefs.add(member['type'], member['ref'], record['_id'])
+                    self.store(name, record, marker)
+
                     self.statsCount = self.statsCount + 1
                     if self.statsCount > 10:
                         self.writeStatsToScreen()
                         self.statsCount = 0
                     self.stat_relations = self.stat_relations + 1
+
+            for name in ('node', 'way', 'relation'):
+                self.finishWriting(name)
+
+        self.markPhase('backrefs')
+        self.applyBackrefs()
+        self.markPhase(None)
+
+    def applyBackrefs(self):
+        if self.checkpoint is not None:
+            if self.checkpoint.phaseDone('backrefs'):
+                return
+            self.checkpoint.setPhase('backrefs')
+        self.backrefs.apply()
+        if self.checkpoint is not None:
+            self.checkpoint.setPhase('indexes')
+
+class OffsetFile(object):
+    """File wrapper that knows the input offset of the bytes it returns.
+
+    When started at an offset in the middle of a file it skips ahead to the
+    next node, way or relation and puts an <osm> root element in front so
+    that the parser sees a well-formed document."""
+    ELEMENT_START = re.compile(r'<(node|way|relation)[\s/>]')
+
+    def __init__(self, file_obj, offset=0):
+        self.file_obj = file_obj
+        self.position = offset
+        self.readStarts = (offset, offset)
+        self.buffer = ''
+        if offset > 0:
+            file_obj.seek(offset)
+            data = file_obj.read(65536)
+            match = self.ELEMENT_START.search(data)
+            while match is None and data:
+                more = file_obj.read(65536)
+                if not more:
+                    break
+                self.position = self.position + len(data) - 16
+                data = data[-16:] + more
+                match = self.ELEMENT_START.search(data)
+            skip = match.start() if match else len(data)
+            self.buffer = '<osm>' + data[skip:]
+            self.position = self.position + skip - len('<osm>')
+            self.readStarts = (self.position, self.position)
+
+    def read(self, size):
+        self.readStarts = (self.readStarts[1], self.position)
+        if self.buffer:
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+        else:
+            data = self.file_obj.read(size)
+        self.position = self.position + len(data)
+        return data
+
+    def safeOffset(self):
+        """An offset no later than the start of any element whose start tag
+        the parser hasn't finished with yet"""
+        return max(self.readStarts[0], 0)
+
+class OsmXmlReader(object):
+    """Yields (name, attrs, tags, children) for every node, way and relation
+    in an OSM XML file. children is [lat, lon] for a node, the list of node
+    ids for a way and the list of member dicts for a relation.
+
+    offset is always an input offset from which reading again gets the
+    element most recently yielded and everything after it."""
+    def __init__(self, file_obj, offset=0):
+        self.file_obj = OffsetFile(file_obj, offset)
+        self.offset = offset
+
+    def __iter__(self):
+        context = iter(iterparse(self.file_obj, events=('start', 'end')))
+        event, root = context.next()
+        elementOffset = self.offset
+
+        for (event, elem) in context:
+            name = elem.tag
+            if name not in ('node', 'way', 'relation'):
+                continue
+
+            if 'start' == event:
+                elementOffset = self.file_obj.safeOffset()
+                continue
+
+            attrs = dict(elem.attrib)
+            tags = [(tag.get('k'), tag.get('v')) for tag in elem.iterfind('tag')]
+            if name == 'node':
+                children = [float(attrs['lat']),
+                            float(attrs['lon'])]
+            elif name == 'way':
+                children = [long(nd.get('ref')) for nd in elem.iterfind('nd')]
+            else:
+                children = [dict(type=member.get('type'),
+                                 ref=long(member.get('ref')),
+                                 role=member.get('role'))
+                            for member in elem.iterfind('member')]
+
+            self.offset = elementOffset
+            yield (name, attrs, tags, children)
+
             elem.clear()
             root.clear()
 
+# Seconds between checks that the workers are still alive while waiting
+# on them
+POLL_SECONDS = 1
+
+class WorkerError(Exception):
+    """An import worker failed; the message is its traceback"""
+    pass
+
+def importWorker(tasks, results, batchBytes, writeConcern, compact):
+    """Worker process for ImportPipeline: turns batches of elements into
+    documents and inserts them with its own connection. If anything goes
+    wrong it sends a WorkerError back and stops."""
+    try:
+        client = MongoClient()
+        handler = OsmHandler(client, indexes=False, batchBytes=batchBytes,
+                             writeConcern=writeConcern, inFlight=0,
+                             compact=compact)
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            (seq, name, elements, locs, upsert) = task
+
+            start = time.time()
+            records = [handler.buildRecord(element) for element in elements]
+            if name == 'way':
+                for (i, record) in enumerate(records):
+                    if locs is not None:
+                        record['loc'] = locs[i]
+                    else:
+                        record['loc'] = handler.wayLocations(record['nd'])
+            converted = time.time()
+
+            handler.insertRecords(name, records, upsert)
+            inserted = time.time()
+
+            results.put((seq, name, len(records), converted - start, inserted - converted))
+
+        client.disconnect()
+    except Exception:
+        import traceback
+        results.put(WorkerError("Import worker %d failed:\n%s" % (os.getpid(), traceback.format_exc())))
+
+class ImportPipeline(object):
+    """Multi-process import: this process tokenises the file and a pool of
+    worker processes converts and inserts batches of elements. Bounded
+    queues between the two keep the reader from running ahead."""
+    def __init__(self, handler, workers, batchSize=2000):
+        self.handler = handler
+        self.workers = workers
+        self.batchSize = batchSize
+        self.tasks = multiprocessing.Queue(maxsize=workers * 2)
+        self.results = multiprocessing.Queue()
+        self.processes = []
+        self.batchesSent = 0
+        self.batchesDone = 0
+        # Batches finish out of order, so only checkpoint past a batch once
+        # every batch sent before it is done too
+        self.batchCheckpoints = {}
+        self.finished = set()
+        self.nextCheckpoint = 0
+        self.stageTimes = {'read': 0.0, 'wait': 0.0, 'convert': 0.0, 'insert': 0.0}
+        self.stageCounts = {'node': 0, 'way': 0, 'relation': 0}
+
+    def checkWorkers(self):
+        """Fail the import if a worker has died without saying why"""
+        for process in self.processes:
+            if process.exitcode not in (None, 0):
+                raise WorkerError("Import worker %d died (exit code %d)" % (
+                    process.pid, process.exitcode))
+        if self.batchesDone < self.batchesSent and self.results.empty() and \
+                not any(process.is_alive() for process in self.processes):
+            raise WorkerError("Import workers exited with %d batches unfinished" % (
+                self.batchesSent - self.batchesDone,))
+
+    def collect(self, block):
+        while self.batchesDone < self.batchesSent:
+            try:
+                result = self.results.get(block, POLL_SECONDS)
+            except Queue.Empty:
+                if not block:
+                    break
+                self.checkWorkers()
+                continue
+            if isinstance(result, WorkerError):
+                raise result
+            (seq, name, count, convertTime, insertTime) = result
+            self.batchesDone = self.batchesDone + 1
+            self.stageCounts[name] = self.stageCounts[name] + count
+            self.stageTimes['convert'] = self.stageTimes['convert'] + convertTime
+            self.stageTimes['insert'] = self.stageTimes['insert'] + insertTime
+            self.finished.add(seq)
+
+        lastDone = None
+        while self.nextCheckpoint in self.finished:
+            self.finished.remove(self.nextCheckpoint)
+            lastDone = self.batchCheckpoints.pop(self.nextCheckpoint)
+            self.nextCheckpoint = self.nextCheckpoint + 1
+        if lastDone is not None and self.handler.checkpoint is not None:
+            self.handler.checkpoint.save(*lastDone)
+
+    def send(self, name, batch, locs, offset):
+        handler = self.handler
+        upsert = any(handler.mayBeStored(name, long(element[1]['id'])) for element in batch)
+
+        seq = self.batchesSent
+        self.batchCheckpoints[seq] = (name, long(batch[-1][1]['id']), offset)
+        start = time.time()
+        self.put((seq, name, batch, locs, upsert))
+        self.stageTimes['wait'] = self.stageTimes['wait'] + (time.time() - start)
+        self.batchesSent = self.batchesSent + 1
+        self.collect(False)
+
+    def put(self, task):
+        """Queue a task for the workers, failing rather than waiting
+        forever if they have stopped taking them"""
+        while True:
+            try:
+                self.tasks.put(task, True, POLL_SECONDS)
+                return
+            except Queue.Full:
+                self.collect(False)
+                self.checkWorkers()
+
+    def drain(self):
+        """Wait for every batch sent so far to be inserted"""
+        self.collect(True)
+
+    def run(self, elements):
+        for i in range(self.workers):
+            process = multiprocessing.Process(target=importWorker,
+                                              args=(self.tasks, self.results,
+                                                    self.handler.batchBytes,
+                                                    self.handler.writeConcern,
+                                                    self.handler.compact))
+            process.start()
+            self.processes.append(process)
+
+        try:
+            self.load(elements)
+        except:
+            # Don't leave the other workers waiting for more tasks, or this
+            # process waiting to hand them the ones still queued
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+            self.tasks.cancel_join_thread()
+            raise
+        finally:
+            for process in self.processes:
+                process.join()
+
+    def load(self, elements):
+        handler = self.handler
+        nodeStore = handler.nodeStore
+
+        start = time.time()
+        batch = []
+        locs = None
+        batchType = None
+        if handler.checkpoint is None or not handler.checkpoint.phaseDone('elements'):
+            for element in elements:
+                name = element[0]
+                if handler.skipped(element):
+                    continue
+
+                if name != batchType:
+                    if batch:
+                        self.send(batchType, batch, locs, elements.offset)
+                        batch = []
+                    # Ways may need their nodes to be in the database and
+                    # relations their ways, so finish each phase before the next
+                    self.drain()
+                    handler.markPhase(name)
+                    batchType = name
+                    locs = [] if name == 'way' and nodeStore is not None else None
+
+                if name == 'node':
+                    if nodeStore is not None:
+                        nodeStore.set(long(element[1]['id']), element[3][0], element[3][1])
+                    handler.stat_nodes = handler.stat_nodes + 1
+                elif name == 'way':
+                    if locs is not None:
+                        locs.append(handler.wayLocations(element[3]))
+                    handler.stat_ways = handler.stat_ways + 1
+                elif name == 'relation':
+                    for member in element[3]:
+                        handler.backrefs.add(member['type'], member['ref'], long(element[1]['id']))
+                    handler.stat_relations = handler.stat_relations + 1
+
+                batch.append(element)
+                if len(batch) >= self.batchSize:
+                    self.send(batchType, batch, locs, elements.offset)
+                    batch = []
+                    locs = [] if locs is not None else None
+                    handler.writeStatsToScreen()
+
+            if batch:
+                self.send(batchType, batch, locs, elements.offset)
+        for process in self.processes:
+            self.put(None)
+        self.drain()
+        loaded = time.time()
+        self.stageTimes['read'] = (loaded - start) - self.stageTimes['wait']
+
+        handler.writeStatsToScreen()
+        handler.markPhase('backrefs')
+        handler.applyBackrefs()
+        handler.markPhase(None)
+        self.report(loaded - start)
+
+    def report(self, elapsed):
+        total = sum(self.stageCounts.values())
+
+        def rate(count, seconds):
+            return count / seconds if seconds > 0 else 0
+
+        print "Pipeline with %d workers, %d elements in %.1fs (%d/s)" % (
+            self.workers, total, elapsed, rate(total, elapsed))
+        for name in ('node', 'way', 'relation'):
+            print "  %ss: %d" % (name, self.stageCounts[name])
+        print "  read:    %.1fs, %d elements/s" % (
+            self.stageTimes['read'], rate(total, self.stageTimes['read']))
+        print "  queue:   %.1fs blocked on full worker queue" % (self.stageTimes['wait'],)
+        print "  convert: %.1f worker-s, %d elements/worker-s" % (
+            self.stageTimes['convert'], rate(total, self.stageTimes['convert']))
+        print "  insert:  %.1f worker-s, %d elements/worker-s" % (
+            self.stageTimes['insert'], rate(total, self.stageTimes['insert']))
+
+def optionParser():
+    parser = OptionParser(usage="%prog [options] <OSM filename>")
+    parser.add_option("--node-store", dest="nodeStore", default="sparse",
+                      choices=["sparse", "dense", "mongo"],
+                      help="where to keep node locations for building way "
+                           "geometries: sparse (in memory, for extracts), "
+                           "dense (memory-mapped file, for planets) or "
+                           "mongo (query the nodes collection) [%default]")
+    parser.add_option("--node-store-file", dest="nodeStoreFile",
+                      default="nodes.cache",
+                      help="file backing the dense node store [%default]")
+    parser.add_option("--workers", dest="workers", type="int", default=0,
+                      help="convert and insert in N worker processes while "
+                           "this one reads the file (0 reads and writes in "
+                           "a single process) [%default]")
+    parser.add_option("--decoders", dest="decoders", type="int", default=None,
+                      help="processes decoding PBF blocks or bz2 streams "
+                           "(defaults to the number of CPUs)")
+    parser.add_option("--defer-indexes", dest="deferIndexes",
+                      action="store_true", default=False,
+                      help="drop the secondary indexes, load the data and "
+                           "build them once at the end")
+    parser.add_option("--batch-bytes", dest="batchBytes", type="int",
+                      default=DEFAULT_BATCH_BYTES,
+                      help="write documents in bulk batches of about this "
+                           "many BSON bytes [%default]")
+    parser.add_option("--in-flight", dest="inFlight", type="int", default=2,
+                      help="batches being written at the same time [%default]")
+    parser.add_option("--write-concern", dest="writeConcern", default=None,
+                      help="write concern for inserts, e.g. 1 or majority; "
+                           "0 doesn't wait for acknowledgement at all, the "
+                           "fastest (and least safe) way to load")
+    parser.add_option("--journal", dest="journal", action="store_true",
+                      default=False,
+                      help="wait for inserts to be journaled")
+    parser.add_option("--compact", dest="compact", action="store_true",
+                      default=False,
+                      help="store coordinates as fixed-point integers and "
+                           "way node refs and tags as packed binary fields")
+    parser.add_option("--resume", dest="resume", action="store_true",
+                      default=False,
+                      help="continue an interrupted import from its last "
+                           "checkpoint")
+    return parser
+
+def importFile(client, filename, options):
+    """Import an OSM file with the given command line options, returning
+    the handler (and its stats) when done"""
+    start = time.time()
+    if options.resume and isCompact(client) != options.compact:
+        print "The interrupted import %s --compact; resume it the same way." % (
+            "didn't use" if options.compact else "used")
+        sys.exit(-1)
+    nodeStore = openNodeStore(options.nodeStore, options.nodeStoreFile, options.resume)
+    #parser = make_parser()
+    handler = OsmHandler(client, nodeStore, indexes=not options.deferIndexes,
+                         batchBytes=options.batchBytes,
+                         writeConcern=parseWriteConcern(options.writeConcern,
+                                                        options.journal),
+                         inFlight=options.inFlight,
+                         compact=options.compact)
+    handler.checkpoint = ImportCheckpoint(client, os.path.abspath(filename))
+    offset = 0
+    if options.resume:
+        if not handler.checkpoint.load():
+            print "No checkpoint to resume from."
+            sys.exit(-1)
+        offset = handler.checkpoint.offset()
+        handler.resuming = True
+        handler.resume(handler.checkpoint)
+        print "Resuming after %s %s." % (handler.checkpoint.elementType(),
+                                         handler.checkpoint.state.get('lastId'))
+    else:
+        handler.checkpoint.clear()
+        setCompact(client, options.compact)
+        if options.deferIndexes:
+            handler.dropIndexes()
+    #parser.setContentHandler(handler)
+    #parser.parse(open(filename))
+    input = openInput(filename, options.decoders)
+    if baseName(filename).endswith('.pbf'):
+        elements = OsmPbfReader(input, options.decoders, offset)
+    else:
+        elements = OsmXmlReader(input, offset)
+
+    if options.workers > 0:
+        pipeline = ImportPipeline(handler, options.workers)
+        pipeline.run(elements)
+    else:
+        handler.load(elements)
+    loaded = time.time()
+
+    if options.deferIndexes and not handler.checkpoint.phaseDone('indexes'):
+        handler.markPhase('indexes')
+        handler.buildIndexes()
+        handler.markPhase(None)
+    handler.checkpoint.setPhase('done')
+    indexed = time.time()
+
+    print "Load: %.1fs, index build: %.1fs, total: %.1fs" % (
+        loaded - start, indexed - loaded, indexed - start)
+    input.close()
+    if nodeStore is not None:
+        nodeStore.close()
+    return handler
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print "Usage: %s <OSM filename>" % (sys.argv[0])
+    parser = optionParser()
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_usage()
         sys.exit(-1)
 
-    filename = sys.argv[1]
+    filename = args[0]
 
     if not os.path.exists(filename):
         print "Path %s doesn't exist." % (filename)
         sys.exit(-1)
 
     client = MongoClient()
-    #parser = make_parser()
-    handler = OsmHandler(client)
-    #parser.setContentHandler(handler)
-    #parser.parse(open(filename))
-    handler.parse(open(filename))
+    importFile(client, filename, options)
     client.disconnect()
@@ -1,4 +1,4 @@
-"""This program parses an OSM XML file and inserts the data in a
+"""This program parses an OSM XML or PBF file and inserts the data in a
 MongoDB database"""
 
 import sys
@@ -6,27 +6,90 @@ import os
 import time
 import pymongo
 from datetime import datetime
+from optparse import OptionParser
 from xml.sax import make_parser
 from xml.sax.handler import ContentHandler
 from pymongo import Connection
 
-from globalmaptiles import GlobalMercator
+from globalmaptiles import GlobalMercator, MORTON_ZOOM
+from backrefs import RelationBackrefs
+from bulkwriter import BulkWriter
+from osmpbf import OsmPbfReader, feedHandler
+from inputfile import openInput, baseName
+from compactschema import compactRecord, setCompact
+from nodestore import SparseKeyStore, openKeyStore
+
+# Nodes are keyed by their integer quadkey at MORTON_ZOOM. Ways store a
+# covering of the tiles at WAY_ZOOM their nodes are in, of at most
+# MAX_WAY_CELLS tiles at mixed zooms (see cellKey).
+WAY_ZOOM = 17
+WAY_KEY_SHIFT = 2 * (MORTON_ZOOM - WAY_ZOOM)
+MAX_WAY_CELLS = 16
+
+def cellKey(key, zoom):
+    """A covering tile as one integer: the MORTON_ZOOM key of its first
+    descendant, with its zoom in the low bits (which are always zero for
+    tiles no deeper than WAY_ZOOM)"""
+    return (key << (2 * (MORTON_ZOOM - zoom))) | zoom
+
+def wayTileQuery(proj, tx, ty, zoom):
+    """Query on way cell keys for ways whose covering overlaps a TMS tile:
+    the ones with a cell inside it, or a cell that is one of its ancestors"""
+    if zoom > WAY_ZOOM:
+        (tx, ty) = (tx >> (zoom - WAY_ZOOM), ty >> (zoom - WAY_ZOOM))
+        zoom = WAY_ZOOM
+    (minKey, maxKey) = proj.MortonRange(tx, ty, zoom)
+    key = proj.MortonKey(tx, ty, zoom)
+    ancestors = [cellKey(key >> (2 * (zoom - z)), z) for z in range(zoom)]
+    return {'$or': [{'qk': {'$gte': minKey, '$lt': maxKey}},
+                    {'qk': {'$in': ancestors}}]}
+
+# Nodes are buffered and their quadkeys computed this many at a time
+NODE_BATCH = 10000
 
 class OsmHandler(ContentHandler):
     """Base class for parsing OSM XML data"""
-    def __init__(self, client):
+    def __init__(self, client, compact=False, keyStore=None):
         self.proj = GlobalMercator()
-        self.nodeRecords = []
-        self.wayRecords = []
-        self.relationRecords = []
+        self.compact = compact
+        self.nodeWriter = BulkWriter(client.osm.nodes)
+        self.wayWriter = BulkWriter(client.osm.ways)
+        self.relationWriter = BulkWriter(client.osm.relations)
         self.record = {}
-        self.nodeLocations = {}
+        if keyStore is None:
+            keyStore = SparseKeyStore()
+        self.keyStore = keyStore
+        self.pendingNodes = []
+        self.pendingLats = []
+        self.pendingLons = []
         self.client = client
-        
+        self.backrefs = RelationBackrefs(client)
+        client.osm.nodes.ensure_index('qk')
+        client.osm.ways.ensure_index('qk')
+
         self.stats = {'nodes': 0, 'ways': 0, 'relations': 0}
+        self.stat_seconds = {}
+        self.currentPhase = None
+        self.phaseStart = None
         self.lastStatString = ""
         self.statsCount = 0
 
+    def markPhase(self, phase):
+        """Start timing a phase (an element type or 'backrefs'), waiting
+        for the writes of the one before it first"""
+        self.flushNodes()
+        writers = {'node': self.nodeWriter,
+                   'way': self.wayWriter,
+                   'relation': self.relationWriter}
+        if self.currentPhase in writers:
+            writers[self.currentPhase].wait()
+        now = time.time()
+        if self.currentPhase is not None:
+            self.stat_seconds[self.currentPhase] = (self.stat_seconds.get(self.currentPhase, 0) +
+                                                    now - self.phaseStart)
+        self.currentPhase = phase
+        self.phaseStart = now
+
     def writeStatsToScreen(self):
         for char in self.lastStatString:
             sys.stdout.write('\b')
@@ -54,19 +117,30 @@ class OsmHandler(ContentHandler):
         t = datetime.strptime(isotime, "%Y-%m-%dT%H:%M:%SZ")
         return time.mktime(t.timetuple())
 
-    def quadKey(self, lat, lon, zoom):
-        (mx, my) = self.proj.LatLonToMeters(lat, lon)
-        (tx, ty) = self.proj.MetersToTile(mx, my, zoom)
-        return self.proj.QuadTree(tx, ty, zoom)
+    def flushNodes(self):
+        """Work out the quadkeys of the buffered nodes in one batch and
+        send them off to be written"""
+        if not self.pendingNodes:
+            return
+        keys = self.proj.LatLonToMortonArray(self.pendingLats, self.pendingLons)
+        for (record, key) in zip(self.pendingNodes, keys):
+            record['qk'] = int(key)
+            self.keyStore.set(record['_id'], record['qk'])
+            self.nodeWriter.add(record)
+        self.pendingNodes = []
+        self.pendingLats = []
+        self.pendingLons = []
 
     def startElement(self, name, attrs):
         """Parse the XML element at the start"""
+        if name in ('node', 'way', 'relation') and name != self.currentPhase:
+            self.markPhase(name)
         if name == 'node':
             self.fillDefault(attrs)
             self.record['loc'] = {'lat': float(attrs['lat']),
                                   'lon': float(attrs['lon'])}
-            self.record['qk'] = self.quadKey(float(attrs['lat']), float(attrs['lon']), 17)
-            self.nodeLocations[self.record['_id']] = self.record['qk']
+            self.pendingLats.append(self.record['loc']['lat'])
+            self.pendingLons.append(self.record['loc']['lon'])
         elif name == 'changeset':
             self.fillDefault(attrs)
         elif name == 'tag':
@@ -78,64 +152,54 @@ class OsmHandler(ContentHandler):
         elif name == 'way':
             self.fillDefault(attrs)
             self.record['n'] = []
-            self.record['loc'] = []
+            self.wayTiles = set()
         elif name == 'relation':
             self.fillDefault(attrs)
             self.record['m'] = []
         elif name == 'nd':
             ref = int(attrs['ref'])
             self.record['n'].append(ref)
-            refLoc = self.nodeLocations[ref]
-            if refLoc not in self.record['loc']:
-                self.record['loc'].append(refLoc)
+            refKey = self.keyStore.get(ref)
+            if refKey is None:
+                print 'node not found: ' + str(ref)
+                return
+            self.wayTiles.add(refKey >> WAY_KEY_SHIFT)
         elif name == 'member':
             ref = int(attrs['ref'])
             member = {'type': attrs['type'],
                       'ref':  ref,
                       'role': attrs['role']}
             self.record['m'].append(member)
-            
-            if attrs['type'] == 'way':
-                ways2relations = self.client.osm.ways.find_one({ '_id' : ref})
-                if ways2relations:
-                    if 'relations' not in ways2relations:
-                        ways2relations['relations'] = []
-                    ways2relations['relations'].append(self.record['_id'])
-                    self.client.osm.ways.save(ways2relations)
-            elif attrs['type'] == 'node':
-                nodes2relations = self.client.osm.nodes.find_one({ '_id' : ref})
-                if nodes2relations:
-                    if 'relations' not in nodes2relations:
-                        nodes2relations['relations'] = []
-                    nodes2relations['relations'].append(self.record['_id'])
-                    self.client.osm.nodes.save(nodes2relations)
+            self.backrefs.add(attrs['type'], ref, self.record['_id'])
         
     def endElement(self, name):
         """Finish parsing an element
         (only really used with nodes, ways and relations)"""
+        if name == 'way':
+            self.record['qk'] = [cellKey(key, zoom) for (key, zoom) in
+                                 self.proj.MortonCovering(self.wayTiles, WAY_ZOOM, MAX_WAY_CELLS)]
+        if self.compact and name in ('node', 'way', 'relation'):
+            compactRecord(self.record)
         if name == 'node':
-            self.nodeRecords.append(self.record)
-            if len(self.nodeRecords) > 1500:
-                self.client.osm.nodes.insert(self.nodeRecords)
-                self.nodeRecords = []
-                self.writeStatsToScreen()
+            self.pendingNodes.append(self.record)
+            if len(self.pendingNodes) >= NODE_BATCH:
+                self.flushNodes()
             self.record = {}
+            self.statsCount = self.statsCount + 1
+            if self.statsCount > 1500:
+                self.writeStatsToScreen()
+                self.statsCount = 0
             self.stats['nodes'] = self.stats['nodes'] + 1
         elif name == 'way':
-            # Clean up any existing nodes
-            if len(self.nodeRecords) > 0:
-                self.client.osm.nodes.insert(self.nodeRecords)
-                self.nodeRecords = []
-
-            self.wayRecords.append(self.record)
-            if len(self.wayRecords) > 100:
-                self.client.osm.ways.insert(self.wayRecords)
-                self.wayRecords = []
-                self.writeStatsToScreen()
+            self.wayWriter.add(self.record)
             self.record = {}
+            self.statsCount = self.statsCount + 1
+            if self.statsCount > 100:
+                self.writeStatsToScreen()
+                self.statsCount = 0
             self.stats['ways'] = self.stats['ways'] + 1
         elif name == 'relation':
-            self.client.osm.relations.save(self.record)
+            self.relationWriter.add(self.record)
             self.record = {}
             self.statsCount = self.statsCount + 1
             if self.statsCount > 10:
@@ -143,18 +207,58 @@ class OsmHandler(ContentHandler):
                 self.statsCount = 0
             self.stats['relations'] = self.stats['relations'] + 1
 
+    def endDocument(self):
+        """Flush what's left and write out the member -> relation links
+        collected while parsing"""
+        self.markPhase('backrefs')
+        self.nodeWriter.close()
+        self.wayWriter.close()
+        self.relationWriter.close()
+        self.backrefs.apply()
+        self.markPhase(None)
+
+def importFile(client, filename, compact=False, keyStore=None):
+    """Import an OSM file, returning the handler (and its stats) when done"""
+    setCompact(client, compact)
+    handler = OsmHandler(client, compact, keyStore)
+    input = openInput(filename)
+    if baseName(filename).endswith('.pbf'):
+        feedHandler(handler, OsmPbfReader(input))
+    else:
+        parser = make_parser()
+        parser.setContentHandler(handler)
+        parser.parse(input)
+    input.close()
+    handler.keyStore.close()
+    return handler
+
 if __name__ == "__main__":
-    filename = sys.argv[1]
+    parser = OptionParser(usage="usage: %prog [options] filename")
+    parser.add_option("--compact", action="store_true", default=False,
+                      help="store coordinates, node refs and tags in the compact "
+                           "binary schema")
+    parser.add_option("--node-store", default="sparse", choices=["sparse", "dense"],
+                      help="where to keep node quadkeys for building ways: sparse "
+                           "(sorted arrays, for extracts) or dense (memory-mapped "
+                           "file indexed by id, for planets) [%default]")
+    parser.add_option("--node-store-file", default="nodekeys.cache",
+                      help="file backing the dense node store [%default]")
+    parser.add_option("--node-memory", type="int", default=1024,
+                      help="MB of node quadkeys the sparse store keeps in memory "
+                           "before moving them to a temporary file [%default]")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected one input file")
+    filename = args[0]
 
     if not os.path.exists(filename):
         print "Path %s doesn't exist." % (filename)
         sys.exit(-1)
 
     client = Connection()
-    parser = make_parser()
-    handler = OsmHandler(client)
-    parser.setContentHandler(handler)
-    parser.parse(open(filename))
+    keyStore = openKeyStore(options.node_store, options.node_store_file,
+                            options.node_memory * 1024 * 1024)
+    importFile(client, filename, options.compact, keyStore)
     client.disconnect()
 
     print
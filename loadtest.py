@@ -0,0 +1,183 @@
+"""Load test for map_server.py's production mode: serves the same data with
+prefork.serve() at each of several worker counts, sends random
+/api/0.6/map requests from a pool of client processes and writes
+throughput and latency per worker count as JSON.
+
+By default the data is a generated file loaded into benchmark.py's
+in-process stand-in for MongoDB (forked into every worker), with
+--latency-ms of simulated network time per round trip. With --mongo the
+servers read from a real mongod, which should already hold data covering
+--bbox."""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import urllib2
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+
+from benchmark import generateOsm, MemoryClient
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def runServer(client, mongo, port, workers, threads):
+    """Child process running the pre-forked server until it's sent SIGTERM"""
+    import prefork
+    import map_server
+    from mongopool import MongoPool
+
+    sys.stdout = open(os.devnull, 'w')
+    def makeApp():
+        if client is not None:
+            pool = MongoPool(poolSize=threads, client=client)
+        else:
+            pool = MongoPool(mongo, poolSize=threads)
+            pool.warm()
+        return map_server.Mongosm(map_server.OsmApi(pool))
+    prefork.serve(makeApp, '127.0.0.1', port, workers, threads, accessLog=False)
+
+def waitForServer(port, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("The server didn't start listening on port %d" % (port,))
+
+def runClient(args):
+    """Client process: send map requests until the time is up, returning
+    (latencies, bytes, errors)"""
+    (port, bbox, size, seconds, seed) = args
+    rand = random.Random(seed)
+    (minlon, minlat, maxlon, maxlat) = bbox
+    latencies = []
+    received = 0
+    errors = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        lon = rand.uniform(minlon, maxlon - size)
+        lat = rand.uniform(minlat, maxlat - size)
+        url = 'http://127.0.0.1:%d/api/0.6/map?bbox=%f,%f,%f,%f' % (
+            port, lon, lat, lon + size, lat + size)
+        start = time.time()
+        try:
+            received = received + len(urllib2.urlopen(url, timeout=60).read())
+            latencies.append(time.time() - start)
+        except (urllib2.URLError, socket.error):
+            errors = errors + 1
+    return (latencies, received, errors)
+
+def loadTest(client, options, bbox, workers, port):
+    server = multiprocessing.Process(target=runServer,
+                                     args=(client, options.mongo, port, workers,
+                                           options.threads))
+    server.start()
+    try:
+        waitForServer(port)
+        pool = multiprocessing.Pool(options.clients)
+        start = time.time()
+        results = pool.map(runClient, [(port, bbox, options.bboxSize, options.seconds, seed)
+                                       for seed in range(options.clients)])
+        elapsed = time.time() - start
+        pool.close()
+        pool.join()
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+
+    latencies = [latency for (clientLatencies, received, errors) in results
+                 for latency in clientLatencies]
+    return {'workers': workers,
+            'threads': options.threads,
+            'clients': options.clients,
+            'seconds': elapsed,
+            'requests': len(latencies),
+            'errors': sum(errors for (clientLatencies, received, errors) in results),
+            'bytes': sum(received for (clientLatencies, received, errors) in results),
+            'requests_per_s': len(latencies) / elapsed,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p95': percentile(latencies, 0.95),
+            'latency_p99': percentile(latencies, 0.99)}
+
+def printResult(result):
+    def ms(value):
+        return '%6.0fms' % (value * 1000,) if value is not None else '      -'
+    print "%2d workers  %7.1f requests/s  p50 %s  p95 %s  p99 %s  errors %d" % (
+        result['workers'], result['requests_per_s'], ms(result['latency_p50']),
+        ms(result['latency_p95']), ms(result['latency_p99']), result['errors'])
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--workers", dest="workers", default="1,2,4",
+                      help="comma separated worker counts to test [%default]")
+    parser.add_option("--threads", dest="threads", type="int", default=8,
+                      help="threads (and MongoDB connections) per worker [%default]")
+    parser.add_option("--clients", dest="clients", type="int", default=16,
+                      help="client processes sending requests [%default]")
+    parser.add_option("--seconds", dest="seconds", type="int", default=10,
+                      help="how long to send requests for at each worker count [%default]")
+    parser.add_option("--bbox", dest="bbox", default="-1,51,0,52",
+                      help="minlon,minlat,maxlon,maxlat the data covers and the "
+                           "requests are spread over [%default]")
+    parser.add_option("--bbox-size", dest="bboxSize", type="float", default=0.02,
+                      help="width and height in degrees of each request's bbox [%default]")
+    parser.add_option("--nodes", dest="nodes", type="int", default=50000,
+                      help="nodes to generate for the stand-in [%default]")
+    parser.add_option("--latency-ms", dest="latencyMs", type="float", default=2,
+                      help="simulated time per stand-in round trip [%default]")
+    parser.add_option("--mongo", dest="mongo", default=None,
+                      help="serve from the mongod at this host or URI instead "
+                           "of the stand-in")
+    parser.add_option("--port", dest="port", type="int", default=5099,
+                      help="port the servers listen on [%default]")
+    parser.add_option("--output", dest="output", default="loadtest.json",
+                      help="file to write the JSON results to [%default]")
+    (options, args) = parser.parse_args()
+
+    bbox = tuple(float(v) for v in options.bbox.split(','))
+    client = None
+    if not options.mongo:
+        import insert_osm_data
+        (fd, filename) = tempfile.mkstemp(suffix='.osm')
+        out = os.fdopen(fd, 'w')
+        counts = generateOsm(out, options.nodes, bbox=bbox)
+        out.close()
+        client = MemoryClient()
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            insert_osm_data.importFile(client, filename,
+                                       insert_osm_data.optionParser().parse_args([])[0])
+        finally:
+            sys.stdout = stdout
+            os.remove(filename)
+        client.latency = options.latencyMs / 1000.0
+        print "Loaded %d nodes, %d ways and %d relations into the stand-in." % (
+            counts['nodes'], counts['ways'], counts['relations'])
+
+    runs = []
+    for workers in [int(w) for w in options.workers.split(',')]:
+        result = loadTest(client, options, bbox, workers, options.port)
+        printResult(result)
+        runs.append(result)
+
+    report = {'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              'database': options.mongo or 'stand-in',
+              'latency_ms': None if options.mongo else options.latencyMs,
+              'bbox': bbox,
+              'bbox_size': options.bboxSize,
+              'runs': runs}
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results written to %s." % (options.output,)
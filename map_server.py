@@ -1,84 +1,139 @@
 import pymongo
-from pymongo import Connection
-from xml.sax.saxutils import escape
 import re
+import json
+import logging
+import threading
+from itertools import islice
+
+from compactschema import expandRecord, isCompact, scaleQuery
+from osmxml import OsmXmlWriter, DEFAULT_CHUNK_BYTES
+from nodestore import IdSet
+from mongopool import MongoPool, addPoolOptions, openPool
+
+# Ids per $in query
+IN_CHUNK = 1000
+
+log = logging.getLogger('mongosm')
 
 class OsmApi:
-    def __init__(self):
-        self.client = Connection()
+    """Reads OSM documents through a MongoPool, which can be shared by
+    every request thread"""
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = MongoPool()
+        self.pool = pool
+        self.client = pool.client
+        self.compact = isCompact(self.client)
+        # Queries sent to MongoDB, per thread
+        self.local = threading.local()
+
+    def queryCount(self):
+        """Queries (find and find_one calls) this thread has sent so far.
+        The getMore round trips of long cursors aren't counted."""
+        return getattr(self.local, 'queries', 0)
+
+    def find(self, collection, query, fields=None):
+        self.local.queries = self.queryCount() + 1
+        return self.pool.find(collection, query, fields)
+
+    def findOne(self, collection, query, fields=None):
+        self.local.queries = self.queryCount() + 1
+        return self.pool.findOne(collection, query, fields)
+
+    def findIn(self, collection, ids, fields=None):
+        """Documents with the given ids, IN_CHUNK ids per query"""
+        ids = iter(ids)
+        while True:
+            chunk = list(islice(ids, IN_CHUNK))
+            if not chunk:
+                break
+            for row in self.find(collection, {'_id': {'$in': chunk}}, fields):
+                yield row
+
+    def scale(self, query):
+        """Scale bbox and polygon queries for fixed-point coordinates"""
+        if self.compact:
+            return scaleQuery(query)
+        return query
+
+    def iterQuery(self, collection, query, seen=None):
+        """Expanded documents matching query, straight from the cursor. If
+        seen is given, the ids of the documents are added to it."""
+        for row in self.find(collection, self.scale(query)):
+            if seen is not None:
+                seen.add(row['_id'])
+            yield expandRecord(row)
 
     def getNodesQuery(self, query):
-        cursor = self.client.osm.nodes.find(query)
+        cursor = self.find(self.client.osm.nodes, self.scale(query))
 
         nodes = {}
         for row in cursor:
-            nodes[row['_id']] = row
+            nodes[row['_id']] = expandRecord(row)
 
         return nodes
 
     def getNodes(self, query):
-        nodes = self.getNodesQuery(query)
-
-        return {'nodes': nodes.values()}
+        return {'nodes': self.iterQuery(self.client.osm.nodes, query)}
 
     def getWaysInBounds(self, box):
         return self.getWaysQuery([('bbox', box)])
 
     def getWaysQuery(self, query):
-        cursor = self.client.osm.ways.find(query)
+        cursor = self.find(self.client.osm.ways, self.scale(query))
 
         ways = {}
         for row in cursor:
-            ways[row['_id']] = row
+            ways[row['_id']] = expandRecord(row)
 
         return ways
 
     def getWays(self, query):
         ways = self.getWaysQuery(query)
-    
-        nodes = {}
-        nodes = self.getNodesFromWays(ways, nodes)
 
-        return {'nodes': nodes.values(), 'ways': ways.values()}
+        return {'nodes': self.iterNodesFromWays(ways, IdSet()), 'ways': ways.values()}
+
+    def getRelations(self, query):
+        return {'relations': self.iterQuery(self.client.osm.relations, query)}
 
     def getNodesFromWays(self, ways, existingNodes):
-        nodeIds = set() 
+        for row in self.iterNodesFromWays(ways, existingNodes):
+            existingNodes[row['_id']] = row
+
+        return existingNodes
+
+    def iterNodesFromWays(self, ways, existingNodes):
+        """The nodes of ways that aren't in existingNodes yet"""
+        nodeIds = IdSet()
 
         for way in ways.values():
             for nodeId in way['nd']:
-                nodeIds.add(nodeId)
+                if nodeId not in existingNodes:
+                    nodeIds.add(nodeId)
 
-        cursor = self.client.osm.nodes.find({'_id': {'$in': list(nodeIds)} })
-
-        for row in cursor:
-            if row['_id'] not in existingNodes:
-                existingNodes[row['_id']] = row
-
-        return existingNodes
-        
+        for row in self.findIn(self.client.osm.nodes, nodeIds):
+            yield expandRecord(row)
 
     def getWaysFromNodes(self, nodes):
         wayIds = set()
 
+        # Node documents carry the ids of their ways
         for node in nodes:
-            wayIdsFromNode = self.getWayIdsUsingNodeId(node['_id'])
-
-            for wayId in wayIdsFromNode:
-                wayIds.add(wayId)
+            wayIds.update(node.get('ways', []))
 
         ways = []
 
+        for way in self.findIn(self.client.osm.ways, wayIds):
+            ways.append(expandRecord(way))
+            wayIds.discard(way['_id'])
+
         for wayId in wayIds:
-            way = self.client.osm.ways.find_one({'_id' : wayId})
-            if way:
-                ways.append(way)
-            else:
-                print "Error. Couldn't find way id %d." % wayId
+            print "Error. Couldn't find way id %d." % wayId
 
         return ways
 
     def getWayIdsUsingNodeId(self, id):
-        cursor = self.client.osm.nodes.find_one({'_id' : id }, ['ways'])
+        cursor = self.findOne(self.client.osm.nodes, {'_id' : id }, ['ways'])
         if cursor and 'ways' in cursor:
             return cursor['ways']
         else:
@@ -87,171 +142,194 @@ class OsmApi:
     def getRelationsFromWays(self, ways):
         relationIds = set()
         
-        for (wid, way) in ways.items():
-            id = way['_id']
-            relationIdsFromWay = self.getRelationIdsUsingWayId(id)
-
-            for relationId in relationIdsFromWay:
-                relationIds.add(relationId)
+        # Way documents carry the ids of their relations
+        for way in ways.itervalues():
+            relationIds.update(way.get('relations', []))
 
         relations = []
 
+        for relation in self.findIn(self.client.osm.relations, relationIds):
+            relations.append(expandRecord(relation))
+            relationIds.discard(relation['_id'])
+
         for relationId in relationIds:
-            relation = self.client.osm.relations.find_one({'_id' : relationId})
-            if relation:
-                relations.append(relation)
-            else:
-                print "Error. Couldn't find relation id %d." % relationId
+            print "Error. Couldn't find relation id %d." % relationId
 
         return relations
 
     def getRelationIdsUsingWayId(self, id):
-        cursor = self.client.osm.ways.find_one({'_id' : id }, ['relations'])
+        cursor = self.findOne(self.client.osm.ways, {'_id' : id }, ['relations'])
         if cursor and 'relations' in cursor:
             return cursor['relations']
         else:
             return []
 
     def getNodeById(self, id):
-        cursor = self.client.osm.nodes.find_one({'_id' : id })
+        cursor = self.findOne(self.client.osm.nodes, {'_id' : id })
         if cursor:
-            return {'nodes': [cursor]}
+            return {'nodes': [expandRecord(cursor)]}
         else:
             return {}
 
     def getWayById(self, id):
         print id
-        cursor = self.client.osm.ways.find_one({'_id' : id })
+        cursor = self.findOne(self.client.osm.ways, {'_id' : id })
         if cursor:
-            return {'ways': [cursor]}
+            return {'ways': [expandRecord(cursor)]}
         else:
             return {}
 
     def getRelationById(self, id):
-        cursor = self.client.osm.relations.ways.find_one({'_id' : id })
+        cursor = self.findOne(self.client.osm.relations, {'_id' : id })
         if cursor:
-            return {'relations': [cursor]}
+            return {'relations': [expandRecord(cursor)]}
         else:
             return {}
 
     def getPrimitives(self, xapi_query):
-        nodes = self.getNodesQuery(xapi_query)
-
         ways = self.getWaysQuery(xapi_query)
 
-        nodes = self.getNodesFromWays(ways, nodes)
+        return {'nodes': self.iterPrimitiveNodes(xapi_query, ways), 'ways': ways.values()}
 
-        return {'nodes': nodes.values(), 'ways': ways.values()}
+    def iterPrimitiveNodes(self, xapi_query, ways):
+        """Nodes matching the query, then the other nodes of the ways"""
+        seen = IdSet()
+        for node in self.iterQuery(self.client.osm.nodes, xapi_query, seen):
+            yield node
+        for node in self.iterNodesFromWays(ways, seen):
+            yield node
 
     def getBbox(self, bbox):
-        import time, sys
-
-        start = time.time()
-        
-        nodes = self.getNodesQuery(bbox)
-
-        timeA = time.time()
-        sys.stderr.write("<!-- Get nodes in bbox %s -->\n" % (timeA - start))
-
-        ways = self.getWaysQuery(bbox)
-
-        timeB = time.time()
-        sys.stderr.write("<!-- Get ways in bbox %s -->\n" % (timeB - timeA))
-
-        wayNodes = self.getNodesFromWays(ways, nodes)
-
-        timeC = time.time()
-        sys.stderr.write("<!-- Get nodes from ways %s -->\n" % (timeC - timeB))
-
-
-        timeD = time.time()
-        sys.stderr.write("<!-- Collate nodes from ways %s -->\n" % (timeD - timeC))
-
-        relations = self.getRelationsFromWays(ways)
+        """Everything in a bbox as generators that read from the cursors as
+        the output asks for more. They feed each other, so they have to be
+        read in order: nodes, ways, wayNodes and then relations. Only ids
+        are held on to."""
+        nodeIds = IdSet()
+        wayNodeIds = IdSet()
+        relationIds = set()
 
-        timeE = time.time()
-        sys.stderr.write("<!-- Get relations %s -->\n" % (timeE - timeD))
-        
-        bboxArr = bbox['loc']['$within']['$polygon']
-        doc = {'bounds': {'minlat': bboxArr[0][0],
-                          'minlon': bboxArr[0][1],
-                          'maxlat': bboxArr[2][0],
-                          'maxlon': bboxArr[2][1]},
-               'nodes': nodes.values(),
-               'ways': ways.values(),
-               'relations': relations}
+        doc = {'bounds': bboxBounds(bbox),
+               'nodes': self.iterQuery(self.client.osm.nodes, bbox, nodeIds),
+               'ways': self.iterBboxWays(bbox, nodeIds, wayNodeIds, relationIds),
+               'wayNodes': self.iterById(self.client.osm.nodes, wayNodeIds),
+               'relations': self.iterById(self.client.osm.relations, relationIds)}
 
         return doc
 
-class OsmXmlOutput:
-    def addNotNullAttr(self, mappable, mappableElement, name, outName=None):
-        if not outName:
-            outName = name
-        if name in mappable:
-            mappableElement.setAttribute(escape(outName), escape(unicode(mappable[name])))
-
-    def defaultAttrs(self, mappableElement, mappable):
-        self.addNotNullAttr(mappable, mappableElement, "_id", "id")
-        self.addNotNullAttr(mappable, mappableElement, "v",   "version")
-        self.addNotNullAttr(mappable, mappableElement, "un",  "user")
-        self.addNotNullAttr(mappable, mappableElement, "ts",  "timestamp")
-
-    def tagNodes(self, doc, mappableElement, mappable):
-        if 'tg' in mappable:
-            for mappable in mappable['tg']:
-                tagElement = doc.createElement("tag")
-                k,v = mappable
-                tagElement.setAttribute("k", k)
-                tagElement.setAttribute("v", v)
-                mappableElement.appendChild(tagElement)
+    def iterBboxWays(self, bbox, nodeIds, wayNodeIds, relationIds):
+        """Ways in the bbox, noting the ids of their nodes that aren't in
+        nodeIds and of their relations"""
+        for way in self.iterQuery(self.client.osm.ways, bbox):
+            for nodeId in way['nd']:
+                if nodeId not in nodeIds:
+                    wayNodeIds.add(nodeId)
+            relationIds.update(way.get('relations', []))
+            yield way
+
+    def iterById(self, collection, ids):
+        for row in self.findIn(collection, ids):
+            yield expandRecord(row)
+
+def bboxBounds(bbox):
+    """The bounds of a map request's bbox query"""
+    bboxArr = bbox['loc']['$within']['$polygon']
+    return {'minlat': bboxArr[0][0],
+            'minlon': bboxArr[0][1],
+            'maxlat': bboxArr[2][0],
+            'maxlon': bboxArr[2][1]}
+
+class OsmXmlOutput(OsmXmlWriter):
+    pass
+
+class OsmJsonOutput:
+    """OSM JSON (http://wiki.openstreetmap.org/wiki/OSM_JSON), written an
+    element at a time in chunks of about chunkSize bytes"""
+    GENERATOR = "mongosm 0.1"
+    # (document field, attribute) pairs written on every element
+    ATTRS = (('v', 'version'), ('un', 'user'), ('ts', 'timestamp'))
+
+    def __init__(self, chunkSize=DEFAULT_CHUNK_BYTES):
+        self.chunkSize = chunkSize
+        self.dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+    def element(self, type, mappable, fields):
+        out = ['{"type":"%s","id":%d' % (type, mappable['_id']), fields]
+        for (field, name) in self.ATTRS:
+            if mappable.get(field) is not None:
+                out.append(',"%s":%s' % (name, self.dumps(mappable[field])))
+        if mappable.get('tg'):
+            out.append(',"tags":')
+            out.append(self.dumps(dict(mappable['tg'])))
+        out.append('}')
+        return ''.join(out)
+
+    def nodeElement(self, node):
+        return self.element('node', node, ',"lat":%s,"lon":%s' % (
+                self.dumps(node['loc'][0]), self.dumps(node['loc'][1])))
+
+    def sectionElements(self, name, mappables):
+        if name in ('nodes', 'wayNodes'):
+            for node in mappables:
+                yield self.nodeElement(node)
+
+        elif name == 'ways':
+            for way in mappables:
+                yield self.element('way', way, ',"nodes":%s' % (self.dumps(way['nd']),))
+
+        elif name == 'relations':
+            for relation in mappables:
+                members = [{'type': member['type'], 'ref': member['ref'], 'role': member['role']}
+                           for member in relation['mm']]
+                yield self.element('relation', relation, ',"members":%s' % (self.dumps(members),))
+
+    def elements(self, data):
+        # Map requests put the nodes of ways that aren't in the bbox after
+        # the ways
+        for name in ('nodes', 'ways', 'wayNodes', 'relations'):
+            for element in self.sectionElements(name, data.get(name, ())):
+                yield element
+
+    def header(self, data):
+        out = ['{"version":"0.6","generator":"%s"' % (self.GENERATOR,)]
+        if 'bounds' in data:
+            out.append(',"bounds":%s' % (self.dumps(data['bounds']),))
+        out.append(',"elements":[\n')
+        self.separator = ''
+        return ''.join(out)
+
+    def footer(self):
+        return '\n]}\n'
+
+    def section(self, name, mappables):
+        """A batch of one section's documents, for writers that get their
+        documents a batch at a time rather than from iter()"""
+        out = []
+        for element in self.sectionElements(name, mappables):
+            out.append(self.separator)
+            out.append(element)
+            self.separator = ',\n'
+        return ''.join(out)
 
     def iter(self, data):
-        from xml.dom.minidom import Document
-        doc = Document()
-
-        yield '<osm generator="%s" version="%s">\n' % ("mongosm 0.1", "0.6")
-
-        if 'bounds' in data:
-            yield '<bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n' % (
-                    str(data['bounds']['minlat']),
-                    str(data['bounds']['minlon']),
-                    str(data['bounds']['maxlat']),
-                    str(data['bounds']['maxlon']))
-
-        if 'nodes' in data:
-            for node in data['nodes']:
-                nodeElem = doc.createElement("node")
-                nodeElem.setAttribute("lat", str(node['loc'][0]))
-                nodeElem.setAttribute("lon", str(node['loc'][1]))
-                self.defaultAttrs(nodeElem, node)
-                self.tagNodes(doc, nodeElem, node)
-                yield "%s\n" % (nodeElem.toxml('UTF-8'),)
-
-        if 'ways' in data:
-            for way in data['ways']:
-                wayElem = doc.createElement("way")
-                self.defaultAttrs(wayElem, way)
-                self.tagNodes(doc, wayElem, way)
-                for ref in way['nd']:
-                    refElement = doc.createElement("nd")
-                    refElement.setAttribute("ref", str(ref))
-                    wayElem.appendChild(refElement)
-                yield "%s\n" % (wayElem.toxml('UTF-8'),)
-
-        if 'relations' in data:
-            for relation in data['relations']:
-                relationElem = doc.createElement("relation")
-                self.defaultAttrs(relationElem, relation)
-                self.tagNodes(doc, relationElem, relation)
-                for member in relation['mm']:
-                    memberElem = doc.createElement("member")
-                    memberElem.setAttribute("type", member['type'])
-                    memberElem.setAttribute("ref", str(member['ref']))
-                    memberElem.setAttribute("role", member['role'])
-                    relationElem.appendChild(memberElem)
-                yield "%s\n" % (relationElem.toxml('UTF-8'),)
-
-        yield '</osm>\n'
+        chunk = [self.header(data)]
+        size = 0
+
+        for element in self.elements(data):
+            chunk.append(self.separator)
+            chunk.append(element)
+            self.separator = ',\n'
+            size = size + len(element)
+            if size >= self.chunkSize:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+
+        chunk.append(self.footer())
+        yield ''.join(chunk)
+
+# Output formats by name: (outputter, content type)
+OUTPUTS = {'xml': (OsmXmlOutput, 'text/xml'),
+           'json': (OsmJsonOutput, 'application/json')}
 
 import time, sys
 import os
@@ -260,149 +338,197 @@ from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException, NotFound
 
-class Mongosm(object):
-    def decodePolyline(self, encoded):
-        i = 0
-        lat = 0.0
-        lon = 0.0
-        points = []
-
-        while i < len(encoded):
-            b = 0
-            shift = 0
-            result = 0
-            while True:
-                b = ord(encoded[i]) - 63
-                i = i + 1
-                result |= (b & 0x1f) << shift
-                shift = shift + 5
-                if b < 0x20:
-                    break
-            if (result & 1) > 0:
-                dlat = ~(result >> 1)
-            else:
-                dlat = (result >> 1)
-            lat = lat + dlat
-            
-            shift = 0
-            result = 0
-            while True:
-                b = ord(encoded[i]) - 63
-                i = i + 1
-                result |= (b & 0x1f) << shift
-                shift = shift + 5
-                if b < 0x20:
-                    break
-            if (result & 1) > 0:
-                dlng = ~(result >> 1)
-            else:
-                dlng = (result >> 1)
-            lon = lon + dlng
-
-            points.append([lat * 1e-5, lon * 1e-5])
-        return points
-            
-    def buildMongoQuery(self, xapiQuery):
-        q = {}
-        groups = re.findall(r'(?:\[(.*?)\])', xapiQuery)
-        for g in groups:
-            (left, right) = g.split('=')
-            if left == '@user':
-                q['user'] = right
-            elif left == '@uid':
-                q['uid'] = long(right)
-            elif left is '@changeset':
-                q['changeset'] = long(right)
-            elif left == 'bbox':
-                (minlon, minlat, maxlon, maxlat) = right.split(',')
-                bboxPolygon = [ [float(minlat),float(minlon)],
-                                [float(minlat),float(maxlon)],
-                                [float(maxlat),float(maxlon)],
-                                [float(maxlat),float(minlon)] ]
-                q['loc'] = { '$within': { '$polygon': bboxPolygon } }
-            elif left == 'poly':
-                decodedPolygon = self.decodePolyline(right)
-                q['loc'] = { '$within': { '$polygon': decodedPolygon } }
-            elif right == u'*':
-                q['tags.%s' % (left,)] = {'$exists': True}
-            else:
-                q['tags.%s' % (left,)] = right
-
-        print "Built query: %s" % (q,)
-
-        return q
+class QueryStats(object):
+    """MongoDB queries per request by endpoint, to keep an eye on how many
+    lookups a request makes. Only the queries themselves are counted, not
+    the getMore batches of their cursors."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, queries):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {'requests': 0,
+                                                         'queries': 0,
+                                                         'max_queries': 0,
+                                                         'last_queries': 0})
+            stats['requests'] = stats['requests'] + 1
+            stats['queries'] = stats['queries'] + queries
+            stats['max_queries'] = max(stats['max_queries'], queries)
+            stats['last_queries'] = queries
+
+    def stats(self):
+        with self.lock:
+            return dict((endpoint, dict(stats)) for (endpoint, stats) in self.endpoints.iteritems())
+
+def decodePolyline(encoded):
+    i = 0
+    lat = 0.0
+    lon = 0.0
+    points = []
+
+    while i < len(encoded):
+        b = 0
+        shift = 0
+        result = 0
+        while True:
+            b = ord(encoded[i]) - 63
+            i = i + 1
+            result |= (b & 0x1f) << shift
+            shift = shift + 5
+            if b < 0x20:
+                break
+        if (result & 1) > 0:
+            dlat = ~(result >> 1)
+        else:
+            dlat = (result >> 1)
+        lat = lat + dlat
+
+        shift = 0
+        result = 0
+        while True:
+            b = ord(encoded[i]) - 63
+            i = i + 1
+            result |= (b & 0x1f) << shift
+            shift = shift + 5
+            if b < 0x20:
+                break
+        if (result & 1) > 0:
+            dlng = ~(result >> 1)
+        else:
+            dlng = (result >> 1)
+        lon = lon + dlng
+
+        points.append([lat * 1e-5, lon * 1e-5])
+    return points
+
+def buildMongoQuery(xapiQuery):
+    q = {}
+    groups = re.findall(r'(?:\[(.*?)\])', xapiQuery)
+    for g in groups:
+        (left, right) = g.split('=')
+        if left == '@user':
+            q['user'] = right
+        elif left == '@uid':
+            q['uid'] = long(right)
+        elif left is '@changeset':
+            q['changeset'] = long(right)
+        elif left == 'bbox':
+            (minlon, minlat, maxlon, maxlat) = right.split(',')
+            bboxPolygon = [ [float(minlat),float(minlon)],
+                            [float(minlat),float(maxlon)],
+                            [float(maxlat),float(maxlon)],
+                            [float(maxlat),float(minlon)] ]
+            q['loc'] = { '$within': { '$polygon': bboxPolygon } }
+        elif left == 'poly':
+            decodedPolygon = decodePolyline(right)
+            q['loc'] = { '$within': { '$polygon': decodedPolygon } }
+        elif right == u'*':
+            q['tags.%s' % (left,)] = {'$exists': True}
+        else:
+            q['tags.%s' % (left,)] = right
+
+    print "Built query: %s" % (q,)
+
+    return q
+
+def outputFormat(request, value):
+    """OSM JSON is asked for with a .json suffix or an Accept header,
+    anything else gets OSM XML. Returns the format and value without
+    the suffix."""
+    if value.endswith('.json'):
+        return ('json', value[:-len('.json')])
+    if 'application/json' in request.headers.get('Accept', ''):
+        return ('json', value)
+    return ('xml', value)
 
+class Mongosm(object):
     def mapRequest(self, request):
         #(minlon, minlat, maxlon, maxlat) = request.args['bbox'].split(',')
         #bbox = [[float(minlat), float(minlon)],[float(maxlat), float(maxlon)]]
-        query = self.buildMongoQuery('[bbox=%s]' % (request.args['bbox'],))
-
-        api = OsmApi()
-        data = api.getBbox(query)
+        format = outputFormat(request, request.path)[0]
+        query = buildMongoQuery('[bbox=%s]' % (request.args['bbox'],))
 
-        outputter = OsmXmlOutput()
+        data = self.api.getBbox(query)
 
-        return Response(outputter.iter(data), content_type='text/xml', direct_passthrough=True)
+        return self.outputResponse(request, format, data)
 
     def changesetsRequest(self, request):
         return Response("<boop>%s</boop>" % (xapi_query,))
 
     def getNode(self, request, id):
-        api = OsmApi()
-        data = api.getNodeById(long(id))
+        (format, id) = outputFormat(request, id)
+        data = self.api.getNodeById(long(id))
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+        return self.outputResponse(request, format, data)
 
     def getNodeQuery(self, request, xapi_query):
-        query = self.buildMongoQuery(xapi_query)
+        (format, xapi_query) = outputFormat(request, xapi_query)
+        query = buildMongoQuery(xapi_query)
 
-        api = OsmApi()
-        data = api.getNodes(query)
+        data = self.api.getNodes(query)
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+        return self.outputResponse(request, format, data)
 
     def getWay(self, request, id):
-        api = OsmApi()
-        data = api.getWayById(long(id))
+        (format, id) = outputFormat(request, id)
+        data = self.api.getWayById(long(id))
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+        return self.outputResponse(request, format, data)
 
     def getWayQuery(self, request, xapi_query):
-        query = self.buildMongoQuery(xapi_query)
+        (format, xapi_query) = outputFormat(request, xapi_query)
+        query = buildMongoQuery(xapi_query)
 
-        api = OsmApi()
-        data = api.getWays(query)
+        data = self.api.getWays(query)
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+        return self.outputResponse(request, format, data)
 
     def getRelation(self, request, id):
-        api = OsmApi()
-        data = api.getRelationById(long(id))
+        (format, id) = outputFormat(request, id)
+        data = self.api.getRelationById(long(id))
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+        return self.outputResponse(request, format, data)
 
     def getRelationQuery(self, request, xapi_query):
-        query = self.buildMongoQuery(xapi_query)
+        (format, xapi_query) = outputFormat(request, xapi_query)
+        query = buildMongoQuery(xapi_query)
 
-        api = OsmApi()
-        data = api.getRelations(query)
+        data = self.api.getRelations(query)
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+        return self.outputResponse(request, format, data)
 
     def getPrimitiveQuery(self, request, xapi_query):
-        query = self.buildMongoQuery(xapi_query)
+        (format, xapi_query) = outputFormat(request, xapi_query)
+        query = buildMongoQuery(xapi_query)
+
+        data = self.api.getPrimitives(query)
 
-        api = OsmApi()
-        data = api.getPrimitives(query)
+        return self.outputResponse(request, format, data)
 
-        outputter = OsmXmlOutput()
-        return Response(outputter.iter(data), content_type='text/xml')
+    def outputResponse(self, request, format, data):
+        """Stream data out as it is read from the cursors"""
+        (outputClass, contentType) = OUTPUTS[format]
+        outputter = outputClass()
+        body = self.countQueries(request, outputter.iter(data))
+        return Response(body, content_type=contentType, direct_passthrough=True)
+
+    def countQueries(self, request, chunks):
+        """Pass chunks through, then record the queries it took to make
+        them (the cursors are read as the response is sent, by the thread
+        that handled the request)"""
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            queries = self.api.queryCount() - request.queriesBefore
+            self.queryStats.record(request.endpoint, queries)
+            log.info("%s took %d queries", request.endpoint, queries)
+
+    def statsRequest(self, request):
+        stats = {'queries': self.queryStats.stats(),
+                 'pool': self.api.pool.stats()}
+        return Response(json.dumps(stats), content_type='application/json')
 
     def capabilitiesRequest(self, request):
         return Response("""
@@ -413,9 +539,14 @@ class Mongosm(object):
                 </api>
             </osm>""")
 
-    def __init__(self):
+    def __init__(self, api=None):
+        if api is None:
+            api = OsmApi()
+        self.api = api
+        self.queryStats = QueryStats()
         self.url_map = Map([
             Rule('/api/0.6/map', endpoint='mapRequest'),
+            Rule('/api/0.6/map.json', endpoint='mapRequest'),
 
             Rule('/api/0.6/changesets', endpoint='changesetsRequest'),
 
@@ -430,12 +561,15 @@ class Mongosm(object):
             Rule('/api/0.6/*<xapi_query>', endpoint='getPrimitiveQuery'),
 
             Rule('/api/capabilities', endpoint='capabilitiesRequest'),
+            Rule('/api/stats', endpoint='statsRequest'),
         ])
 
     def dispatch_request(self, request):
         adapter = self.url_map.bind_to_environ(request.environ)
         try:
             endpoint, values = adapter.match()
+            request.endpoint = endpoint
+            request.queriesBefore = self.api.queryCount()
             return getattr(self, endpoint)(request, **values)
         except HTTPException, e:
             return e
@@ -449,6 +583,16 @@ class Mongosm(object):
         return self.wsgi_app(environ, start_response)
 
 if __name__ == '__main__':
-    from werkzeug.serving import run_simple
-    app = Mongosm()
-    run_simple('0.0.0.0', 5000, app, use_debugger=True, use_reloader=True)
+    from optparse import OptionParser
+    import prefork
+
+    parser = OptionParser()
+    addPoolOptions(parser)
+    prefork.addServeOptions(parser)
+    (options, args) = parser.parse_args()
+
+    def makeApp():
+        pool = openPool(options)
+        pool.warm()
+        return Mongosm(OsmApi(pool))
+    prefork.run(options, makeApp)
@@ -0,0 +1,154 @@
+"""One MongoDB client per server process, shared by every request.
+
+pymongo keeps its own pool of sockets. MongoPool sizes it from the command
+line and counts what pymongo doesn't tell us: how often requests check a
+connection out, how many are in use and how long requests wait for one."""
+
+import time
+import threading
+from itertools import islice
+from contextlib import contextmanager
+
+# Documents find() reads from the server per round trip
+BATCH_SIZE = 1000
+
+# --read-preference values and the pymongo ReadPreference they select
+READ_PREFERENCES = {'primary': 'PRIMARY',
+                    'primaryPreferred': 'PRIMARY_PREFERRED',
+                    'secondary': 'SECONDARY',
+                    'secondaryPreferred': 'SECONDARY_PREFERRED',
+                    'nearest': 'NEAREST'}
+
+class PoolTimeout(Exception):
+    pass
+
+class MongoPool(object):
+    """A MongoClient with poolSize connections. Queries go through find()
+    and findOne(), which check a connection out only while they wait on the
+    server: findOne() for its query and find() for each batch of its
+    cursor, so a response streamed to a slow client doesn't hold one.
+
+    Pass client to share an existing client (or a stand-in) instead of
+    connecting."""
+    def __init__(self, host=None, poolSize=10, connectTimeoutMs=None,
+                 socketTimeoutMs=None, waitTimeoutMs=None,
+                 readPreference='primary', client=None):
+        if client is None:
+            from pymongo import MongoClient, ReadPreference
+            client = MongoClient(host,
+                                 max_pool_size=poolSize,
+                                 connectTimeoutMS=connectTimeoutMs,
+                                 socketTimeoutMS=socketTimeoutMs,
+                                 waitQueueTimeoutMS=waitTimeoutMs,
+                                 read_preference=getattr(ReadPreference,
+                                                         READ_PREFERENCES[readPreference]))
+        self.client = client
+        self.poolSize = poolSize
+        self.readPreference = readPreference
+        self.waitTimeout = waitTimeoutMs / 1000.0 if waitTimeoutMs else None
+
+        self.condition = threading.Condition()
+        self.free = poolSize
+
+        self.stat_checkouts = 0
+        self.stat_waits = 0
+        self.stat_wait_seconds = 0.0
+        self.stat_max_wait_seconds = 0.0
+        self.stat_timeouts = 0
+        self.stat_max_in_use = 0
+
+    def acquire(self):
+        start = time.time()
+        with self.condition:
+            waited = False
+            while self.free == 0:
+                waited = True
+                remaining = None
+                if self.waitTimeout is not None:
+                    remaining = self.waitTimeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.stat_timeouts = self.stat_timeouts + 1
+                        raise PoolTimeout("No MongoDB connection free after %.1fs" % (self.waitTimeout,))
+                self.condition.wait(remaining)
+            self.free = self.free - 1
+
+            wait = time.time() - start
+            self.stat_checkouts = self.stat_checkouts + 1
+            if waited:
+                self.stat_waits = self.stat_waits + 1
+            self.stat_wait_seconds = self.stat_wait_seconds + wait
+            self.stat_max_wait_seconds = max(self.stat_max_wait_seconds, wait)
+            self.stat_max_in_use = max(self.stat_max_in_use, self.poolSize - self.free)
+
+    def release(self):
+        with self.condition:
+            self.free = self.free + 1
+            self.condition.notify()
+
+    @contextmanager
+    def checkout(self):
+        self.acquire()
+        try:
+            yield self.client
+        finally:
+            self.release()
+
+    def warm(self):
+        """Open the pool's connections before the first requests need them,
+        by pinging the server from poolSize threads at once"""
+        threads = [threading.Thread(target=self.client.admin.command, args=('ping',))
+                   for i in range(self.poolSize)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def find(self, collection, query, fields=None):
+        # Read a batch at a time, handing the connection back before
+        # yielding its documents
+        cursor = collection.find(query, fields).batch_size(BATCH_SIZE)
+        while True:
+            with self.checkout():
+                batch = list(islice(cursor, BATCH_SIZE))
+            for row in batch:
+                yield row
+            if len(batch) < BATCH_SIZE:
+                break
+
+    def findOne(self, collection, query, fields=None):
+        with self.checkout():
+            return collection.find_one(query, fields)
+
+    def stats(self):
+        with self.condition:
+            return {'pool_size': self.poolSize,
+                    'read_preference': self.readPreference,
+                    'in_use': self.poolSize - self.free,
+                    'max_in_use': self.stat_max_in_use,
+                    'checkouts': self.stat_checkouts,
+                    'waits': self.stat_waits,
+                    'wait_seconds': self.stat_wait_seconds,
+                    'max_wait_seconds': self.stat_max_wait_seconds,
+                    'timeouts': self.stat_timeouts}
+
+def addPoolOptions(parser):
+    parser.add_option("--mongo", dest="mongo", default="localhost",
+                      help="MongoDB host[:port] or URI [%default]")
+    parser.add_option("--pool-size", dest="poolSize", type="int", default=10,
+                      help="MongoDB connections shared by all requests [%default]")
+    parser.add_option("--connect-timeout-ms", dest="connectTimeoutMs", type="int",
+                      default=20000, help="connection timeout [%default]")
+    parser.add_option("--socket-timeout-ms", dest="socketTimeoutMs", type="int",
+                      default=None, help="timeout for each query's replies (none by default)")
+    parser.add_option("--wait-timeout-ms", dest="waitTimeoutMs", type="int",
+                      default=None, help="how long a request waits for a free "
+                                         "connection before failing (forever by default)")
+    parser.add_option("--read-preference", dest="readPreference", default="primary",
+                      choices=sorted(READ_PREFERENCES.keys()),
+                      help="which replica set members to read from [%default]")
+
+def openPool(options):
+    """The MongoPool selected by the addPoolOptions() options"""
+    return MongoPool(options.mongo, options.poolSize, options.connectTimeoutMs,
+                     options.socketTimeoutMs, options.waitTimeoutMs,
+                     options.readPreference)
@@ -0,0 +1,310 @@
+"""Local node location stores used to build way geometries without
+querying MongoDB for every way.
+
+Coordinates are kept as fixed-point integers at 1e-7 degree precision,
+which is the precision OSM itself uses, so a location read back from a
+store is the same float that was parsed out of the OSM file.
+
+The key stores do the same job for the tiled importer, which only needs
+each node's integer quadkey."""
+
+import os
+import mmap
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+
+COORD_SCALE = 10000000
+
+# Latitudes are stored offset by 90 degrees and then by one more unit so
+# that a zero in the dense store always means "no node here".
+LAT_OFFSET = 90 * COORD_SCALE + 1
+LON_OFFSET = 180 * COORD_SCALE
+
+def toFixed(deg):
+    """Convert a coordinate in degrees to a fixed-point integer"""
+    return int(round(deg * COORD_SCALE))
+
+def fromFixed(fixed):
+    """Convert a fixed-point integer back to degrees"""
+    return fixed / float(COORD_SCALE)
+
+class SparseNodeStore(object):
+    """Node locations kept in three parallel arrays sorted by node id.
+
+    Good for extracts, where node ids are spread far too thinly over the
+    id space for a dense array to make sense. Lookups are a binary search."""
+    def __init__(self):
+        self.ids = array('l')
+        self.lats = array('i')
+        self.lons = array('i')
+        self.sorted = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def set(self, id, lat, lon):
+        if self.ids and id <= self.ids[-1]:
+            self.sorted = False
+        self.ids.append(id)
+        self.lats.append(toFixed(lat))
+        self.lons.append(toFixed(lon))
+
+    def sort(self):
+        """Put the arrays back in id order if nodes arrived unsorted"""
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('l', (self.ids[i] for i in order))
+        self.lats = array('i', (self.lats[i] for i in order))
+        self.lons = array('i', (self.lons[i] for i in order))
+        self.sorted = True
+
+    def get(self, id):
+        """Return [lat, lon] for a node id or None if it isn't stored"""
+        if not self.sorted:
+            self.sort()
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return [fromFixed(self.lats[i]), fromFixed(self.lons[i])]
+        return None
+
+    def close(self):
+        pass
+
+class DenseNodeStore(object):
+    """Node locations in a memory-mapped file indexed directly by node id.
+
+    Every node takes 8 bytes at offset id * 8 whether it exists or not, so
+    this only pays off for planet-sized imports. The file is created
+    sparse and grown in large steps as higher node ids show up.
+
+    An existing file is emptied unless keep is set (to resume an import),
+    so that nodes missing from a new import aren't found in an old one."""
+    RECORD = struct.Struct('<II')
+    GROW_BY = 64 * 1024 * 1024
+
+    def __init__(self, filename, keep=False):
+        self.filename = filename
+        self.count = 0
+        flags = os.O_RDWR | os.O_CREAT
+        if not keep:
+            flags = flags | os.O_TRUNC
+        self.fd = os.open(filename, flags)
+        self.size = os.fstat(self.fd).st_size
+        if self.size < self.GROW_BY:
+            self.size = self.GROW_BY
+            os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def __len__(self):
+        return self.count
+
+    def grow(self, needed):
+        size = self.size
+        while size < needed:
+            size = size + self.GROW_BY
+        self.map.close()
+        os.ftruncate(self.fd, size)
+        self.size = size
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def set(self, id, lat, lon):
+        offset = id * self.RECORD.size
+        if offset + self.RECORD.size > self.size:
+            self.grow(offset + self.RECORD.size)
+        self.RECORD.pack_into(self.map, offset,
+                              toFixed(lat) + LAT_OFFSET,
+                              toFixed(lon) + LON_OFFSET)
+        self.count = self.count + 1
+
+    def get(self, id):
+        """Return [lat, lon] for a node id or None if it isn't stored"""
+        offset = id * self.RECORD.size
+        if id < 0 or offset + self.RECORD.size > self.size:
+            return None
+        (lat, lon) = self.RECORD.unpack_from(self.map, offset)
+        if lat == 0:
+            return None
+        return [fromFixed(lat - LAT_OFFSET), fromFixed(lon - LON_OFFSET)]
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+def openNodeStore(kind, filename=None, keep=False):
+    """Create the node store selected on the command line. keep reuses the
+    locations already in a dense store's file."""
+    if kind == 'dense':
+        if not filename:
+            filename = 'nodes.cache'
+        return DenseNodeStore(filename, keep)
+    elif kind == 'sparse':
+        return SparseNodeStore()
+    return None
+
+class SparseKeyStore(object):
+    """Node quadkeys kept in two parallel arrays sorted by node id, 16
+    bytes per node.
+
+    Once the arrays reach memoryBudget bytes they are sorted and appended
+    to a temporary file as a run, which is memory-mapped and binary
+    searched, so the page cache rather than the process holds them. Input
+    sorted by id (as OSM files are) makes runs that don't overlap, and a
+    lookup then only searches one."""
+    RECORD = struct.Struct('<qq')
+
+    def __init__(self, memoryBudget=None, tempDir=None):
+        self.memoryBudget = memoryBudget
+        self.tempDir = tempDir
+        self.ids = array('l')
+        self.keys = array('l')
+        self.sorted = True
+        self.count = 0
+        self.file = None
+        self.map = None
+        # (first record, record count, lowest id, highest id) of each run
+        self.runs = []
+
+    def __len__(self):
+        return self.count
+
+    def set(self, id, key):
+        if self.ids and id <= self.ids[-1]:
+            self.sorted = False
+        self.ids.append(id)
+        self.keys.append(key)
+        self.count = self.count + 1
+        if self.memoryBudget and len(self.ids) * self.RECORD.size >= self.memoryBudget:
+            self.spill()
+
+    def sort(self):
+        """Put the arrays back in id order if nodes arrived unsorted"""
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.ids = array('l', (self.ids[i] for i in order))
+        self.keys = array('l', (self.keys[i] for i in order))
+        self.sorted = True
+
+    def spill(self):
+        """Move the in-memory arrays to a new run on disk"""
+        if not self.sorted:
+            self.sort()
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.tempDir)
+        self.file.seek(0, os.SEEK_END)
+        first = self.file.tell() / self.RECORD.size
+        pairs = array('l', [0]) * (2 * len(self.ids))
+        pairs[0::2] = self.ids
+        pairs[1::2] = self.keys
+        pairs.tofile(self.file)
+        self.file.flush()
+        self.runs.append((first, len(self.ids), self.ids[0], self.ids[-1]))
+
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ids = array('l')
+        self.keys = array('l')
+
+    def searchRun(self, first, count, id):
+        lo = first
+        hi = first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (midId, key) = self.RECORD.unpack_from(self.map, mid * self.RECORD.size)
+            if midId < id:
+                lo = mid + 1
+            elif midId > id:
+                hi = mid
+            else:
+                return key
+        return None
+
+    def get(self, id):
+        """Return the quadkey of a node id or None if it isn't stored"""
+        if not self.sorted:
+            self.sort()
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return self.keys[i]
+        for (first, count, lowest, highest) in reversed(self.runs):
+            if lowest <= id <= highest:
+                key = self.searchRun(first, count, id)
+                if key is not None:
+                    return key
+        return None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class DenseKeyStore(DenseNodeStore):
+    """Node quadkeys in a memory-mapped file indexed directly by node id,
+    8 bytes per id. Keys are stored plus one so that zero means "no node
+    here"."""
+    RECORD = struct.Struct('<Q')
+
+    def set(self, id, key):
+        offset = id * self.RECORD.size
+        if offset + self.RECORD.size > self.size:
+            self.grow(offset + self.RECORD.size)
+        self.RECORD.pack_into(self.map, offset, key + 1)
+        self.count = self.count + 1
+
+    def get(self, id):
+        """Return the quadkey of a node id or None if it isn't stored"""
+        offset = id * self.RECORD.size
+        if id < 0 or offset + self.RECORD.size > self.size:
+            return None
+        (key,) = self.RECORD.unpack_from(self.map, offset)
+        if key == 0:
+            return None
+        return key - 1
+
+def openKeyStore(kind, filename=None, memoryBudget=None):
+    """Create the quadkey store selected on the tiled importer's command line"""
+    if kind == 'dense':
+        if not filename:
+            filename = 'nodekeys.cache'
+        return DenseKeyStore(filename)
+    return SparseKeyStore(memoryBudget)
+
+class IdSet(object):
+    """A set of ids in one sorted array, 8 bytes per id. Adding is an
+    append; the array is sorted (and duplicates dropped) the first time
+    it's searched or iterated after that."""
+    def __init__(self):
+        self.ids = array('l')
+        self.sorted = True
+
+    def __len__(self):
+        if not self.sorted:
+            self.sort()
+        return len(self.ids)
+
+    def add(self, id):
+        if self.ids and id <= self.ids[-1]:
+            self.sorted = False
+        self.ids.append(id)
+
+    def sort(self):
+        ids = array('l')
+        for id in sorted(self.ids):
+            if not ids or id != ids[-1]:
+                ids.append(id)
+        self.ids = ids
+        self.sorted = True
+
+    def __contains__(self, id):
+        if not self.sorted:
+            self.sort()
+        i = bisect_left(self.ids, id)
+        return i < len(self.ids) and self.ids[i] == id
+
+    def __iter__(self):
+        if not self.sorted:
+            self.sort()
+        return iter(self.ids)
@@ -0,0 +1,350 @@
+"""Reads OSM PBF files (http://wiki.openstreetmap.org/wiki/PBF_Format)
+without any protobuf dependency.
+
+The file is a sequence of independently zlib-compressed blobs, so blobs
+are handed to a process pool and decoded in parallel. Elements come out
+in file order as the same (name, attrs, tags, children) tuples that
+insert_osm_data.OsmXmlReader produces for XML."""
+
+import time
+import zlib
+import struct
+import multiprocessing
+from collections import deque
+
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes'])
+MEMBER_TYPES = ['node', 'way', 'relation']
+
+def readVarint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos = pos + 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (result, pos)
+        shift = shift + 7
+
+def iterFields(buf):
+    """Yield (field number, value) for every field of a protobuf message.
+    Length-delimited values are returned as strings."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        (key, pos) = readVarint(buf, pos)
+        wireType = key & 0x7
+        if wireType == 0:
+            (value, pos) = readVarint(buf, pos)
+        elif wireType == 2:
+            (length, pos) = readVarint(buf, pos)
+            value = buf[pos:pos + length]
+            pos = pos + length
+        elif wireType == 1:
+            value = buf[pos:pos + 8]
+            pos = pos + 8
+        elif wireType == 5:
+            value = buf[pos:pos + 4]
+            pos = pos + 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % (wireType,))
+        yield (key >> 3, value)
+
+def signed(value):
+    """Reinterpret a varint as a two's complement int64"""
+    if value >= 1 << 63:
+        value = value - (1 << 64)
+    return value
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def unpackVarints(buf):
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = ord(buf[pos])
+            pos = pos + 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift = shift + 7
+        append(result)
+    return values
+
+def unpackDeltas(buf):
+    """Decode a packed, zigzag and delta encoded sint64 array"""
+    values = unpackVarints(buf)
+    total = 0L
+    for (i, value) in enumerate(values):
+        total = total + ((value >> 1) ^ -(value & 1))
+        values[i] = total
+    return values
+
+def isoTime(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+class PrimitiveBlock(object):
+    """Decodes one PrimitiveBlock into OSM elements"""
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.latOffset = 0
+        self.lonOffset = 0
+        self.dateGranularity = 1000
+        for (field, value) in iterFields(data):
+            if field == 1:
+                self.strings = [s.decode('utf-8') for (f, s) in iterFields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.dateGranularity = value
+            elif field == 19:
+                self.latOffset = signed(value)
+            elif field == 20:
+                self.lonOffset = signed(value)
+
+    def coord(self, offset, value):
+        # Nanodegrees are exact integers, so a single division gives the
+        # same float as parsing the decimal string in an XML file.
+        return (offset + self.granularity * value) / 1e9
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for (k, v) in zip(keys, vals)]
+
+    def info(self, attrs, version, timestamp, changeset, uid, userSid):
+        attrs['version'] = version
+        attrs['timestamp'] = isoTime(timestamp * self.dateGranularity / 1000)
+        attrs['changeset'] = changeset
+        user = self.strings[userSid]
+        if user:
+            attrs['user'] = user
+            attrs['uid'] = uid
+
+    def parseInfo(self, attrs, data):
+        values = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+        for (field, value) in iterFields(data):
+            if field in values:
+                values[field] = value
+        self.info(attrs, values[1], signed(values[2]), signed(values[3]),
+                  signed(values[4]), values[5])
+
+    def elements(self):
+        elements = []
+        for group in self.groups:
+            for (field, value) in iterFields(group):
+                if field == 1:
+                    elements.append(self.node(value))
+                elif field == 2:
+                    elements.extend(self.denseNodes(value))
+                elif field == 3:
+                    elements.append(self.way(value))
+                elif field == 4:
+                    elements.append(self.relation(value))
+        return elements
+
+    def node(self, data):
+        attrs = {}
+        keys = vals = []
+        lat = lon = 0
+        for (field, value) in iterFields(data):
+            if field == 1:
+                attrs['id'] = zigzag(value)
+            elif field == 2:
+                keys = unpackVarints(value)
+            elif field == 3:
+                vals = unpackVarints(value)
+            elif field == 4:
+                self.parseInfo(attrs, value)
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        loc = [self.coord(self.latOffset, lat), self.coord(self.lonOffset, lon)]
+        attrs['lat'] = loc[0]
+        attrs['lon'] = loc[1]
+        return ('node', attrs, self.tags(keys, vals), loc)
+
+    def denseNodes(self, data):
+        ids = lats = lons = keysVals = []
+        info = {}
+        for (field, value) in iterFields(data):
+            if field == 1:
+                ids = unpackDeltas(value)
+            elif field == 5:
+                for (infoField, infoValue) in iterFields(value):
+                    if infoField == 1:
+                        info['version'] = unpackVarints(infoValue)
+                    elif infoField in (2, 3, 4, 5):
+                        info[infoField] = unpackDeltas(infoValue)
+            elif field == 8:
+                lats = unpackDeltas(value)
+            elif field == 9:
+                lons = unpackDeltas(value)
+            elif field == 10:
+                keysVals = unpackVarints(value)
+
+        strings = self.strings
+        elements = []
+        kv = 0
+        for i in xrange(len(ids)):
+            loc = [self.coord(self.latOffset, lats[i]), self.coord(self.lonOffset, lons[i])]
+            attrs = {'id': ids[i], 'lat': loc[0], 'lon': loc[1]}
+            if info:
+                self.info(attrs, info['version'][i], info[2][i], info[3][i],
+                          info[4][i], info[5][i])
+            tags = []
+            while kv < len(keysVals) and keysVals[kv] != 0:
+                tags.append((strings[keysVals[kv]], strings[keysVals[kv + 1]]))
+                kv = kv + 2
+            kv = kv + 1
+            elements.append(('node', attrs, tags, loc))
+        return elements
+
+    def way(self, data):
+        attrs = {}
+        keys = vals = refs = []
+        for (field, value) in iterFields(data):
+            if field == 1:
+                attrs['id'] = signed(value)
+            elif field == 2:
+                keys = unpackVarints(value)
+            elif field == 3:
+                vals = unpackVarints(value)
+            elif field == 4:
+                self.parseInfo(attrs, value)
+            elif field == 8:
+                refs = unpackDeltas(value)
+        return ('way', attrs, self.tags(keys, vals), refs)
+
+    def relation(self, data):
+        attrs = {}
+        keys = vals = roles = memids = types = []
+        for (field, value) in iterFields(data):
+            if field == 1:
+                attrs['id'] = signed(value)
+            elif field == 2:
+                keys = unpackVarints(value)
+            elif field == 3:
+                vals = unpackVarints(value)
+            elif field == 4:
+                self.parseInfo(attrs, value)
+            elif field == 8:
+                roles = unpackVarints(value)
+            elif field == 9:
+                memids = unpackDeltas(value)
+            elif field == 10:
+                types = unpackVarints(value)
+        members = [dict(type=MEMBER_TYPES[types[i]],
+                        ref=memids[i],
+                        role=self.strings[roles[i]])
+                   for i in xrange(len(memids))]
+        return ('relation', attrs, self.tags(keys, vals), members)
+
+def iterBlobs(file_obj):
+    """Yield (offset, type, blob) for every fileblock in a PBF file"""
+    while True:
+        offset = file_obj.tell()
+        data = file_obj.read(4)
+        if len(data) < 4:
+            break
+        (length,) = struct.unpack('!I', data)
+        blobType = None
+        dataSize = 0
+        for (field, value) in iterFields(file_obj.read(length)):
+            if field == 1:
+                blobType = value
+            elif field == 3:
+                dataSize = value
+        yield (offset, blobType, file_obj.read(dataSize))
+
+def blobData(blob):
+    for (field, value) in iterFields(blob):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+        elif field == 4:
+            raise ValueError("LZMA compressed PBF blobs are not supported")
+    return ''
+
+def decodeBlob(blobType, blob):
+    """Decode one fileblock into a list of elements"""
+    data = blobData(blob)
+    if blobType == 'OSMHeader':
+        for (field, value) in iterFields(data):
+            if field == 4 and value not in SUPPORTED_FEATURES:
+                raise ValueError("PBF file requires unsupported feature %s" % (value,))
+        return []
+    elif blobType == 'OSMData':
+        return PrimitiveBlock(data).elements()
+    return []
+
+class OsmPbfReader(object):
+    """Yields the elements of a PBF file, decoding blobs in a pool of
+    processes. At most a couple of blobs per decoder are in flight so
+    memory stays bounded however big the file is.
+
+    offset is the start of the fileblock holding the element most recently
+    yielded, so reading again from there gets it and everything after it."""
+    def __init__(self, file_obj, decoders=None, offset=0):
+        if decoders is None:
+            decoders = multiprocessing.cpu_count()
+        self.file_obj = file_obj
+        self.decoders = decoders
+        self.offset = offset
+        if offset > 0:
+            file_obj.seek(offset)
+
+    def __iter__(self):
+        if self.decoders <= 1:
+            for (offset, blobType, blob) in iterBlobs(self.file_obj):
+                self.offset = offset
+                for element in decodeBlob(blobType, blob):
+                    yield element
+            return
+
+        pool = multiprocessing.Pool(self.decoders)
+        pending = deque()
+        try:
+            for (offset, blobType, blob) in iterBlobs(self.file_obj):
+                pending.append((offset, pool.apply_async(decodeBlob, (blobType, blob))))
+                if len(pending) >= self.decoders * 2:
+                    (self.offset, result) = pending.popleft()
+                    for element in result.get():
+                        yield element
+            while pending:
+                (self.offset, result) = pending.popleft()
+                for element in result.get():
+                    yield element
+        finally:
+            pool.terminate()
+
+def feedHandler(handler, elements):
+    """Replay elements as SAX events on an xml.sax ContentHandler so that
+    SAX based importers can read PBF files too"""
+    handler.startDocument()
+    for (name, attrs, tags, children) in elements:
+        handler.startElement(name, attrs)
+        for (k, v) in tags:
+            handler.startElement('tag', {'k': k, 'v': v})
+            handler.endElement('tag')
+        if name == 'way':
+            for ref in children:
+                handler.startElement('nd', {'ref': ref})
+                handler.endElement('nd')
+        elif name == 'relation':
+            for member in children:
+                handler.startElement('member', member)
+                handler.endElement('member')
+        handler.endElement(name)
+    handler.endDocument()
@@ -0,0 +1,179 @@
+"""Writes OSM XML for the servers without building a DOM.
+
+Elements are written straight into a reusable buffer using attribute
+templates worked out once per output, and the buffer is handed out in
+chunks of about chunkSize bytes. The output is byte for byte what the
+minidom-based outputs used to produce: attributes in name order, the same
+escaping, and one element per line."""
+
+import re
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+DEFAULT_CHUNK_BYTES = 64 * 1024
+
+SPECIAL = re.compile('[&<>"]')
+
+def escapeAttr(value):
+    """Escape an attribute value the way minidom does"""
+    if SPECIAL.search(value) is None:
+        return value
+    return value.replace("&", "&amp;").replace("<", "&lt;") \
+                .replace("\"", "&quot;").replace(">", "&gt;")
+
+def escapeDefault(value):
+    """The id, version, user and timestamp attributes were escaped by
+    saxutils before minidom escaped them again. Keep doing both so the
+    output doesn't change."""
+    value = unicode(value)
+    if SPECIAL.search(value) is None:
+        return value
+    return escapeAttr(escape(value))
+
+class OsmXmlWriter(object):
+    """Subclasses describe their schema with the class attributes below
+    and coordinates() and items()."""
+    GENERATOR = "mongosm 0.1"
+    # (document field, attribute) pairs written on every element
+    ATTRS = (('_id', 'id'), ('v', 'version'), ('un', 'user'), ('ts', 'timestamp'))
+    TAGS = 'tg'
+    REFS = 'nd'
+    MEMBERS = 'mm'
+    # Sections of data in the order they're written. Map requests put the
+    # nodes of ways that aren't in the bbox after the ways.
+    SECTIONS = (('nodes', 'writeNode'),
+                ('ways', 'writeWay'),
+                ('wayNodes', 'writeNode'),
+                ('relations', 'writeRelation'))
+
+    def __init__(self, chunkSize=DEFAULT_CHUNK_BYTES):
+        self.chunkSize = chunkSize
+
+        # minidom writes attributes sorted by name, so nodes get theirs
+        # split around lat and lon
+        attrs = sorted((name, ' %s="' % name, field) for (field, name) in self.ATTRS)
+        self.attrs = [(prefix, field) for (name, prefix, field) in attrs]
+        self.nodeAttrsBefore = [(prefix, field) for (name, prefix, field) in attrs if name < 'lat']
+        self.nodeAttrsAfter = [(prefix, field) for (name, prefix, field) in attrs if name > 'lon']
+
+    def coordinates(self, node):
+        """(lat, lon) of a node document"""
+        return node['loc']
+
+    def items(self, data, name):
+        """The documents in one of data's sections (nodes, ways...)"""
+        return data.get(name, ())
+
+    def writeAttrs(self, out, mappable, template):
+        for (prefix, field) in template:
+            if field in mappable:
+                out.append(prefix)
+                out.append(escapeDefault(mappable[field]))
+                out.append('"')
+
+    def writeTags(self, out, mappable):
+        for (k, v) in mappable.get(self.TAGS, ()):
+            out.append('<tag k="')
+            out.append(escapeAttr(k))
+            out.append('" v="')
+            out.append(escapeAttr(v))
+            out.append('"/>')
+
+    def header(self, data):
+        out = ['<osm generator="%s" version="%s">\n' % (self.GENERATOR, "0.6")]
+        if 'bounds' in data:
+            out.append('<bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n' % (
+                    str(data['bounds']['minlat']),
+                    str(data['bounds']['minlon']),
+                    str(data['bounds']['maxlat']),
+                    str(data['bounds']['maxlon'])))
+        return ''.join(out)
+
+    def footer(self):
+        return '</osm>\n'
+
+    def section(self, name, mappables):
+        """A batch of one section's documents, for writers that get their
+        documents a batch at a time rather than from iter()"""
+        write = getattr(self, dict(self.SECTIONS)[name])
+        out = []
+        for mappable in mappables:
+            write(out, mappable)
+        element = ''.join(out)
+        if isinstance(element, unicode):
+            element = element.encode('utf-8')
+        return element
+
+    def iter(self, data):
+        buf = StringIO()
+        out = []
+
+        buf.write(self.header(data))
+
+        for (name, write) in self.SECTIONS:
+            write = getattr(self, write)
+            for mappable in self.items(data, name):
+                write(out, mappable)
+                for chunk in self.flush(buf, out):
+                    yield chunk
+
+        buf.write(self.footer())
+        yield buf.getvalue()
+
+    def writeNode(self, out, node):
+        (lat, lon) = self.coordinates(node)
+        out.append('<node')
+        self.writeAttrs(out, node, self.nodeAttrsBefore)
+        out.append(' lat="%s" lon="%s"' % (str(lat), str(lon)))
+        self.writeAttrs(out, node, self.nodeAttrsAfter)
+        if node.get(self.TAGS):
+            out.append('>')
+            self.writeTags(out, node)
+            out.append('</node>\n')
+        else:
+            out.append('/>\n')
+
+    def writeWay(self, out, way):
+        out.append('<way')
+        self.writeAttrs(out, way, self.attrs)
+        if way.get(self.TAGS) or way[self.REFS]:
+            out.append('>')
+            self.writeTags(out, way)
+            for ref in way[self.REFS]:
+                out.append('<nd ref="%s"/>' % (str(ref),))
+            out.append('</way>\n')
+        else:
+            out.append('/>\n')
+
+    def writeRelation(self, out, relation):
+        out.append('<relation')
+        self.writeAttrs(out, relation, self.attrs)
+        if relation.get(self.TAGS) or relation[self.MEMBERS]:
+            out.append('>')
+            self.writeTags(out, relation)
+            for member in relation[self.MEMBERS]:
+                out.append('<member ref="')
+                out.append(str(member['ref']))
+                out.append('" role="')
+                out.append(escapeAttr(member['role']))
+                out.append('" type="')
+                out.append(escapeAttr(member['type']))
+                out.append('"/>')
+            out.append('</relation>\n')
+        else:
+            out.append('/>\n')
+
+    def flush(self, buf, out):
+        """Move one element's pieces into the buffer, and hand the buffer
+        out once it holds a full chunk"""
+        element = ''.join(out)
+        del out[:]
+        if isinstance(element, unicode):
+            element = element.encode('utf-8')
+        buf.write(element)
+        if buf.tell() >= self.chunkSize:
+            chunk = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return (chunk,)
+        return ()
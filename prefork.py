@@ -0,0 +1,260 @@
+"""Pre-forking WSGI server for running the servers in production.
+
+The parent process binds the listening socket and forks workers, which all
+accept from it. Each worker builds its own app (and with it its own
+MongoDB pool, since pymongo clients don't survive a fork) and serves
+requests from up to `threads` threads at once. The parent replaces workers
+that die, and on SIGTERM or SIGINT it asks them to finish the requests
+they are serving and exit."""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+class TimeLimit(object):
+    """WSGI middleware that gives up on responses taking longer than
+    seconds. A streaming response that runs over is cut off: its 200 has
+    already gone out, so the client gets a truncated XML or JSON body.
+
+    The limit is cooperative: it is checked between chunks, so a query or
+    a wait for a connection that is under way isn't interrupted. run()
+    bounds those with the MongoDB socket and pool wait timeouts; an error
+    raised once the deadline has passed is answered with a 504 if nothing
+    has been sent yet. Once the deadline has passed, one more chunk is
+    asked for to tell a response that is complete from one that isn't,
+    and only the latter is logged as timed out."""
+    def __init__(self, app, seconds):
+        self.app = app
+        self.seconds = seconds
+
+    def __call__(self, environ, start_response):
+        deadline = time.time() + self.seconds
+        started = []
+        def delayStart(status, headers, exc_info=None):
+            started.append((status, headers, exc_info))
+        try:
+            result = self.app(environ, delayStart)
+        except Exception:
+            if time.time() < deadline:
+                raise
+            return self.timedOut(environ, start_response, False)
+        return self.limit(environ, start_response, result, started, deadline)
+
+    def limit(self, environ, start_response, result, started, deadline):
+        chunks = iter(result)
+        try:
+            sent = False
+            while True:
+                overdue = sent and time.time() > deadline
+                try:
+                    chunk = chunks.next()
+                except StopIteration:
+                    break
+                except Exception:
+                    if time.time() < deadline:
+                        raise
+                    for chunk in self.timedOut(environ, start_response, sent):
+                        yield chunk
+                    return
+                if overdue:
+                    # Drop the chunk and end the response short
+                    self.timedOut(environ, start_response, sent)
+                    return
+                if not sent:
+                    start_response(*started[0])
+                    sent = True
+                yield chunk
+            if not sent:
+                start_response(*started[0])
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    def timedOut(self, environ, start_response, sent):
+        """Log a timeout; the chunks to finish the response with"""
+        sys.stderr.write("Request for %s timed out after %ds\n" % (
+            environ.get('PATH_INFO'), self.seconds))
+        if sent:
+            return []
+        start_response('504 Gateway Timeout', [('Content-Type', 'text/plain')])
+        return ['Request timed out\n']
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    """Serves each connection from its own thread, at most threads at a
+    time"""
+    daemon_threads = True
+
+    def __init__(self, listener, threads, handler):
+        WSGIServer.__init__(self, listener.getsockname(), handler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        (host, port) = listener.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.slots = threading.Semaphore(threads)
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        with self.lock:
+            self.active = self.active + 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.lock:
+                self.active = self.active - 1
+            self.slots.release()
+
+    def server_close(self):
+        # The listening socket belongs to the parent
+        pass
+
+def runWorker(listener, makeApp, threads, timeout, grace, accessLog):
+    stopping = threading.Event()
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    app = makeApp()
+    if timeout:
+        app = TimeLimit(app, timeout)
+    server = ThreadedWSGIServer(listener, threads,
+                                WSGIRequestHandler if accessLog else QuietHandler)
+    server.set_app(app)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # Waiting with a timeout lets the signal handlers run
+    while not stopping.is_set():
+        stopping.wait(1)
+
+    server.shutdown()
+    listener.close()
+    end = time.time() + grace
+    while server.active > 0 and time.time() < end:
+        time.sleep(0.1)
+    if server.active > 0:
+        sys.stderr.write("Worker %d exiting with %d requests unfinished\n" % (os.getpid(), server.active))
+
+def serve(makeApp, host='0.0.0.0', port=5000, workers=4, threads=10,
+          timeout=None, grace=30, accessLog=True):
+    """Serve the app made by makeApp() in each of workers processes until
+    SIGTERM or SIGINT"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+
+    children = set()
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                runWorker(listener, makeApp, threads, timeout, grace, accessLog)
+            except:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stderr.flush()
+                os._exit(status)
+        children.add(pid)
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(workers):
+        spawn()
+    print "Serving on http://%s:%d/ with %d workers of %d threads." % (host, port, workers, threads)
+    sys.stdout.flush()
+
+    signalled = False
+    deadline = None
+    while children:
+        if stopping and not signalled:
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+            signalled = True
+            deadline = time.time() + grace + 5
+        if deadline is not None and time.time() > deadline:
+            for pid in children:
+                os.kill(pid, signal.SIGKILL)
+            deadline = None
+
+        try:
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        children.discard(pid)
+        if not stopping:
+            sys.stderr.write("Worker %d died (status %d), starting another\n" % (pid, status))
+            time.sleep(1)
+            spawn()
+
+    listener.close()
+
+def addServeOptions(parser):
+    parser.add_option("--host", dest="host", default="0.0.0.0",
+                      help="address to listen on [%default]")
+    parser.add_option("--port", dest="port", type="int", default=5000,
+                      help="port to listen on [%default]")
+    parser.add_option("--workers", dest="workers", type="int", default=0,
+                      help="serve from this many pre-forked worker processes; 0 "
+                           "runs the single-process Werkzeug development server "
+                           "[%default]")
+    parser.add_option("--threads", dest="threads", type="int", default=None,
+                      help="requests each worker serves at once [--pool-size]")
+    parser.add_option("--request-timeout", dest="requestTimeout", type="int",
+                      default=None, help="seconds before a request is given up "
+                                         "on between chunks of its response (a "
+                                         "streamed one then ends early: a 200 with "
+                                         "a truncated body), which is also the "
+                                         "MongoDB socket and pool wait timeout "
+                                         "unless --socket-timeout-ms or "
+                                         "--wait-timeout-ms is given (none by default)")
+    parser.add_option("--no-access-log", dest="accessLog", action="store_false",
+                      default=True, help="don't log every request")
+
+def run(options, makeApp):
+    """Serve the app made by makeApp() the way the addServeOptions() (and
+    mongopool.addPoolOptions()) options ask"""
+    logging.basicConfig(format='%(message)s',
+                        level=logging.INFO if options.accessLog else logging.WARNING)
+    if options.requestTimeout and getattr(options, 'socketTimeoutMs', 0) is None:
+        options.socketTimeoutMs = options.requestTimeout * 1000
+    if options.requestTimeout and getattr(options, 'waitTimeoutMs', 0) is None:
+        options.waitTimeoutMs = options.requestTimeout * 1000
+    if options.workers > 0:
+        serve(makeApp, options.host, options.port, options.workers,
+              options.threads or getattr(options, 'poolSize', 10),
+              options.requestTimeout, accessLog=options.accessLog)
+    else:
+        from werkzeug.serving import run_simple
+        run_simple(options.host, options.port, makeApp(), use_debugger=True, use_reloader=True)
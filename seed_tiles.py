@@ -0,0 +1,115 @@
+"""Pre-renders the tiles covering a bounding box over a range of zooms
+into a tile store that tile_server.py serves before rendering anything
+itself (with --store)."""
+
+import sys
+import time
+import multiprocessing
+from optparse import OptionParser
+
+from globalmaptiles import GlobalMercator
+from tile_server import OsmApi, OsmXmlOutput
+from tilestore import TileStore, gzipBytes
+
+# Tiles written to the store per transaction
+COMMIT_EVERY = 200
+
+def tilesInBbox(minlon, minlat, maxlon, maxlat, zoom):
+    """Google (zoom, x, y) of every tile at zoom touching the bbox"""
+    proj = GlobalMercator()
+    last = 2**zoom - 1
+    (mx, my) = proj.LatLonToMeters(minlat, minlon)
+    (minX, minY) = proj.MetersToTile(mx, my, zoom)
+    (mx, my) = proj.LatLonToMeters(maxlat, maxlon)
+    (maxX, maxY) = proj.MetersToTile(mx, my, zoom)
+    for tx in xrange(max(minX, 0), min(maxX, last) + 1):
+        for ty in xrange(max(minY, 0), min(maxY, last) + 1):
+            (x, y) = proj.GoogleTile(tx, ty, zoom)
+            yield (zoom, x, y)
+
+api = None
+
+def startWorker():
+    global api
+    api = OsmApi()
+
+def renderTile(tile):
+    """Worker process: render one tile to a gzipped body"""
+    (zoom, x, y) = tile
+    data = api.getTile(zoom, x, y)
+    return (zoom, x, y, gzipBytes(''.join(OsmXmlOutput().iter(data))))
+
+class SeedProgress(object):
+    def __init__(self, total, store):
+        self.total = total
+        self.store = store
+        self.done = 0
+        self.start = time.time()
+        self.lastReport = 0
+        self.lastStatString = ""
+
+    def add(self, count):
+        self.done = self.done + count
+        if time.time() - self.lastReport > 2:
+            self.report()
+
+    def report(self):
+        for char in self.lastStatString:
+            sys.stdout.write('\b')
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        self.lastStatString = "%d/%d tiles, %.1f tiles/s, store %dMB" % (
+            self.done, self.total, rate, self.store.size() / 1024 / 1024)
+        sys.stdout.write(self.lastStatString)
+        sys.stdout.flush()
+        self.lastReport = time.time()
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] <tile store>")
+    parser.add_option("--bbox", dest="bbox",
+                      help="minlon,minlat,maxlon,maxlat of the area to seed")
+    parser.add_option("--min-zoom", dest="minZoom", type="int", default=12,
+                      help="lowest zoom to render [%default]")
+    parser.add_option("--max-zoom", dest="maxZoom", type="int", default=16,
+                      help="highest zoom to render [%default]")
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=multiprocessing.cpu_count(),
+                      help="processes rendering tiles [%default]")
+    parser.add_option("--skip-existing", dest="skipExisting",
+                      action="store_true", default=False,
+                      help="don't render tiles the store already has")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or not options.bbox:
+        parser.print_usage()
+        sys.exit(-1)
+
+    (minlon, minlat, maxlon, maxlat) = [float(v) for v in options.bbox.split(',')]
+    store = TileStore(args[0])
+    tiles = []
+    for zoom in range(options.minZoom, options.maxZoom + 1):
+        for tile in tilesInBbox(minlon, minlat, maxlon, maxlat, zoom):
+            if not (options.skipExisting and store.has(*tile)):
+                tiles.append(tile)
+    print "Seeding %d tiles at zooms %d-%d." % (len(tiles), options.minZoom, options.maxZoom)
+
+    progress = SeedProgress(len(tiles), store)
+    pool = multiprocessing.Pool(options.processes, startWorker)
+    batch = []
+    for rendered in pool.imap_unordered(renderTile, tiles, 16):
+        batch.append(rendered)
+        if len(batch) >= COMMIT_EVERY:
+            store.putMany(batch)
+            progress.add(len(batch))
+            batch = []
+    store.putMany(batch)
+    progress.add(len(batch))
+    pool.close()
+    pool.join()
+
+    store.setMetadata('bounds', options.bbox)
+    store.setMetadata('minzoom', options.minZoom)
+    store.setMetadata('maxzoom', options.maxZoom)
+    progress.report()
+    print
+    store.close()
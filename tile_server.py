@@ -1,147 +1,467 @@
 import pymongo
-from pymongo import Connection
-from xml.sax.saxutils import escape
 import re
-
-from globalmaptiles import GlobalMercator
+import json
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+from globalmaptiles import GlobalMercator, MORTON_ZOOM
+from compactschema import expandRecord
+from insert_tiled_osm_data import WAY_ZOOM, wayTileQuery
+from tilestore import TileStore, gzipBytes, gunzipBytes
+from osmxml import OsmXmlWriter
+from mongopool import MongoPool, addPoolOptions, openPool
 
 class OsmApi:
-    def __init__(self):
-        self.client = Connection()
+    """Reads tiles through a MongoPool, which can be shared by every
+    request thread"""
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = MongoPool()
+        self.pool = pool
+        self.client = pool.client
         self.proj = GlobalMercator()
 
     def getTile(self, zoom, x, y):
-        (x, y) = self.proj.GoogleTile(x,y,zoom)
-        quadkey = self.proj.QuadTree(x,y,zoom)
-        print "Querying for %s." % (quadkey,)
-        (minlat, minlon, maxlat, maxlon) = self.proj.TileLatLonBounds(x,y,zoom)
+        return self.getMetatile(zoom, x, y, 1)[(x, y)]
 
-        # Nodes in the tile
+    def getMetatile(self, zoom, x, y, size):
+        """Load the size x size block of tiles (size a power of two) holding
+        a tile with one query per collection plus one for the nodes of
+        ways leaving the block, and split it up into per-tile documents.
+        Returns {(x, y): doc} for every tile in the block."""
+        (levels, bx, by, blockZoom) = metatileBlock(self.proj, zoom, x, y, size)
+        print "Querying for %s." % (self.proj.QuadTree(bx,by,blockZoom),)
+
+        # Nodes in the block
         nodes = {}
-        cursor = self.client.osm.nodes.find({'qk': {'$regex': "^%s" % (quadkey,)} })
+        cursor = self.pool.find(self.client.osm.nodes, blockNodeQuery(self.proj, bx, by, blockZoom))
         for row in cursor:
-            nodes[row['_id']] = row
+            nodes[row['_id']] = expandRecord(row)
 
-        # Ways with nodes in the tile
+        # Ways whose tile coverings overlap the block
         ways = {}
-        cursor = self.client.osm.ways.find({'loc': {'$regex': "^%s" % (quadkey,)} })
+        cursor = self.pool.find(self.client.osm.ways, wayTileQuery(self.proj, bx, by, blockZoom))
         for row in cursor:
-            ways[row['_id']] = row
+            ways[row['_id']] = expandRecord(row)
 
-        # Nodes on ways that extend beyond the bounding box
-        otherNids = set()
-        for way in ways.values():
-            for nid in way['nodes']:
-                otherNids.add(nid)
-        cursor = self.client.osm.nodes.find({'_id': {'$in': list(otherNids)} })
+        # Nodes on ways that extend beyond the block
+        otherNodes = {}
+        cursor = self.pool.find(self.client.osm.nodes, {'_id': {'$in': list(otherNodeIds(ways, nodes))} })
         for row in cursor:
-            nodes[row['_id']] = row
-
-        # Relations that contain any of the above as members
-        relations = {}
-
-        # Sort the results by id
-        nodes = sorted(nodes.iteritems())
-        ways = sorted(ways.iteritems())
-        relations = sorted(relations.iteritems())
-
-        doc = {'bounds': {'minlat': minlat,
-                          'minlon': minlon,
-                          'maxlat': maxlat,
-                          'maxlon': maxlon},
-               'nodes': nodes,
-               'ways': ways,
-               'relations': relations}
-
-        return doc
-
-class OsmXmlOutput:
-    def addNotNullAttr(self, mappable, mappableElement, name, outName=None):
-        if not outName:
-            outName = name
-        if name in mappable:
-            mappableElement.setAttribute(escape(outName), escape(unicode(mappable[name])))
-
-    def defaultAttrs(self, mappableElement, mappable):
-        self.addNotNullAttr(mappable, mappableElement, "_id", "id")
-        self.addNotNullAttr(mappable, mappableElement, "v", "version")
-        self.addNotNullAttr(mappable, mappableElement, "user")
-
-    def tagNodes(self, doc, mappableElement, mappable):
-        for mappable in mappable['tags']:
-            k,v = mappable
-            tagElement = doc.createElement("tag")
-            tagElement.setAttribute("k", k)
-            tagElement.setAttribute("v", v)
-            mappableElement.appendChild(tagElement)
+            otherNodes[row['_id']] = expandRecord(row)
+
+        return splitMetatile(self.proj, zoom, x, y, levels, nodes, ways, otherNodes)
+
+def metatileBlock(proj, zoom, x, y, size):
+    """(levels, bx, by, blockZoom) of the size x size block holding a tile:
+    the block is the TMS tile bx, by at blockZoom, levels zooms out"""
+    levels = 0
+    while (1 << (levels + 1)) <= size and levels < zoom:
+        levels = levels + 1
+    blockZoom = zoom - levels
+    (bx, by) = proj.GoogleTile(x >> levels, y >> levels, blockZoom)
+    return (levels, bx, by, blockZoom)
+
+def blockNodeQuery(proj, bx, by, blockZoom):
+    (minKey, maxKey) = proj.MortonRange(bx, by, blockZoom)
+    return {'qk': {'$gte': minKey, '$lt': maxKey} }
+
+def otherNodeIds(ways, nodes):
+    """Ids of the nodes of ways that aren't in nodes"""
+    otherNids = set()
+    for way in ways.values():
+        for nid in way['n']:
+            if nid not in nodes:
+                otherNids.add(nid)
+    return otherNids
+
+def splitMetatile(proj, zoom, x, y, levels, nodes, ways, otherNodes):
+    """Split a block's nodes, ways and the nodes of ways leaving it (each
+    {id: document}) into {(x, y): doc} for every tile in the block"""
+    allNodes = dict(otherNodes)
+    allNodes.update(nodes)
+
+    # Coverings can be coarser than the ways, so a way only goes in the
+    # tiles its nodes are in. Ways only know their tiles down to
+    # WAY_ZOOM, so deeper tiles get the ways of their parent there.
+    shift = 2 * (MORTON_ZOOM - zoom)
+    wayZoom = min(zoom, WAY_ZOOM)
+    wayShift = 2 * (MORTON_ZOOM - wayZoom)
+    tileNodes = {}
+    for node in nodes.itervalues():
+        tileNodes.setdefault(node['qk'] >> shift, []).append(node)
+    tileWays = {}
+    for way in ways.itervalues():
+        keys = set(allNodes[nid]['qk'] >> wayShift for nid in way['n'] if nid in allNodes)
+        for key in keys:
+            tileWays.setdefault(key, []).append(way)
+
+    docs = {}
+    for tileX in range(x >> levels << levels, ((x >> levels) + 1) << levels):
+        for tileY in range(y >> levels << levels, ((y >> levels) + 1) << levels):
+            (tx, ty) = proj.GoogleTile(tileX, tileY, zoom)
+            (minlat, minlon, maxlat, maxlon) = proj.TileLatLonBounds(tx,ty,zoom)
+            key = proj.MortonKey(tx, ty, zoom)
+
+            tileDocNodes = dict((node['_id'], node) for node in tileNodes.get(key, []))
+            tileDocWays = {}
+            for way in tileWays.get(key >> (2 * (zoom - wayZoom)), []):
+                tileDocWays[way['_id']] = way
+                for nid in way['n']:
+                    if nid in allNodes:
+                        tileDocNodes[nid] = allNodes[nid]
+
+            # Relations that contain any of the above as members
+            relations = {}
+
+            # Sort the results by id
+            docs[(tileX, tileY)] = {'bounds': {'minlat': minlat,
+                                               'minlon': minlon,
+                                               'maxlat': maxlat,
+                                               'maxlon': maxlon},
+                                    'nodes': sorted(tileDocNodes.iteritems()),
+                                    'ways': sorted(tileDocWays.iteritems()),
+                                    'relations': sorted(relations.iteritems())}
+    return docs
+
+class SharedInvalidations(object):
+    """The quadkeys invalidated by any of the processes forked after this
+    is made, so that every process's TileCache can drop them.
+
+    Quadkeys are appended to an unlinked temporary file, one per line, and
+    a counter in shared memory says how many bytes of it are written, so
+    checking for new ones doesn't take the lock."""
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.lock = multiprocessing.Lock()
+        self.written = multiprocessing.RawValue('l', 0)
+
+    def add(self, quadkey):
+        line = str(quadkey) + '\n'
+        with self.lock:
+            # The file offset is shared with the other processes too
+            os.lseek(self.file.fileno(), self.written.value, os.SEEK_SET)
+            os.write(self.file.fileno(), line)
+            self.written.value = self.written.value + len(line)
+
+    def since(self, offset):
+        """The quadkeys added after offset, and the offset they end at"""
+        end = self.written.value
+        if end == offset:
+            return ([], offset)
+        with self.lock:
+            os.lseek(self.file.fileno(), offset, os.SEEK_SET)
+            data = os.read(self.file.fileno(), end - offset)
+        return (data.split('\n')[:-1], offset + len(data))
+
+class TileCache(object):
+    """Size-bounded LRU cache of rendered tile bodies keyed by
+    (zoom, x, y, format), optionally stored gzipped.
+
+    Changed data invalidates by quadkey: every cached tile that contains
+    the changed tile or lies inside it is dropped. With shared (a
+    SharedInvalidations), invalidations reach the caches of the other
+    processes too; each drops their tiles before it serves its next one."""
+    def __init__(self, maxBytes=64 * 1024 * 1024, compress=False, shared=None):
+        self.maxBytes = maxBytes
+        self.compress = compress
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.proj = GlobalMercator()
+        self.shared = shared
+        self.sharedOffset = shared.written.value if shared is not None else 0
+
+        self.stat_hits = 0
+        self.stat_misses = 0
+        self.stat_evictions = 0
+        self.stat_invalidations = 0
+
+    def get(self, zoom, x, y, format='xml'):
+        """The cached (body, gzipped) for a tile, or None"""
+        self.sync()
+        with self.lock:
+            entry = self.entries.pop((zoom, x, y, format), None)
+            if entry is None:
+                self.stat_misses = self.stat_misses + 1
+                return None
+            self.entries[(zoom, x, y, format)] = entry
+            self.stat_hits = self.stat_hits + 1
+            return (entry[1], self.compress)
+
+    def put(self, zoom, x, y, body, format='xml'):
+        if self.compress:
+            body = gzipBytes(body)
+        if len(body) > self.maxBytes:
+            return
+        (tx, ty) = self.proj.GoogleTile(x, y, zoom)
+        quadkey = self.proj.QuadTree(tx, ty, zoom)
+        with self.lock:
+            old = self.entries.pop((zoom, x, y, format), None)
+            if old is not None:
+                self.size = self.size - len(old[1])
+            self.entries[(zoom, x, y, format)] = (quadkey, body)
+            self.size = self.size + len(body)
+            while self.size > self.maxBytes:
+                (key, (quadkey, evicted)) = self.entries.popitem(last=False)
+                self.size = self.size - len(evicted)
+                self.stat_evictions = self.stat_evictions + 1
+
+    def invalidate(self, quadkey):
+        """Drop the tiles overlapping the tile with the given quadkey,
+        returning how many were dropped from this cache"""
+        if self.shared is not None:
+            self.shared.add(quadkey)
+        with self.lock:
+            return self.drop(quadkey)
+
+    def sync(self):
+        """Drop the tiles invalidated by other processes since last time"""
+        if self.shared is None:
+            return
+        with self.lock:
+            (quadkeys, self.sharedOffset) = self.shared.since(self.sharedOffset)
+            for quadkey in quadkeys:
+                self.drop(quadkey)
+
+    def drop(self, quadkey):
+        # Called with the lock held
+        stale = [key for (key, (tileQuadkey, body)) in self.entries.iteritems()
+                 if tileQuadkey.startswith(quadkey) or quadkey.startswith(tileQuadkey)]
+        for key in stale:
+            (tileQuadkey, body) = self.entries.pop(key)
+            self.size = self.size - len(body)
+        self.stat_invalidations = self.stat_invalidations + len(stale)
+        return len(stale)
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.maxBytes,
+                'compressed': self.compress,
+                'hits': self.stat_hits,
+                'misses': self.stat_misses,
+                'evictions': self.stat_evictions,
+                'invalidations': self.stat_invalidations}
+
+class OsmXmlOutput(OsmXmlWriter):
+    GENERATOR = "tiled mongosm 0.1"
+    ATTRS = (('_id', 'id'), ('v', 'version'), ('u', 'user'))
+    REFS = 'n'
+    MEMBERS = 'm'
+
+    def coordinates(self, node):
+        return (node['loc']['lat'], node['loc']['lon'])
+
+    def items(self, data, name):
+        # getMetatile() hands out (id, document) pairs
+        return (mappable for (id, mappable) in data.get(name, ()))
+
+def pbVarint(value, out):
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value = value >> 7
+    out.append(chr(value))
+
+def pbZigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+def pbField(field, wireType, out):
+    pbVarint((field << 3) | wireType, out)
+
+def pbBytes(field, data, out):
+    pbField(field, 2, out)
+    pbVarint(len(data), out)
+    out.append(data)
+
+def pbPacked(field, values, out):
+    packed = []
+    for value in values:
+        pbVarint(value, packed)
+    pbBytes(field, ''.join(packed), out)
+
+class OsmVectorTileOutput:
+    """Encodes a getTile document as a Mapbox vector tile
+    (https://github.com/mapbox/vector-tile-spec): tagged nodes as points in
+    a "nodes" layer and ways as linestrings in a "ways" layer, with
+    tile-local integer coordinates and tags dictionary-encoded per layer.
+    Each layer is yielded as soon as it is encoded."""
+    EXTENT = 4096
+    POINT = 1
+    LINESTRING = 2
+
+    def __init__(self):
+        self.proj = GlobalMercator()
+
+    def tilePoint(self, loc, bounds):
+        (mx, my) = self.proj.LatLonToMeters(loc['lat'], loc['lon'])
+        (minx, miny, maxx, maxy) = bounds
+        return (int(round((mx - minx) * self.EXTENT / (maxx - minx))),
+                int(round((maxy - my) * self.EXTENT / (maxy - miny))))
+
+    def geometry(self, points):
+        """Command integers for a point or linestring"""
+        commands = []
+        (x, y) = (0, 0)
+        for (i, (px, py)) in enumerate(points):
+            if i == 0:
+                commands.append((1 << 3) | 1)  # MoveTo, once
+            elif i == 1:
+                commands.append(((len(points) - 1) << 3) | 2)  # LineTo the rest
+            commands.append(pbZigzag(px - x))
+            commands.append(pbZigzag(py - y))
+            (x, y) = (px, py)
+        return commands
+
+    def layer(self, name, features):
+        """Encode a layer from (id, geometry type, points, tags) features"""
+        keys = {}
+        values = {}
+        out = []
+        for (id, geomType, points, tags) in features:
+            if len(points) < geomType:
+                # Points need one point and linestrings two
+                continue
+            feature = []
+            pbField(1, 0, feature)
+            pbVarint(id, feature)
+            tagIndexes = []
+            for (k, v) in tags:
+                tagIndexes.append(keys.setdefault(k, len(keys)))
+                tagIndexes.append(values.setdefault(v, len(values)))
+            if tagIndexes:
+                pbPacked(2, tagIndexes, feature)
+            pbField(3, 0, feature)
+            pbVarint(geomType, feature)
+            pbPacked(4, self.geometry(points), feature)
+            pbBytes(2, ''.join(feature), out)
+
+        header = []
+        pbField(15, 0, header)
+        pbVarint(2, header)
+        pbBytes(1, name, header)
+        for k in sorted(keys, key=keys.get):
+            pbBytes(3, k.encode('utf-8'), out)
+        for v in sorted(values, key=values.get):
+            value = []
+            pbBytes(1, v.encode('utf-8'), value)
+            pbBytes(4, ''.join(value), out)
+        pbField(5, 0, out)
+        pbVarint(self.EXTENT, out)
+
+        tile = []
+        pbBytes(3, ''.join(header + out), tile)
+        return ''.join(tile)
+
+    def pointFeatures(self, nodes, bounds):
+        for (id, node) in nodes:
+            # Untagged nodes and nodes outside the tile are only there for
+            # the ways' sake
+            if not node.get('tg'):
+                continue
+            (x, y) = self.tilePoint(node['loc'], bounds)
+            if 0 <= x <= self.EXTENT and 0 <= y <= self.EXTENT:
+                yield (id, self.POINT, [(x, y)], node['tg'])
 
     def iter(self, data):
-        from xml.dom.minidom import Document
-        doc = Document()
-
-        yield '<osm generator="%s" version="%s">\n' % ("tiled mongosm 0.1", "0.6")
-
-        if 'bounds' in data:
-            yield '<bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n' % (
-                    str(data['bounds']['minlat']),
-                    str(data['bounds']['minlon']),
-                    str(data['bounds']['maxlat']),
-                    str(data['bounds']['maxlon']))
-
-        if 'nodes' in data:
-            for (id, node) in data['nodes']:
-                nodeElem = doc.createElement("node")
-                nodeElem.setAttribute("lat", str(node['loc']['lat']))
-                nodeElem.setAttribute("lon", str(node['loc']['lon']))
-                self.defaultAttrs(nodeElem, node)
-                self.tagNodes(doc, nodeElem, node)
-                yield "%s\n" % (nodeElem.toxml('UTF-8'),)
-
-        if 'ways' in data:
-            for (id, way) in data['ways']:
-                wayElem = doc.createElement("way")
-                self.defaultAttrs(wayElem, way)
-                self.tagNodes(doc, wayElem, way)
-                for ref in way['nodes']:
-                    refElement = doc.createElement("nd")
-                    refElement.setAttribute("ref", str(ref))
-                    wayElem.appendChild(refElement)
-                yield "%s\n" % (wayElem.toxml('UTF-8'),)
-
-        if 'relations' in data:
-            for (id, relation) in data['relations']:
-                relationElem = doc.createElement("relation")
-                self.defaultAttrs(relationElem, relation)
-                self.tagNodes(doc, relationElem, relation)
-                for member in relation['members']:
-                    memberElem = doc.createElement("member")
-                    memberElem.setAttribute("type", member['type'])
-                    memberElem.setAttribute("ref", str(member['ref']))
-                    memberElem.setAttribute("role", member['role'])
-                    relationElem.appendChild(memberElem)
-                yield "%s\n" % (relationElem.toxml('UTF-8'),)
-
-        yield '</osm>\n'
+        b = data['bounds']
+        (mx, my) = self.proj.LatLonToMeters(b['minlat'], b['minlon'])
+        (maxx, maxy) = self.proj.LatLonToMeters(b['maxlat'], b['maxlon'])
+        bounds = (mx, my, maxx, maxy)
+
+        nodes = dict(data.get('nodes', []))
+        yield self.layer('nodes', self.pointFeatures(data.get('nodes', []), bounds))
+        yield self.layer('ways', ((id, self.LINESTRING,
+                                   [self.tilePoint(nodes[nid]['loc'], bounds)
+                                    for nid in way['n'] if nid in nodes],
+                                   way.get('tg', []))
+                                  for (id, way) in data.get('ways', [])))
+
+# Output formats by name: (outputter, content type)
+OUTPUTS = {'xml': (OsmXmlOutput, 'text/xml'),
+           'mvt': (OsmVectorTileOutput, 'application/vnd.mapbox-vector-tile')}
 
 import time, sys
 import os
 import urlparse
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.exceptions import HTTPException, NotFound, BadRequest
+
+def tileFormat(request, y):
+    """Vector tiles are asked for with a .mvt (or .pbf) extension or an
+    Accept header, anything else gets OSM XML"""
+    if y.endswith('.mvt') or y.endswith('.pbf'):
+        return 'mvt'
+    accept = request.headers.get('Accept', '')
+    if 'application/vnd.mapbox-vector-tile' in accept or 'application/x-protobuf' in accept:
+        return 'mvt'
+    return 'xml'
 
 class Mongosm(object):
 
     def tileRequest(self, request, zoom, x, y):
         #(minlon, minlat, maxlon, maxlat) = request.args['bbox'].split(',')
         #bbox = [[float(minlat), float(minlon)],[float(maxlat), float(maxlon)]]
-
-        api = OsmApi()
-        data = api.getTile(int(zoom), int(x), int(y))
-
-        outputter = OsmXmlOutput()
-
-        return Response(outputter.iter(data), content_type='text/xml', direct_passthrough=True)
+        format = tileFormat(request, y)
+        (outputClass, contentType) = OUTPUTS[format]
+        (zoom, x, y) = (int(zoom), int(x), int(y.split('.')[0]))
+
+        if self.store is not None and format == 'xml':
+            body = self.store.get(zoom, x, y)
+            if body is not None:
+                return self.tileResponse(request, body, True, contentType)
+
+        if self.cache is None:
+            data = self.api.getTile(zoom, x, y)
+            outputter = outputClass()
+            return Response(outputter.iter(data), content_type=contentType, direct_passthrough=True)
+
+        cached = self.cache.get(zoom, x, y, format)
+        if cached is None:
+            # Neighbouring tiles are likely to be asked for next, so render
+            # the whole metatile and cache all of it
+            for ((tileX, tileY), data) in self.api.getMetatile(zoom, x, y, self.metatile).iteritems():
+                tileBody = ''.join(outputClass().iter(data))
+                self.cache.put(zoom, tileX, tileY, tileBody, format)
+                if (tileX, tileY) == (x, y):
+                    body = tileBody
+            return Response(body, content_type=contentType)
+
+        (body, gzipped) = cached
+        return self.tileResponse(request, body, gzipped, contentType)
+
+    def tileResponse(self, request, body, gzipped, contentType='text/xml'):
+        """Send a stored tile, gzipped as it is if the client accepts that"""
+        if not gzipped:
+            return Response(body, content_type=contentType)
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = Response(body, content_type=contentType)
+            response.headers['Content-Encoding'] = 'gzip'
+            return response
+        return Response(gunzipBytes(body), content_type=contentType)
+
+    def invalidateRequest(self, request, quadkey):
+        """Drop cached tiles overlapping a changed tile, given as a quadkey"""
+        if request.method != 'POST':
+            raise BadRequest("Invalidate tiles with a POST")
+        if not re.match('^[0-3]*$', quadkey):
+            raise BadRequest("Not a quadkey: %s" % (quadkey,))
+        dropped = 0
+        if self.cache is not None:
+            dropped = dropped + self.cache.invalidate(quadkey)
+        if self.store is not None:
+            dropped = dropped + self.store.invalidate(quadkey)
+        return Response(json.dumps({'invalidated': dropped}), content_type='application/json')
+
+    def cacheStatsRequest(self, request):
+        stats = self.cache.stats() if self.cache is not None else {}
+        return Response(json.dumps(stats), content_type='application/json')
+
+    def poolStatsRequest(self, request):
+        return Response(json.dumps(self.api.pool.stats()), content_type='application/json')
 
     def capabilitiesRequest(self, request):
         return Response("""
@@ -152,9 +472,18 @@ class Mongosm(object):
                 </api>
             </osm>""")
 
-    def __init__(self):
+    def __init__(self, cache=None, store=None, metatile=1, api=None):
+        if api is None:
+            api = OsmApi()
+        self.api = api
+        self.cache = cache
+        self.store = store
+        self.metatile = metatile
         self.url_map = Map([
             Rule('/tiles/0.6/<zoom>/<x>/<y>', endpoint='tileRequest'),
+            Rule('/tiles/invalidate/<quadkey>', endpoint='invalidateRequest'),
+            Rule('/tiles/cache', endpoint='cacheStatsRequest'),
+            Rule('/tiles/pool', endpoint='poolStatsRequest'),
             Rule('/api/capabilities', endpoint='capabilitiesRequest'),
         ])
 
@@ -175,6 +504,41 @@ class Mongosm(object):
         return self.wsgi_app(environ, start_response)
 
 if __name__ == '__main__':
-    from werkzeug.serving import run_simple
-    app = Mongosm()
-    run_simple('0.0.0.0', 5000, app, use_debugger=True, use_reloader=True)
+    from optparse import OptionParser
+    import prefork
+
+    parser = OptionParser()
+    parser.add_option("--cache-mb", dest="cacheMb", type="int", default=64,
+                      help="MB of rendered tiles to keep in memory, 0 to turn "
+                           "the cache off [%default]")
+    parser.add_option("--cache-gzip", dest="cacheGzip", action="store_true",
+                      default=False,
+                      help="keep cached tiles gzipped (and send them that way "
+                           "to clients that accept it)")
+    parser.add_option("--store", dest="store", default=None,
+                      help="serve pre-rendered tiles from this tile store "
+                           "(see seed_tiles.py) when it has them")
+    parser.add_option("--metatile", dest="metatile", type="int", default=1,
+                      help="on a cache miss, load and cache the whole N x N block "
+                           "of tiles around the tile (N a power of two) [%default]")
+    addPoolOptions(parser)
+    prefork.addServeOptions(parser)
+    (options, args) = parser.parse_args()
+    if options.metatile < 1 or options.metatile & (options.metatile - 1):
+        parser.error("--metatile must be a power of two")
+
+    # Each worker gets its own cache; invalidations reach all of them
+    # through state made before the workers are forked
+    shared = SharedInvalidations() if options.cacheMb > 0 else None
+
+    def makeApp():
+        cache = None
+        if options.cacheMb > 0:
+            cache = TileCache(options.cacheMb * 1024 * 1024, options.cacheGzip, shared)
+        store = None
+        if options.store:
+            store = TileStore(options.store)
+        pool = openPool(options)
+        pool.warm()
+        return Mongosm(cache, store, options.metatile, OsmApi(pool))
+    prefork.run(options, makeApp)
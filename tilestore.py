@@ -0,0 +1,112 @@
+"""Pre-rendered tiles in a single SQLite file laid out like MBTiles
+(http://github.com/mapbox/mbtiles-spec): a tiles table of gzipped bodies
+keyed by zoom, column and TMS row, plus a metadata table."""
+
+import os
+import gzip
+import sqlite3
+import threading
+from StringIO import StringIO
+
+def gzipBytes(data):
+    buf = StringIO()
+    out = gzip.GzipFile(fileobj=buf, mode='wb')
+    out.write(data)
+    out.close()
+    return buf.getvalue()
+
+def gunzipBytes(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+def quadKeyToTile(quadkey):
+    """Google tile (zoom, x, y) of a Microsoft QuadTree string"""
+    x = y = 0
+    for digit in quadkey:
+        digit = int(digit)
+        x = (x << 1) | (digit & 1)
+        y = (y << 1) | (digit >> 1)
+    return (len(quadkey), x, y)
+
+class TileStore(object):
+    """Gzipped tile bodies by Google tile coordinates. Each thread gets its
+    own SQLite connection."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        db = self.db()
+        db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, "
+                   "tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles "
+                   "(zoom_level, tile_column, tile_row)")
+        db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        db.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)",
+                       [('name', os.path.basename(filename)),
+                        ('format', 'osm'),
+                        ('compression', 'gzip')])
+        db.commit()
+
+    def db(self):
+        if getattr(self.local, 'db', None) is None:
+            self.local.db = sqlite3.connect(self.filename)
+            self.local.db.text_factory = str
+        return self.local.db
+
+    def get(self, zoom, x, y):
+        """The gzipped body of a tile, or None if it isn't stored"""
+        row = self.db().execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND "
+                                "tile_column = ? AND tile_row = ?",
+                                (zoom, x, (2**zoom - 1) - y)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def has(self, zoom, x, y):
+        return self.db().execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND "
+                                 "tile_column = ? AND tile_row = ?",
+                                 (zoom, x, (2**zoom - 1) - y)).fetchone() is not None
+
+    def putMany(self, tiles):
+        """Store (zoom, x, y, gzipped body) tuples in one transaction"""
+        db = self.db()
+        db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                       [(zoom, x, (2**zoom - 1) - y, sqlite3.Binary(body))
+                        for (zoom, x, y, body) in tiles])
+        db.commit()
+
+    def setMetadata(self, name, value):
+        db = self.db()
+        db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (name, str(value)))
+        db.commit()
+
+    def invalidate(self, quadkey):
+        """Delete the stored tiles overlapping the tile with the given
+        quadkey, returning how many were deleted"""
+        (zoom, x, y) = quadKeyToTile(quadkey)
+        db = self.db()
+        deleted = 0
+        zooms = [row[0] for row in db.execute("SELECT DISTINCT zoom_level FROM tiles")]
+        for z in zooms:
+            if z <= zoom:
+                # The one tile at z containing the changed tile
+                shift = zoom - z
+                (minX, maxX) = (x >> shift, x >> shift)
+                (minY, maxY) = (y >> shift, y >> shift)
+            else:
+                shift = z - zoom
+                (minX, maxX) = (x << shift, ((x + 1) << shift) - 1)
+                (minY, maxY) = (y << shift, ((y + 1) << shift) - 1)
+            # Rows count up from the bottom of the map
+            cursor = db.execute("DELETE FROM tiles WHERE zoom_level = ? AND "
+                                "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                                (z, minX, maxX, (2**z - 1) - maxY, (2**z - 1) - minY))
+            deleted = deleted + cursor.rowcount
+        db.commit()
+        return deleted
+
+    def size(self):
+        return os.path.getsize(self.filename)
+
+    def close(self):
+        if getattr(self.local, 'db', None) is not None:
+            self.local.db.close()
+            self.local.db = None